@@ -0,0 +1,46 @@
+"""
+基准测试的运行环境
+
+管道脚本依赖 open_webui 提供的 pop_system_message 和 UPLOAD_DIR，
+在未安装 open-webui 的开发环境中运行基准测试时，注册一个最小化的替代模块。
+"""
+
+import os
+import sys
+import types
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _pop_system_message(messages):
+    system_message = next((m for m in messages if m.get("role") == "system"), None)
+    return system_message, [m for m in messages if m.get("role") != "system"]
+
+
+def ensure_open_webui():
+    """open-webui 不可用时注册 open_webui.utils.misc 与 open_webui.config"""
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    try:
+        import open_webui.utils.misc  # noqa: F401
+        import open_webui.config  # noqa: F401
+        return
+    except ImportError:
+        pass
+    package = types.ModuleType("open_webui")
+    package.__path__ = []
+    utils = types.ModuleType("open_webui.utils")
+    utils.__path__ = []
+    misc = types.ModuleType("open_webui.utils.misc")
+    misc.pop_system_message = _pop_system_message
+    config = types.ModuleType("open_webui.config")
+    config.UPLOAD_DIR = "data/uploads"
+    package.utils = utils
+    package.config = config
+    utils.misc = misc
+    sys.modules.update({
+        "open_webui": package,
+        "open_webui.utils": utils,
+        "open_webui.utils.misc": misc,
+        "open_webui.config": config,
+    })
@@ -0,0 +1,76 @@
+"""
+图片上传内存微基准：旧的 split + b64decode + 临时文件 路径 对比 Base64Reader 流式解码路径
+
+两种方式都构建与 requests 上传时相同的 multipart 请求体（不发送网络请求），用 tracemalloc 统计峰值内存。
+
+用法:
+    python benchmarks/bench_image_upload.py [--size-mb 8]
+"""
+
+import argparse
+import base64
+import hashlib
+import os
+import tempfile
+import tracemalloc
+
+import requests
+
+from _compat import ensure_open_webui
+
+ensure_open_webui()
+
+from dify_pipe import Base64Reader, sniff_image_type  # noqa: E402
+
+URL = "http://127.0.0.1/v1/files/upload"
+
+
+def legacy_upload(data_url: str):
+    image_data_base64 = data_url.split(",", 1)[1]
+    image_data = base64.b64decode(image_data_base64)
+    hashlib.sha256(image_data).hexdigest()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
+        tmp_file.write(image_data)
+        temp_file_path = tmp_file.name
+    try:
+        with open(temp_file_path, "rb") as file:
+            files = {"file": ("image.png", file, "image/png"), "user": (None, "user")}
+            return requests.Request("POST", URL, files=files).prepare()
+    finally:
+        os.remove(temp_file_path)
+
+
+def streaming_upload(data_url: str):
+    reader = Base64Reader(data_url)
+    _, head = reader.digest()
+    mime_type, extension = sniff_image_type(head, reader.declared_type or "image/png")
+    files = {"file": (f"image.{extension}", reader.read_all(), mime_type), "user": (None, "user")}
+    return requests.Request("POST", URL, files=files).prepare()
+
+
+def peak_memory(func, data_url: str) -> int:
+    tracemalloc.start()
+    prepared = func(data_url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del prepared
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=8)
+    args = parser.parse_args()
+
+    image = b"\x89PNG\r\n\x1a\n" + os.urandom(int(args.size_mb * 1024 * 1024))
+    data_url = "data:image/png;base64," + base64.b64encode(image).decode()
+
+    legacy = peak_memory(legacy_upload, data_url)
+    streaming = peak_memory(streaming_upload, data_url)
+    print(f"image: {len(image) / 1024 / 1024:.1f} MiB, data URL: {len(data_url) / 1024 / 1024:.1f} MiB")
+    print(f"split + b64decode + tempfile: peak {legacy / 1024 / 1024:8.1f} MiB")
+    print(f"Base64Reader:                 peak {streaming / 1024 / 1024:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+压测基准：以N个并发聊天驱动 dify_pipe.Pipe 与 dify_Workflow.Pipe，后端为本地模拟的Dify服务
+
+统计每个并发级别的 TTFT（从调用pipe到输出第一段内容）与完整响应耗时的 p50/p95/p99、吞吐量、
+本进程的CPU占用与RSS。模拟服务默认在子进程中启动，其CPU不计入结果。
+结果保存为JSON，--compare 指定之前的结果文件时逐项对比，超出 --threshold 的退化以非零退出码返回。
+
+用法:
+    python benchmarks/bench_load.py [--target pipe,workflow] [--concurrency 1,8,32] [--requests 200]
+                                    [--sync] [--blocking] [--image-kb 0] [--url http://host:port/v1]
+                                    [--label baseline] [--compare benchmarks/results/baseline.json]
+    模拟服务的参数（--tokens、--token-rate、--latency-ms、--error-rate 等）见 mock_dify.py
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from _compat import REPO_ROOT, ensure_open_webui
+from mock_dify import build_parser
+
+ensure_open_webui()
+
+import dify_pipe  # noqa: E402
+import dify_Workflow  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+USER = {"id": "bench", "email": "bench@example.com", "name": "bench"}
+# 对比时越小越好与越大越好的指标
+LOWER_IS_BETTER = ["ttft_ms.p50", "ttft_ms.p95", "ttft_ms.p99", "latency_ms.p95", "cpu_percent", "peak_rss_mb"]
+HIGHER_IS_BETTER = ["throughput_rps"]
+
+
+def percentile(values: list, pct: float) -> float:
+    """最近秩百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "mean": round(sum(values) / len(values), 2) if values else 0.0,
+        "max": round(max(values), 2) if values else 0.0,
+    }
+
+
+def cpu_seconds() -> float:
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def rss_mb() -> float:
+    """当前RSS，无法读取 /proc 时为0"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux为KB，macOS为字节
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(args) -> tuple:
+    """在子进程中启动 mock_dify.py，返回 (进程, base_url)"""
+    port = free_port()
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_dify.py"), "--port", str(port)]
+    for action in build_parser()._actions:
+        if action.dest == "help":
+            continue
+        value = getattr(args, action.dest)
+        if value is not None:
+            command += [action.option_strings[0], str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, f"http://127.0.0.1:{port}/v1"
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("模拟Dify服务启动超时")
+
+
+def make_emitter(chat_id: str, message_id: str):
+    # 管道通过闭包中的字典获取chat_id，与open-webui的__event_emitter__一致
+    info = {"chat_id": chat_id, "message_id": message_id}
+
+    async def emitter(event):
+        _ = info
+
+    return emitter
+
+
+def make_body(target: str, args, image_url: str, index: int) -> dict:
+    model = "bench.dify_id" if target == "pipe" else "bench.dify_t2i"
+    content = f"benchmark request {index}"
+    if image_url:
+        content = [{"type": "text", "text": content}, {"type": "image_url", "image_url": {"url": image_url}}]
+    return {"model": model, "stream": not args.blocking, "messages": [{"role": "user", "content": content}]}
+
+
+def make_pipe(target: str, args, base_url: str, concurrency: int):
+    module = dify_pipe if target == "pipe" else dify_Workflow
+    pipe = module.Pipe()
+    valves = pipe.valves
+    valves.DIFY_BASE_URL = base_url
+    valves.FILE_SERVER = f"{base_url}/files/upload"
+    valves.DIFY_KEY = "app-benchmark"
+    valves.POOL_MAXSIZE = max(valves.POOL_MAXSIZE, concurrency)
+    valves.LOG_LEVEL = args.log_level
+    # 同一张图片每次都重新上传，测量上传路径本身
+    valves.UPLOAD_CACHE_SIZE = 0
+    if target == "pipe":
+        valves.ASYNC_MODE = not args.sync
+    return pipe
+
+
+def consume_sync(result, started: float) -> tuple:
+    """遍历同步生成器，返回 (首段内容时间, 文本长度, 是否出错)"""
+    first = None
+    chars = 0
+    failed = False
+    for chunk in result:
+        if first is None and chunk:
+            first = time.perf_counter()
+        text = chunk if isinstance(chunk, str) else json.dumps(chunk)
+        failed = failed or text.startswith("Error")
+        chars += len(text)
+    return first or time.perf_counter(), chars, failed
+
+
+async def consume(result, started: float) -> tuple:
+    if isinstance(result, str):
+        return time.perf_counter(), len(result), result.startswith("Error")
+    if hasattr(result, "__aiter__"):
+        first = None
+        chars = 0
+        failed = False
+        async for chunk in result:
+            if first is None and chunk:
+                first = time.perf_counter()
+            text = chunk if isinstance(chunk, str) else json.dumps(chunk)
+            failed = failed or text.startswith("Error")
+            chars += len(text)
+        return first or time.perf_counter(), chars, failed
+    # open-webui 0.5 直接在事件循环中遍历同步生成器，这里保持一致，测到的是管道对事件循环的真实阻塞
+    return consume_sync(result, started)
+
+
+async def one_request(target: str, pipe, body: dict, index: int) -> dict:
+    chat_id = f"bench-{target}-{index}-{time.monotonic_ns()}"
+    emitter = make_emitter(chat_id, f"msg-{index}")
+    started = time.perf_counter()
+    try:
+        result = await pipe.pipe(body, emitter, USER)
+        first, chars, failed = await consume(result, started)
+    except Exception as e:
+        return {"ok": False, "error": repr(e), "ttft": None, "latency": time.perf_counter() - started, "chars": 0}
+    finished = time.perf_counter()
+    return {"ok": not failed, "ttft": first - started, "latency": finished - started, "chars": chars}
+
+
+async def run_level(target: str, args, base_url: str, concurrency: int, image_url: str) -> dict:
+    pipe = make_pipe(target, args, base_url, concurrency)
+    # 线程池要容纳全部并发请求，否则测到的是默认线程池的排队时间
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency * 2 + 4))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(index: int):
+        async with semaphore:
+            return await one_request(target, pipe, make_body(target, args, image_url, index), index)
+
+    # 预热：建立连接池、初始化状态存储
+    await asyncio.gather(*(limited(-i - 1) for i in range(min(concurrency, args.warmup))))
+
+    rss_before = rss_mb()
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    samples = await asyncio.gather(*(limited(i) for i in range(args.requests)))
+    wall = time.perf_counter() - started
+    cpu = cpu_seconds() - cpu_before
+
+    ok = [s for s in samples if s["ok"]]
+    errors = [s for s in samples if not s["ok"]]
+    return {
+        "target": target,
+        "mode": ("sync" if args.sync and target == "pipe" else "async" if target == "pipe" else "threads")
+                + ("/blocking" if args.blocking else "/streaming"),
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(errors),
+        "error_samples": sorted({s.get("error", "response starts with Error") for s in errors})[:5],
+        "ttft_ms": summarize([s["ttft"] * 1000 for s in ok]),
+        "latency_ms": summarize([s["latency"] * 1000 for s in ok]),
+        "throughput_rps": round(len(ok) / wall, 2) if wall else 0.0,
+        "chars_per_s": round(sum(s["chars"] for s in ok) / wall, 1) if wall else 0.0,
+        "wall_s": round(wall, 3),
+        "cpu_percent": round(cpu / wall * 100, 1) if wall else 0.0,
+        "rss_mb": round(rss_mb(), 1),
+        "rss_growth_mb": round(rss_mb() - rss_before, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=5,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def lookup(row: dict, key: str) -> float:
+    value = row
+    for part in key.split("."):
+        value = value.get(part, {}) if isinstance(value, dict) else {}
+    return value if isinstance(value, (int, float)) else 0.0
+
+
+def compare(results: list, baseline_path: str, threshold: float) -> list:
+    """与基线结果逐项对比，返回超出阈值的退化列表"""
+    with open(baseline_path) as f:
+        baseline = {(r["target"], r["mode"], r["concurrency"]): r for r in json.load(f)["results"]}
+    regressions = []
+    print(f"\n对比基线 {baseline_path}（阈值 {threshold:.0%}）")
+    for row in results:
+        base = baseline.get((row["target"], row["mode"], row["concurrency"]))
+        if base is None:
+            continue
+        for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            old, new = lookup(base, key), lookup(row, key)
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = change > threshold if key in LOWER_IS_BETTER else change < -threshold
+            flag = "  <-- 退化" if worse else ""
+            print(f"  {row['target']:<8} c={row['concurrency']:<4} {key:<16} {old:>10.2f} -> {new:>10.2f} ({change:+.1%}){flag}")
+            if worse:
+                regressions.append((row["target"], row["concurrency"], key, old, new))
+    return regressions
+
+
+def print_row(row: dict):
+    print(
+        f"{row['target']:<8} {row['mode']:<18} c={row['concurrency']:<4} "
+        f"ttft p50/p95/p99 {row['ttft_ms']['p50']:8.1f}/{row['ttft_ms']['p95']:8.1f}/{row['ttft_ms']['p99']:8.1f} ms  "
+        f"{row['throughput_rps']:8.1f} req/s  cpu {row['cpu_percent']:5.1f}%  "
+        f"rss {row['rss_mb']:6.1f} MiB  errors {row['errors']}",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", default="pipe,workflow", help="pipe、workflow，逗号分隔")
+    parser.add_argument("--concurrency", default="1,8,32", help="并发聊天数，逗号分隔")
+    parser.add_argument("--requests", type=int, default=200, help="每个并发级别的请求数")
+    parser.add_argument("--warmup", type=int, default=8, help="每个并发级别的预热请求数上限")
+    parser.add_argument("--sync", action="store_true", help="dify_pipe使用同步实现(ASYNC_MODE=False)")
+    parser.add_argument("--blocking", action="store_true", help="使用阻塞模式而非流式")
+    parser.add_argument("--image-kb", type=int, default=0, help="每个请求附带的图片大小(KB)，0表示不带图片")
+    parser.add_argument("--log-level", default="WARNING", help="管道的LOG_LEVEL")
+    parser.add_argument("--url", default="", help="使用已启动的模拟服务，如 http://127.0.0.1:18080/v1")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"), help="结果目录")
+    parser.add_argument("--label", default="", help="结果文件名，默认使用时间戳")
+    parser.add_argument("--compare", default="", help="对比的基线结果文件")
+    parser.add_argument("--threshold", type=float, default=0.1, help="判定退化的相对变化")
+    build_parser(parser)
+    args = parser.parse_args()
+
+    targets = [t.strip() for t in args.target.split(",") if t.strip()]
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    image_url = ""
+    if args.image_kb > 0:
+        image = b"\x89PNG\r\n\x1a\n" + os.urandom(args.image_kb * 1024)
+        image_url = "data:image/png;base64," + base64.b64encode(image).decode()
+
+    process = None
+    base_url = args.url.rstrip("/")
+    if not base_url:
+        process, base_url = start_mock_server(args)
+    output = os.path.abspath(args.output)
+    # 管道的状态文件写在相对路径data/下，放到临时目录中
+    workdir = tempfile.mkdtemp(prefix="dify-bench-")
+    os.chdir(workdir)
+    os.makedirs("data/uploads", exist_ok=True)
+
+    results = []
+    try:
+        for target in targets:
+            for concurrency in levels:
+                row = asyncio.run(run_level(target, args, base_url, concurrency, image_url))
+                print_row(row)
+                results.append(row)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    os.makedirs(output, exist_ok=True)
+    path = os.path.join(output, f"{args.label or datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到 {path}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 项退化")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
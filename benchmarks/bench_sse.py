@@ -0,0 +1,104 @@
+"""
+SSE解析微基准：旧的 iter_lines + 逐行 json.loads 循环 对比 SSEParser
+
+用法:
+    python benchmarks/bench_sse.py [--messages 2000] [--node-bytes 20000] [--chunk-size 512] [--repeat 5]
+"""
+
+import argparse
+import json
+import time
+
+from _compat import ensure_open_webui
+
+ensure_open_webui()
+
+from dify_pipe import STREAM_EVENTS, iter_sse_events  # noqa: E402
+
+
+def build_stream(messages: int, node_bytes: int) -> bytes:
+    """构造一段模拟的Dify流：大量message事件，穿插ping和体积较大的node_finished事件"""
+    big = "x" * node_bytes
+    parts = []
+    for i in range(messages):
+        parts.append(b"data: " + json.dumps({"event": "message", "answer": f"token{i} ", "conversation_id": "c", "message_id": "m"}).encode() + b"\n\n")
+        if i % 100 == 0:
+            parts.append(b"event: ping\n\n")
+            parts.append(b"data: " + json.dumps({"event": "node_finished", "data": {"outputs": {"text": big}}}).encode() + b"\n\n")
+    parts.append(b"data: " + json.dumps({"event": "workflow_finished", "data": {"outputs": {"text": big * 5}}}).encode() + b"\n\n")
+    parts.append(b"data: " + json.dumps({"event": "message_end", "conversation_id": "c", "message_id": "m"}).encode() + b"\n\n")
+    return b"".join(parts)
+
+
+def chunked(stream: bytes, chunk_size: int):
+    for i in range(0, len(stream), chunk_size):
+        yield stream[i:i + chunk_size]
+
+
+def iter_lines(chunks):
+    """与 requests.Response.iter_lines 相同的按行切分逻辑"""
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def legacy_loop(stream: bytes, chunk_size: int) -> int:
+    answers = 0
+    for line in iter_lines(chunked(stream, chunk_size)):
+        if line:
+            line = line.decode("utf-8")
+            if line.startswith("data: "):
+                data = json.loads(line[6:])
+                if data.get("event") == "message":
+                    answers += 1
+    return answers
+
+
+def parser_loop(stream: bytes, chunk_size: int) -> int:
+    answers = 0
+    for sse in iter_sse_events(chunked(stream, chunk_size), STREAM_EVENTS):
+        if sse.event == "message":
+            sse.data.get("answer")
+            answers += 1
+    return answers
+
+
+def bench(func, stream: bytes, chunk_size: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(stream, chunk_size)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--node-bytes", type=int, default=20000)
+    # requests.Response.iter_lines 默认每次读取512字节
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    stream = build_stream(args.messages, args.node_bytes)
+    assert legacy_loop(stream, args.chunk_size) == parser_loop(stream, args.chunk_size)
+
+    legacy = bench(legacy_loop, stream, args.chunk_size, args.repeat)
+    new = bench(parser_loop, stream, args.chunk_size, args.repeat)
+    print(f"stream: {len(stream) / 1024:.1f} KiB, {args.messages} message events, chunk {args.chunk_size} B")
+    print(f"iter_lines + json.loads: {legacy * 1000:8.2f} ms")
+    print(f"SSEParser:               {new * 1000:8.2f} ms  ({legacy / new:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
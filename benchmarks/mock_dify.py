@@ -0,0 +1,311 @@
+"""
+本地模拟的Dify服务，用于基准测试与压测，无需连接真实的Dify
+
+实现 /chat-messages、/completion-messages、/workflows/run、/files/upload 以及 /info、/parameters，
+支持流式(SSE)与阻塞两种响应模式；GET /_stats 返回各接口的请求计数。
+SSE的输出速率、首字节延迟、负载大小与错误注入均可配置。
+
+用法:
+    python benchmarks/mock_dify.py [--port 18080] [--tokens 50] [--token-rate 200] [--latency-ms 50]
+                                   [--error-rate 0.01] [--stream-error-rate 0.01] ...
+
+管道中将 DIFY_BASE_URL 设为 http://127.0.0.1:18080/v1，FILE_SERVER 设为 http://127.0.0.1:18080/v1/files/upload
+"""
+
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def build_parser(parser: argparse.ArgumentParser = None) -> argparse.ArgumentParser:
+    """模拟服务的参数，bench_load.py 复用同一组参数"""
+    parser = parser or argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    group = parser.add_argument_group("模拟Dify服务")
+    group.add_argument("--tokens", type=int, default=50, help="每个流式响应的message/text_chunk事件数")
+    group.add_argument("--token-rate", type=float, default=200, help="每秒输出的事件数，0表示不限速")
+    group.add_argument("--token-bytes", type=int, default=8, help="每个事件携带的文本字节数")
+    group.add_argument("--latency-ms", type=float, default=50, help="首字节前的延迟(毫秒)")
+    group.add_argument("--jitter-ms", type=float, default=0, help="首字节延迟的随机抖动上限(毫秒)")
+    group.add_argument("--nodes", type=int, default=3, help="工作流的节点数，每个节点输出node_started与node_finished")
+    group.add_argument("--node-delay-ms", type=float, default=0, help="每个节点开始后不输出任何事件的处理时间(毫秒)，模拟出图等耗时节点")
+    group.add_argument("--node-bytes", type=int, default=1000, help="node_finished事件中outputs的字节数")
+    group.add_argument("--images", type=int, default=1, help="workflow_finished输出的图片数")
+    group.add_argument("--upload-latency-ms", type=float, default=20, help="文件上传的处理延迟(毫秒)")
+    group.add_argument("--error-rate", type=float, default=0, help="以--error-status直接失败的请求比例")
+    group.add_argument("--error-status", type=int, default=503, help="注入错误时返回的HTTP状态码")
+    group.add_argument("--stream-error-rate", type=float, default=0, help="流式响应中途输出error事件并结束的比例")
+    group.add_argument("--seed", type=int, default=None, help="错误注入与抖动的随机种子")
+    return parser
+
+
+class MockDifyServer(ThreadingHTTPServer):
+    """按配置应答Dify API的HTTP服务，config为build_parser解析出的参数"""
+
+    daemon_threads = True
+    # 压测时大量并发连接同时到达，默认的5容易导致连接被拒绝
+    request_queue_size = 1024
+
+    def __init__(self, address, config):
+        super().__init__(address, MockDifyHandler)
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, key: str):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def chance(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def first_byte_delay(self) -> float:
+        jitter = 0.0
+        if self.config.jitter_ms > 0:
+            with self.lock:
+                jitter = self.random.uniform(0, self.config.jitter_ms)
+        return (self.config.latency_ms + jitter) / 1000
+
+    def handle_error(self, request, client_address):
+        # 客户端在流中途断开（超时、熔断、进程退出）是压测中的正常情况，只计数不打印堆栈
+        self.count("client_disconnects")
+
+
+class MockDifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockDifyServer
+
+    def setup(self):
+        super().setup()
+        # 与真实部署(nginx/gunicorn)一致关闭Nagle，否则小的SSE分块会被延迟确认拖慢约40ms
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    # ---------- 响应辅助
+
+    def send_json(self, obj, status: int = 200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status: int, message: str):
+        self.server.count(f"error_{status}")
+        self.send_json({"code": "mock_error", "message": message, "status": status}, status)
+
+    def write_chunk(self, data: bytes):
+        # 分块传输编码，连接可以在流结束后复用
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def write_event(self, obj):
+        self.write_chunk(b"data: " + json.dumps(obj).encode() + b"\n\n")
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def pace(self, started: float, index: int):
+        """按--token-rate控制第index个事件的输出时间"""
+        rate = self.server.config.token_rate
+        if rate > 0:
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            return self.rfile.read(length)
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(parts)
+        return b""
+
+    # ---------- 路由
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/_stats"):
+            with self.server.lock:
+                return self.send_json(dict(self.server.stats))
+        self.server.count(path)
+        if path.endswith("/info"):
+            return self.send_json({"name": "Mock Dify", "description": "", "tags": [], "mode": "advanced-chat"})
+        if path.endswith("/parameters"):
+            return self.send_json({"user_input_form": [], "file_upload": {"image": {"enabled": True}}})
+        self.send_error_json(404, f"not found: {path}")
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self.read_body()
+        self.server.count(path)
+        config = self.server.config
+        if self.server.chance(config.error_rate):
+            time.sleep(self.server.first_byte_delay())
+            return self.send_error_json(config.error_status, "injected error")
+        if path.endswith("/files/upload"):
+            return self.handle_upload(body)
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            return self.send_error_json(400, "invalid json")
+        if path.endswith("/chat-messages") or path.endswith("/completion-messages"):
+            return self.handle_chat(request, chat=path.endswith("/chat-messages"))
+        if path.endswith("/workflows/run"):
+            return self.handle_workflow(request)
+        self.send_error_json(404, f"not found: {path}")
+
+    # ---------- 接口
+
+    def handle_upload(self, body: bytes):
+        time.sleep(self.server.config.upload_latency_ms / 1000)
+        self.send_json({
+            "id": str(uuid.uuid4()),
+            "name": "upload",
+            "size": len(body),
+            "extension": "bin",
+            "mime_type": "application/octet-stream",
+            "created_at": int(time.time()),
+        })
+
+    def handle_chat(self, request: dict, chat: bool):
+        config = self.server.config
+        conversation_id = request.get("conversation_id") or str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        token = "x" * max(config.token_bytes - 1, 0) + " "
+        time.sleep(self.server.first_byte_delay())
+        if request.get("response_mode") != "streaming":
+            answer = token * config.tokens
+            result = {"event": "message", "message_id": message_id, "answer": answer, "created_at": int(time.time())}
+            if chat:
+                result["conversation_id"] = conversation_id
+            return self.send_json(result)
+
+        fail_at = self.stream_failure_point()
+        self.start_stream()
+        self.write_chunk(b"event: ping\n\n")
+        started = time.perf_counter()
+        for i in range(config.tokens):
+            if i == fail_at:
+                self.write_event({"event": "error", "status": 500, "code": "mock_error", "message": "injected stream error"})
+                return self.end_stream()
+            self.pace(started, i)
+            self.write_event({"event": "message", "conversation_id": conversation_id, "message_id": message_id, "answer": token})
+        self.write_event({"event": "message_end", "conversation_id": conversation_id, "message_id": message_id, "metadata": {}})
+        self.end_stream()
+
+    def handle_workflow(self, request: dict):
+        config = self.server.config
+        run_id = str(uuid.uuid4())
+        token = "x" * max(config.token_bytes - 1, 0) + " "
+        outputs = {
+            "text": token * config.tokens,
+            "files": [
+                {"type": "image", "url": f"/files/{run_id}-{i}.png", "extension": ".png", "filename": f"{i}.png"}
+                for i in range(config.images)
+            ],
+        }
+        time.sleep(self.server.first_byte_delay())
+        if request.get("response_mode") != "streaming":
+            return self.send_json({"workflow_run_id": run_id, "task_id": run_id, "data": {
+                "id": run_id, "status": "succeeded", "outputs": outputs, "elapsed_time": 0.1,
+            }})
+
+        fail_at = self.stream_failure_point()
+        self.start_stream()
+        self.write_event({"event": "workflow_started", "workflow_run_id": run_id, "data": {"id": run_id}})
+        node_output = {"text": "n" * config.node_bytes}
+        # 文本事件平均分配到各节点之间
+        per_node = config.tokens // max(config.nodes, 1) if config.nodes else config.tokens
+        started = time.perf_counter()
+        index = 0
+        for node in range(max(config.nodes, 1)):
+            node_id = f"node-{node}"
+            node_started = time.perf_counter()
+            if config.nodes:
+                self.write_event({"event": "node_started", "workflow_run_id": run_id, "data": {
+                    "node_id": node_id, "node_type": "llm", "title": f"Node {node}", "index": node,
+                }})
+            if config.node_delay_ms > 0:
+                time.sleep(config.node_delay_ms / 1000)
+                # 文本事件的输出节奏从节点处理结束后继续
+                started += config.node_delay_ms / 1000
+            count = per_node if node < config.nodes - 1 else config.tokens - index
+            for _ in range(count):
+                if index == fail_at:
+                    self.write_event({"event": "error", "status": 500, "code": "mock_error", "message": "injected stream error"})
+                    return self.end_stream()
+                self.pace(started, index)
+                self.write_event({"event": "text_chunk", "workflow_run_id": run_id, "data": {"text": token}})
+                index += 1
+            if config.nodes:
+                self.write_event({"event": "node_finished", "workflow_run_id": run_id, "data": {
+                    "node_id": node_id, "node_type": "llm", "title": f"Node {node}", "index": node,
+                    "status": "succeeded", "elapsed_time": time.perf_counter() - node_started, "outputs": node_output,
+                }})
+        self.write_event({"event": "workflow_finished", "workflow_run_id": run_id, "data": {
+            "id": run_id, "status": "succeeded", "outputs": outputs, "elapsed_time": time.perf_counter() - started,
+        }})
+        self.end_stream()
+
+    def stream_failure_point(self):
+        """按--stream-error-rate决定本次流在第几个事件处出错，不出错时返回None"""
+        config = self.server.config
+        if not self.server.chance(config.stream_error_rate):
+            return None
+        with self.server.lock:
+            return self.server.random.randrange(max(config.tokens, 1))
+
+
+def start_server(config, host: str = "127.0.0.1", port: int = 0) -> MockDifyServer:
+    """在后台线程启动模拟服务，port为0时随机选择端口，通过server.server_address获取"""
+    server = MockDifyServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = build_parser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    server = MockDifyServer((args.host, args.port), args)
+    host, port = server.server_address[:2]
+    print(f"Mock Dify listening on http://{host}:{port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
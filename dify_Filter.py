@@ -7,10 +7,657 @@ version: 0.1
 description: 该流程用于DIFY的API接口，对openweb-ui用户上传的文件进行预处理。
 """
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
+from collections import deque
+import contextvars
 import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import types
+import hashlib
+import io
+import logging
+import socket
+import email.utils
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+# 进程内共享对象注册表
+# open-webui 把每个函数当作独立模块加载，dify_pipe、dify_Workflow 与 dify_Filter 借助 sys.modules 共享连接池、附件队列等资源
+_SHARED = sys.modules.setdefault("_dify_shared", types.ModuleType("_dify_shared")).__dict__
+_SHARED_LOCK = _SHARED.setdefault("lock", threading.RLock())
+
+
+def get_shared(name: str, factory):
+    """按名称获取进程内共享对象，不存在时用factory创建"""
+    with _SHARED_LOCK:
+        obj = _SHARED.get(name)
+        if obj is None:
+            obj = factory()
+            _SHARED[name] = obj
+        return obj
+
+
+# 共享对象的代码版本，加入注册表中对象的名称
+# 各文件可以单独安装、分别更新，open-webui 更新函数时也只重新加载该文件，注册表中的对象却是先创建它的文件中的类的实例；
+# 版本不同的文件各自创建实例，不会调用到旧实现。修改三个文件共有的代码或注册表中对象的类时加一（tests/test_shared_copies.py 会检查）
+SHARED_CODE_VERSION = 2
+
+
+# 结构化日志
+# 字段值在日志真正输出时才格式化：base64数据与API Key被脱敏，长字符串与长列表被截断，可调用对象被调用取值
+_SECRET_FIELD = re.compile(r"key|token|secret|password|authorization", re.IGNORECASE)
+_SECRET_TEXT = [
+    (re.compile(r"data:([\w.+/-]+);base64,[A-Za-z0-9+/=]{16,}"), lambda m: f"data:{m.group(1)};base64,<{len(m.group(0))} chars>"),
+    (re.compile(r"(Bearer\s+)[\w.-]+"), lambda m: f"{m.group(1)}***"),
+    (re.compile(r"\b(app|dataset)-[A-Za-z0-9]{8,}"), lambda m: f"{m.group(1)}-***"),
+]
+_LOG_MAX_ITEMS = 20
+_LOG_SAMPLED = contextvars.ContextVar("dify_log_sampled", default=True)
+
+
+def redact_text(text: str) -> str:
+    """把文本中的base64数据与API Key替换为占位符"""
+    for pattern, replace in _SECRET_TEXT:
+        text = pattern.sub(replace, text)
+    return text
+
+
+def shrink_for_log(value, max_chars: int):
+    """逐层脱敏并截断日志字段，避免格式化整个请求体"""
+    if callable(value):
+        value = value()
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value[:max_chars]).decode("utf-8", errors="replace") + (f"...<{len(value)} bytes>" if len(value) > max_chars else "")
+    if isinstance(value, str):
+        value = redact_text(value)
+        return value if len(value) <= max_chars else f"{value[:max_chars]}...<{len(value)} chars>"
+    if isinstance(value, dict):
+        return {
+            key: "***" if _SECRET_FIELD.search(str(key)) else shrink_for_log(item, max_chars)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        if len(value) > _LOG_MAX_ITEMS:
+            half = _LOG_MAX_ITEMS // 2
+            value = list(value[:half]) + [f"...<{len(value) - _LOG_MAX_ITEMS} items>"] + list(value[-half:])
+        return [shrink_for_log(item, max_chars) for item in value]
+    return value
+
+
+class _LogMessage:
+    """延迟格式化的日志消息：消息 + key=value 字段"""
+
+    __slots__ = ("msg", "fields", "max_chars")
+
+    def __init__(self, msg: str, fields: dict, max_chars: int):
+        self.msg = msg
+        self.fields = fields
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        field_chars = max(self.max_chars // 4, 64)
+        parts = [self.msg]
+        for key, value in self.fields.items():
+            value = "***" if _SECRET_FIELD.search(key) else shrink_for_log(value, field_chars)
+            parts.append(f"{key}={value}")
+        text = " ".join(parts)
+        return text if len(text) <= self.max_chars else f"{text[:self.max_chars]}...<{len(text)} chars>"
+
+
+class DifyLogger:
+    """
+    logging.Logger 的轻量包装，每个函数文件一个（dify.pipe、dify.workflow、dify.filter）
+
+    log.debug("消息", key=value) 中的字段只在该级别启用时才格式化；
+    begin_request() 按采样率决定本次请求的debug日志是否输出，warning及以上不采样
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+        self.max_chars = 2000
+        self.sample_rate = 1.0
+        self._configured = None
+
+    def configure(self, level: str = "INFO", max_chars: int = 2000, sample_rate: float = 1.0):
+        """按Valves设置级别、单条日志长度上限与debug日志采样率"""
+        config = (str(level).upper(), max_chars, sample_rate)
+        if config == self._configured:
+            return
+        level_no = logging.getLevelName(config[0])
+        self.logger.setLevel(level_no if isinstance(level_no, int) else logging.INFO)
+        self.max_chars = max(int(max_chars), 200)
+        self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+        # open-webui未配置日志处理器时输出到stderr
+        root = logging.getLogger()
+        parent = logging.getLogger("dify")
+        if not root.handlers and not parent.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+            parent.addHandler(handler)
+            parent.propagate = False
+        self._configured = config
+
+    def begin_request(self) -> bool:
+        """在请求开始时调用，决定本次请求（当前上下文）的debug日志是否输出"""
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        _LOG_SAMPLED.set(sampled)
+        return sampled
+
+    def enabled(self, level: int = logging.DEBUG) -> bool:
+        if not self.logger.isEnabledFor(level):
+            return False
+        return level > logging.DEBUG or _LOG_SAMPLED.get()
+
+    def _log(self, level: int, msg: str, fields: dict, exc_info=False):
+        if self.enabled(level):
+            self.logger.log(level, "%s", _LogMessage(msg, fields, self.max_chars), exc_info=exc_info)
+
+    def debug(self, msg: str, **fields):
+        self._log(logging.DEBUG, msg, fields)
+
+    def info(self, msg: str, **fields):
+        self._log(logging.INFO, msg, fields)
+
+    def warning(self, msg: str, **fields):
+        self._log(logging.WARNING, msg, fields)
+
+    def error(self, msg: str, exc_info=False, **fields):
+        self._log(logging.ERROR, msg, fields, exc_info)
+
+
+log = DifyLogger("dify.filter")
+
+
+class AttachmentQueue:
+    """
+    附件队列：Filter.inlet 按聊天（无chat_id时按用户）放入文件信息，Pipe 取出后上传
+
+    默认只在进程内存中传递，不产生文件读写；spill_path 非空时改为写入该SQLite文件，
+    用于 open-webui 多进程部署时在进程间传递。超过 ttl 秒未被取走的附件会被丢弃。
+    """
+
+    def __init__(self, ttl: float = 600, spill_path: str = ""):
+        self.ttl = ttl
+        self.spill_path = spill_path
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if spill_path:
+            os.makedirs(os.path.dirname(spill_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(spill_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS attachments ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_attachments_key ON attachments(key)")
+
+    def put(self, key: str, file_info: dict):
+        now = time.time()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM attachments WHERE created_at < ?", (now - self.ttl,))
+                self._conn.execute(
+                    "INSERT INTO attachments (key, payload, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(file_info, ensure_ascii=False), now),
+                )
+                return
+            # 顺带清理已过期的队列
+            for stale in [k for k, q in self._queues.items() if q[-1][0] < now - self.ttl]:
+                del self._queues[stale]
+            self._queues.setdefault(key, deque()).append((now, file_info))
+
+    def pop_all(self, key: str) -> List[dict]:
+        """取出该键下所有未过期的附件，按放入顺序返回"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            if self._conn is not None:
+                # BEGIN IMMEDIATE 保证多个进程不会取到同一批附件
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = self._conn.execute(
+                        "SELECT payload, created_at FROM attachments WHERE key = ? ORDER BY seq", (key,)
+                    ).fetchall()
+                    self._conn.execute("DELETE FROM attachments WHERE key = ?", (key,))
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                return [json.loads(payload) for payload, created_at in rows if created_at >= cutoff]
+            queue = self._queues.pop(key, None)
+        if not queue:
+            return []
+        return [file_info for created_at, file_info in queue if created_at >= cutoff]
+
+
+def get_attachment_queue(spill_path: str = "") -> AttachmentQueue:
+    """获取 Filter 与 Pipe 共用的附件队列，两边的 ATTACHMENT_SPILL_PATH 需保持一致"""
+    return get_shared(
+        f"attachment_queue@v{SHARED_CODE_VERSION}:{spill_path}", lambda: AttachmentQueue(spill_path=spill_path)
+    )
+
+
+
+class PreuploadRegistry:
+    """
+    Filter 后台预上传任务登记表：预上传键 -> concurrent.futures.Future（结果为Dify上传响应）
+
+    只在进程内有效，Pipe 取不到时回退为直接上传
+    """
+
+    def __init__(self, ttl: float = 600):
+        self.ttl = ttl
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def put(self, key: str, future):
+        now = time.time()
+        with self._lock:
+            for stale in [k for k, (created_at, _) in self._futures.items() if created_at < now - self.ttl]:
+                del self._futures[stale]
+            self._futures[key] = (now, future)
+
+    def pop(self, key: str):
+        with self._lock:
+            entry = self._futures.pop(key, None)
+        return entry[1] if entry is not None else None
+
+
+def get_preupload_registry() -> PreuploadRegistry:
+    return get_shared(f"preupload_registry@v{SHARED_CODE_VERSION}", PreuploadRegistry)
+
+
+def preupload_key(file_server: str, dify_key: str, user_id: str, file_name: str) -> str:
+    """上传文件ID只在同一Dify应用和用户下有效，预上传键包含上传地址与API Key摘要"""
+    app = hashlib.sha256(f"{file_server}|{dify_key}".encode("utf-8")).hexdigest()[:16]
+    return f"{app}:{user_id}:{file_name}"
+
+
+class MultipartFileStream(io.RawIOBase):
+    """
+    流式multipart/form-data请求体：若干文本字段 + 一个从磁盘按块读取的文件字段
+
+    实现了 __len__，requests 据此带上Content-Length并逐块读取发送，
+    不会像 files= 那样先把整个文件拼进内存中的请求体
+
+    Args:
+        fields: 文本字段，如 {"user": "xxx"}
+        file_field: 文件字段名
+        file_name: 上传时使用的文件名
+        file_path: 本地文件路径
+        content_type: 文件的Content-Type
+        progress: 进度回调 progress(已发送文件字节数, 文件总字节数)
+    """
+
+    def __init__(self, fields: dict, file_field: str, file_name: str, file_path: str,
+                 content_type: str = "application/octet-stream", progress=None):
+        self.boundary = os.urandom(16).hex()
+        head = "".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{self._quote(name)}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{self._quote(file_field)}"; '
+            f'filename="{self._quote(file_name)}"\r\nContent-Type: {content_type}\r\n\r\n'
+        )
+        self._head = head.encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._file = open(file_path, "rb")
+        self.file_size = os.fstat(self._file.fileno()).st_size
+        self._progress = progress
+        self.seek(0)
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        # 与urllib3一致的HTML5风格转义
+        return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self.file_size + len(self._tail)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # 只支持回到开头，用于失败后重发
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("MultipartFileStream只支持seek(0)")
+        self._file.seek(0)
+        self._position = 0
+        self._sent = 0
+        return 0
+
+    def readinto(self, b) -> int:
+        head_len = len(self._head)
+        if self._position < head_len:
+            data = self._head[self._position:self._position + len(b)]
+        elif self._position < head_len + self.file_size:
+            data = self._file.read(min(len(b), head_len + self.file_size - self._position))
+            self._sent += len(data)
+            if self._progress is not None and data:
+                self._progress(self._sent, self.file_size)
+        else:
+            start = self._position - head_len - self.file_size
+            data = self._tail[start:start + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._position += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class PooledSession:
+    """
+    带连接池的keep-alive HTTP会话，封装 requests.Session + HTTPAdapter
+
+    Args:
+        pool_connections: 缓存的主机连接池数量
+        pool_maxsize: 每个主机的最大连接数
+        pool_block: 连接数达到上限时是否阻塞等待空闲连接
+        keep_alive: 是否复用连接并开启TCP keepalive
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 20, pool_block: bool = False, keep_alive: bool = True):
+        self.keep_alive = keep_alive
+        self.session = requests.Session()
+        self.adapter = _KeepAliveAdapter(
+            keep_alive=keep_alive,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def stats(self) -> dict:
+        """统计连接复用情况：requests为请求数，connections为新建连接数"""
+        pools = self.adapter.poolmanager.pools
+        num_requests = 0
+        num_connections = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        reused = max(num_requests - num_connections, 0)
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "reused": reused,
+            "reuse_ratio": round(reused / num_requests, 4) if num_requests else 0.0,
+        }
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """开启TCP keepalive的HTTPAdapter"""
+
+    def __init__(self, keep_alive: bool = True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_http_session(valves) -> PooledSession:
+    """按连接池配置获取共享的HTTP会话，两个Pipe配置相同则共用同一个连接池"""
+    key = (
+        f"http_session@v{SHARED_CODE_VERSION}"
+        f":{valves.POOL_CONNECTIONS}:{valves.POOL_MAXSIZE}:{valves.POOL_BLOCK}:{valves.KEEP_ALIVE}"
+    )
+    return get_shared(
+        key,
+        lambda: PooledSession(
+            pool_connections=valves.POOL_CONNECTIONS,
+            pool_maxsize=valves.POOL_MAXSIZE,
+            pool_block=valves.POOL_BLOCK,
+            keep_alive=valves.KEEP_ALIVE,
+        ),
+    )
+
+
+class RetryPolicy:
+    """
+    Dify调用的重试策略：指数退避 + 全抖动，遵循Retry-After
+
+    只用于可安全重发的阶段：文件上传、阻塞调用、流式响应收到首字节之前。
+    重试连接失败（含连接超时、连接被重置）和 statuses 中的HTTP状态码；读超时不重试，避免重复执行
+
+    Args:
+        attempts: 最多尝试次数（含首次），<=1 表示不重试
+        base_delay: 首次重试的退避基数(秒)
+        max_delay: 单次等待的上限(秒)，Retry-After 也不超过该值
+        statuses: 需要重试的HTTP状态码
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10, statuses=(429, 502, 503, 504)):
+        self.attempts = max(int(attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = frozenset(statuses)
+
+    @classmethod
+    def from_valves(cls, valves) -> "RetryPolicy":
+        statuses = [int(s) for s in re.split(r"[,\s]+", valves.RETRY_STATUSES) if s.strip().isdigit()]
+        return cls(valves.RETRY_ATTEMPTS, valves.RETRY_BASE_DELAY, valves.RETRY_MAX_DELAY, statuses)
+
+    @staticmethod
+    def parse_retry_after(value) -> Optional[float]:
+        """解析Retry-After头（秒数或HTTP日期），无法解析时返回None"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def delay(self, attempt: int, retry_after=None) -> float:
+        """第attempt次重试（从0开始）前的等待时间"""
+        seconds = self.parse_retry_after(retry_after)
+        if seconds is None:
+            seconds = random.uniform(0, self.base_delay * (2 ** attempt))
+        return min(seconds, self.max_delay)
+
+    def call(self, send, what: str = "request", breaker=None):
+        """
+        执行 send() 并按策略重试，send 每次都要重新发出请求（文件体需先回到开头）
+
+        Args:
+            breaker: 可选的 CircuitBreaker，每次尝试前检查并记录结果
+
+        Returns:
+            requests.Response: 最后一次的响应，状态码仍可能是可重试的错误码
+        """
+        for attempt in range(self.attempts):
+            last = attempt == self.attempts - 1
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                if breaker is not None:
+                    breaker.record_failure()
+                if last or not isinstance(e, requests.exceptions.ConnectionError):
+                    raise
+                reason, wait = repr(e), self.delay(attempt)
+            else:
+                if breaker is not None:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if last or response.status_code not in self.statuses:
+                    return response
+                reason = f"HTTP {response.status_code}"
+                wait = self.delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+            log.warning(f"{what} 失败，{wait:.2f}秒后第{attempt + 1}次重试", reason=reason)
+            time.sleep(wait)
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开期间直接拒绝请求"""
+
+
+class CircuitBreaker:
+    """
+    Dify服务熔断器
+
+    连续失败（连接失败、超时、5xx）failure_threshold 次后打开，打开期间请求直接失败；
+    reset_timeout 秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+
+    Args:
+        name: 名称（服务地址），用于提示信息
+        failure_threshold: 打开熔断所需的连续失败次数，<=0 表示禁用
+        reset_timeout: 打开后多久允许探测(秒)
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """发出请求前调用，熔断打开时抛出 CircuitOpenError"""
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN and now - self._probe_at >= self.reset_timeout:
+                # 探测请求迟迟没有结果，再放行一个
+                pass
+            else:
+                self.rejected += 1
+                wait = max(self._opened_at + self.reset_timeout - now, 0)
+                raise CircuitOpenError(
+                    f"Dify服务 {self.name} 暂时不可用（连续失败{self.failures}次，已熔断），请约{wait:.0f}秒后再试"
+                )
+            self._probe_at = now
+
+    def available(self) -> bool:
+        """当前是否可以放行请求（不改变状态），用于负载均衡时剔除熔断中的后端"""
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self._opened_at >= self.reset_timeout
+        return now - self._probe_at >= self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    log.warning(f"Dify服务 {self.name} 熔断打开，连续失败{self.failures}次")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(self._opened_at + self.reset_timeout - time.monotonic(), 0.0)
+            return {
+                "name": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in": round(retry_in, 1),
+            }
+
+
+def get_circuit_breaker(valves, url: str) -> CircuitBreaker:
+    """按服务地址(host)获取共享的熔断器，同一Dify服务的各Pipe共用熔断状态"""
+    host = urlparse(url).netloc or url
+    return get_shared(
+        f"circuit_breaker@v{SHARED_CODE_VERSION}:{host}:{valves.CIRCUIT_FAILURE_THRESHOLD}:{valves.CIRCUIT_RESET_TIMEOUT}",
+        lambda: CircuitBreaker(host, valves.CIRCUIT_FAILURE_THRESHOLD, valves.CIRCUIT_RESET_TIMEOUT),
+    )
+
+
+def preupload_file(valves, user_id: str, file_name: str) -> dict:
+    """后台任务：从本地uploads目录读取文件并上传到DIFY服务器，返回服务器响应；连接池、重试与熔断按Valves与Pipe共用"""
+    local_file_path = os.path.join('data/uploads', file_name)
+    http = get_http_session(valves)
+    with MultipartFileStream({'user': user_id}, 'file', file_name, local_file_path) as body:
+        headers = {"Authorization": f"Bearer {valves.DIFY_KEY}", "Content-Type": body.content_type}
+
+        def send():
+            # 重试时从头重发文件
+            body.seek(0)
+            return http.post(valves.FILE_SERVER, headers=headers, data=body, timeout=(5, 30))
+
+        response = RetryPolicy.from_valves(valves).call(
+            send, f"预上传 {file_name}", get_circuit_breaker(valves, valves.FILE_SERVER)
+        )
+    response.raise_for_status()
+    result = response.json()
+    if not all(field in result for field in ('id', 'name')):
+        raise ValueError(f"服务器响应格式无效: {result}")
+    log.debug("预上传成功", result=result)
+    return result
 
-DEBUG_MODE = True
 
 class Filter:
     class Valves(BaseModel):
@@ -20,6 +667,39 @@ class Filter:
         max_turns: int = Field(
             default=8, description="Maximum allowable conversation turns for a user."
         )
+        MAX_FILE_SIZE_MB: float = Field(
+            default=15, description="交给Dify的单个文件大小上限(MB)，超过的文件会被跳过；应不超过Dify的上传限制，0表示不限制"
+        )
+        ATTACHMENT_SPILL_PATH: str = Field(
+            default="", description="附件队列的SQLite文件路径，多进程部署时设置，需与Pipe一致；为空则只在进程内传递"
+        )
+        MODEL_PREFIXES: str = Field(
+            default="",
+            description="只为ID以这些前缀开头的模型排队附件，逗号分隔，如 difyapitest. 表示该Pipe的全部Dify应用；"
+            "为空时处理所有挂载本Filter的模型。只有挂载了本Filter的模型才会收到附件，"
+            "非Dify模型的附件无人取走，10分钟后过期丢弃",
+        )
+        # 预上传：与Pipe的DIFY_KEY、FILE_SERVER一致时，Pipe直接使用预上传结果
+        PREUPLOAD: bool = Field(
+            default=True, description="收到文件后立即在后台上传到Dify，需配置DIFY_KEY与FILE_SERVER"
+        )
+        DIFY_KEY: str = Field(default="", description="与Pipe相同的Dify应用API Key；预上传只使用这一个Key，其他Key或地址的应用由Pipe直接上传")
+        FILE_SERVER: str = Field(default="", description="与Pipe相同的Dify文件上传地址")
+        # 预上传的连接池、重试与熔断，与Pipe的配置相同时共用同一个连接池与熔断状态
+        POOL_CONNECTIONS: int = Field(default=10, description="缓存的主机连接池数量")
+        POOL_MAXSIZE: int = Field(default=20, description="每个主机的最大连接数")
+        POOL_BLOCK: bool = Field(default=False, description="连接数达到上限时是否阻塞等待")
+        KEEP_ALIVE: bool = Field(default=True, description="是否复用HTTP连接并开启TCP keepalive")
+        RETRY_ATTEMPTS: int = Field(default=3, description="预上传的最多尝试次数（含首次），1表示不重试")
+        RETRY_BASE_DELAY: float = Field(default=0.5, description="指数退避的基数(秒)，第n次重试前随机等待0~基数*2^n秒")
+        RETRY_MAX_DELAY: float = Field(default=10, description="单次重试等待的上限(秒)，Retry-After也不超过该值")
+        RETRY_STATUSES: str = Field(default="429,502,503,504", description="需要重试的HTTP状态码，逗号分隔")
+        CIRCUIT_FAILURE_THRESHOLD: int = Field(default=5, description="连续失败多少次后熔断，熔断期间预上传直接失败、由Pipe上传，0表示禁用")
+        CIRCUIT_RESET_TIMEOUT: float = Field(default=30, description="熔断后多久(秒)放行一个探测请求")
+        # 日志
+        LOG_LEVEL: str = Field(default="INFO", description="本函数的日志级别：DEBUG、INFO、WARNING 或 ERROR；DEBUG时输出请求体等调试信息")
+        LOG_MAX_CHARS: int = Field(default=2000, description="单条日志的最大字符数，base64数据与API Key总是被脱敏")
+        LOG_SAMPLE_RATE: float = Field(default=1.0, description="DEBUG日志按请求的采样率(0~1)，高并发时降低以减少日志量")
         pass
 
     class UserValves(BaseModel):
@@ -30,30 +710,34 @@ class Filter:
         #self.file_handler = True 
         self.valves = self.Valves()
         pass
-    def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
+    def _configure_logging(self):
+        """按Valves设置本函数的日志级别、长度上限与采样率"""
+        log.configure(self.valves.LOG_LEVEL, self.valves.LOG_MAX_CHARS, self.valves.LOG_SAMPLE_RATE)
 
-        if DEBUG_MODE:
-            print(f"inlet:{__name__}")
-            print(f"inlet:body:{body}")
-            print(f"inlet:user:{__user__}")        
-        if body.get('model') != "difyapitest.dify_id":
+    def inlet(self, body: dict, __user__: Optional[dict] = None, __metadata__: Optional[dict] = None) -> dict:
+        self._configure_logging()
+        log.begin_request()
+        log.debug("inlet", body=body, user=__user__)
+        if not self._handles_model(body.get("model") or ""):
             return body
         if "files" not in body:
             return body
         
         #因上传的数据openwebui已经向量化
-        #曲线救国传递文件信息，可以修改用其他方法   
+        #通过进程内附件队列把文件信息交给Pipe，按聊天区分，每个文件都会保留
         #实际目前上传文档Dify API只需要文件id和用户两个值即可 
+        metadata = __metadata__ or body.get("metadata") or {}
+        chat_id = metadata.get("chat_id")
+        attachment_queue = get_attachment_queue(self.valves.ATTACHMENT_SPILL_PATH)
         for file_info in body['files']:    
             if file_info['type'] != 'file':
                 continue
-            print(f"file_info:{file_info}")
-            # 检查文件大小（15MB = 15 * 1024 * 1024 bytes）
-            MAX_FILE_SIZE = 15 * 1024 * 1024
+            # 检查文件大小（上限由MAX_FILE_SIZE_MB配置）
+            max_file_size = self.valves.MAX_FILE_SIZE_MB * 1024 * 1024
             file_size = file_info.get('size', 0) 
-            print(f"file_size:{file_size}")
-            if file_size > MAX_FILE_SIZE:
-                print(f"跳过大文件: {file_info['name']}, 大小: {file_size/1024/1024:.2f}MB")
+            log.debug("收到文件", file_info=file_info, file_size=file_size)
+            if max_file_size > 0 and file_size > max_file_size:
+                log.info(f"跳过大文件: {file_info['name']}, 大小: {file_size/1024/1024:.2f}MB")
                 continue
             dify_file = {
                 # "content": file_info['file']['data']['content'],  
@@ -64,21 +748,41 @@ class Filter:
                 "size": file_info['file']['meta']['size'],
                 #"collection_name": file_info['collection_name'],
                 "url": file_info['url'],
-                "flag":True,
             }
+            # 没有chat_id时按用户放入队列，Pipe会同时检查两者
+            key = chat_id or f"user:{dify_file['user_id']}"
             try:
-                with open('data/dify/dify_file_data.json', 'w', encoding='utf-8') as f:
-                    json.dump(dify_file, f, ensure_ascii=False)
+                attachment_queue.put(key, dify_file)
             except Exception as e:
-                print(f"写入文件时出错: {str(e)}")
+                log.error(f"写入附件队列时出错: {str(e)}")
+            self._start_preupload(dify_file)
         return body
 
+    def _handles_model(self, model: str) -> bool:
+        """MODEL_PREFIXES为空时处理所有模型，否则只处理ID以其中某个前缀开头的模型"""
+        prefixes = [prefix for prefix in re.split(r"[,\s]+", self.valves.MODEL_PREFIXES) if prefix]
+        return not prefixes or any(model.startswith(prefix) for prefix in prefixes)
+
+    def _start_preupload(self, dify_file: dict):
+        """在后台线程中提前上传文件，Pipe 按相同的预上传键等待结果"""
+        if not (self.valves.PREUPLOAD and self.valves.DIFY_KEY and self.valves.FILE_SERVER):
+            return
+        file_name = f"{dify_file['id']}_{dify_file['name']}"
+        executor = get_shared(
+            "preupload_executor", lambda: ThreadPoolExecutor(max_workers=4, thread_name_prefix="dify-preupload")
+        )
+        try:
+            future = executor.submit(preupload_file, self.valves, dify_file["user_id"], file_name)
+        except Exception as e:
+            log.error(f"启动预上传失败: {str(e)}")
+            return
+        key = preupload_key(self.valves.FILE_SERVER, self.valves.DIFY_KEY, dify_file["user_id"], file_name)
+        get_preupload_registry().put(key, future)
+
     def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # Modify or analyze the response body after processing by the API.
         # This function is the post-processor for the API, which can be used to modify the response
         # or perform additional checks and analytics.
-        if DEBUG_MODE:
-            print(f"outlet:{__name__}")
-            print(f"outlet:body:{body}")
-            print(f"outlet:user:{user}")
+        self._configure_logging()
+        log.debug("outlet", body=body, user=user)
         return body
@@ -8,26 +8,1765 @@ version: 0.1
 description: 该流程用于DIFY的API接口，用以对接Dify的工作流
 """
 
+import asyncio
+import contextvars
+import copy
 import logging
 import os
+import re
+import socket
+import sys
+import threading
+import types
 import requests
 import json
+import random
 import time
-from typing import List, Union, Generator, Iterator, Optional
+import email.utils
+from typing import Collection, List, Union, Generator, Iterator, Optional, AsyncGenerator
 from pydantic import BaseModel, Field
 from open_webui.utils.misc import pop_system_message
 from open_webui.config import UPLOAD_DIR
 import base64
-import tempfile
-from urllib.parse import quote
+import bisect
+import io
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import quote, urlparse
 from io import BytesIO
-#Debug模式
-DEBUG_MODE = True
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 
 def get_file_extension(file_name: str) -> str:
     return os.path.splitext(file_name)[1].strip(".")
 
 
+# 进程内共享对象注册表
+# open-webui 把每个函数当作独立模块加载，dify_pipe、dify_Workflow 与 dify_Filter 借助 sys.modules 共享连接池、附件队列等资源
+_SHARED = sys.modules.setdefault("_dify_shared", types.ModuleType("_dify_shared")).__dict__
+_SHARED_LOCK = _SHARED.setdefault("lock", threading.RLock())
+
+
+def get_shared(name: str, factory):
+    """按名称获取进程内共享对象，不存在时用factory创建"""
+    with _SHARED_LOCK:
+        obj = _SHARED.get(name)
+        if obj is None:
+            obj = factory()
+            _SHARED[name] = obj
+        return obj
+
+
+# 共享对象的代码版本，加入注册表中对象的名称
+# 各文件可以单独安装、分别更新，open-webui 更新函数时也只重新加载该文件，注册表中的对象却是先创建它的文件中的类的实例；
+# 版本不同的文件各自创建实例，不会调用到旧实现。修改三个文件共有的代码或注册表中对象的类时加一（tests/test_shared_copies.py 会检查）
+SHARED_CODE_VERSION = 2
+
+
+# 结构化日志
+# 字段值在日志真正输出时才格式化：base64数据与API Key被脱敏，长字符串与长列表被截断，可调用对象被调用取值
+_SECRET_FIELD = re.compile(r"key|token|secret|password|authorization", re.IGNORECASE)
+_SECRET_TEXT = [
+    (re.compile(r"data:([\w.+/-]+);base64,[A-Za-z0-9+/=]{16,}"), lambda m: f"data:{m.group(1)};base64,<{len(m.group(0))} chars>"),
+    (re.compile(r"(Bearer\s+)[\w.-]+"), lambda m: f"{m.group(1)}***"),
+    (re.compile(r"\b(app|dataset)-[A-Za-z0-9]{8,}"), lambda m: f"{m.group(1)}-***"),
+]
+_LOG_MAX_ITEMS = 20
+_LOG_SAMPLED = contextvars.ContextVar("dify_log_sampled", default=True)
+
+
+def redact_text(text: str) -> str:
+    """把文本中的base64数据与API Key替换为占位符"""
+    for pattern, replace in _SECRET_TEXT:
+        text = pattern.sub(replace, text)
+    return text
+
+
+def shrink_for_log(value, max_chars: int):
+    """逐层脱敏并截断日志字段，避免格式化整个请求体"""
+    if callable(value):
+        value = value()
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value[:max_chars]).decode("utf-8", errors="replace") + (f"...<{len(value)} bytes>" if len(value) > max_chars else "")
+    if isinstance(value, str):
+        value = redact_text(value)
+        return value if len(value) <= max_chars else f"{value[:max_chars]}...<{len(value)} chars>"
+    if isinstance(value, dict):
+        return {
+            key: "***" if _SECRET_FIELD.search(str(key)) else shrink_for_log(item, max_chars)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        if len(value) > _LOG_MAX_ITEMS:
+            half = _LOG_MAX_ITEMS // 2
+            value = list(value[:half]) + [f"...<{len(value) - _LOG_MAX_ITEMS} items>"] + list(value[-half:])
+        return [shrink_for_log(item, max_chars) for item in value]
+    return value
+
+
+class _LogMessage:
+    """延迟格式化的日志消息：消息 + key=value 字段"""
+
+    __slots__ = ("msg", "fields", "max_chars")
+
+    def __init__(self, msg: str, fields: dict, max_chars: int):
+        self.msg = msg
+        self.fields = fields
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        field_chars = max(self.max_chars // 4, 64)
+        parts = [self.msg]
+        for key, value in self.fields.items():
+            value = "***" if _SECRET_FIELD.search(key) else shrink_for_log(value, field_chars)
+            parts.append(f"{key}={value}")
+        text = " ".join(parts)
+        return text if len(text) <= self.max_chars else f"{text[:self.max_chars]}...<{len(text)} chars>"
+
+
+class DifyLogger:
+    """
+    logging.Logger 的轻量包装，每个函数文件一个（dify.pipe、dify.workflow、dify.filter）
+
+    log.debug("消息", key=value) 中的字段只在该级别启用时才格式化；
+    begin_request() 按采样率决定本次请求的debug日志是否输出，warning及以上不采样
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+        self.max_chars = 2000
+        self.sample_rate = 1.0
+        self._configured = None
+
+    def configure(self, level: str = "INFO", max_chars: int = 2000, sample_rate: float = 1.0):
+        """按Valves设置级别、单条日志长度上限与debug日志采样率"""
+        config = (str(level).upper(), max_chars, sample_rate)
+        if config == self._configured:
+            return
+        level_no = logging.getLevelName(config[0])
+        self.logger.setLevel(level_no if isinstance(level_no, int) else logging.INFO)
+        self.max_chars = max(int(max_chars), 200)
+        self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+        # open-webui未配置日志处理器时输出到stderr
+        root = logging.getLogger()
+        parent = logging.getLogger("dify")
+        if not root.handlers and not parent.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+            parent.addHandler(handler)
+            parent.propagate = False
+        self._configured = config
+
+    def begin_request(self) -> bool:
+        """在请求开始时调用，决定本次请求（当前上下文）的debug日志是否输出"""
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        _LOG_SAMPLED.set(sampled)
+        return sampled
+
+    def enabled(self, level: int = logging.DEBUG) -> bool:
+        if not self.logger.isEnabledFor(level):
+            return False
+        return level > logging.DEBUG or _LOG_SAMPLED.get()
+
+    def _log(self, level: int, msg: str, fields: dict, exc_info=False):
+        if self.enabled(level):
+            self.logger.log(level, "%s", _LogMessage(msg, fields, self.max_chars), exc_info=exc_info)
+
+    def debug(self, msg: str, **fields):
+        self._log(logging.DEBUG, msg, fields)
+
+    def info(self, msg: str, **fields):
+        self._log(logging.INFO, msg, fields)
+
+    def warning(self, msg: str, **fields):
+        self._log(logging.WARNING, msg, fields)
+
+    def error(self, msg: str, exc_info=False, **fields):
+        self._log(logging.ERROR, msg, fields, exc_info)
+
+
+log = DifyLogger("dify.workflow")
+
+
+class PooledSession:
+    """
+    带连接池的keep-alive HTTP会话，封装 requests.Session + HTTPAdapter
+
+    Args:
+        pool_connections: 缓存的主机连接池数量
+        pool_maxsize: 每个主机的最大连接数
+        pool_block: 连接数达到上限时是否阻塞等待空闲连接
+        keep_alive: 是否复用连接并开启TCP keepalive
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 20, pool_block: bool = False, keep_alive: bool = True):
+        self.keep_alive = keep_alive
+        self.session = requests.Session()
+        self.adapter = _KeepAliveAdapter(
+            keep_alive=keep_alive,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def stats(self) -> dict:
+        """统计连接复用情况：requests为请求数，connections为新建连接数"""
+        pools = self.adapter.poolmanager.pools
+        num_requests = 0
+        num_connections = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        reused = max(num_requests - num_connections, 0)
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "reused": reused,
+            "reuse_ratio": round(reused / num_requests, 4) if num_requests else 0.0,
+        }
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """开启TCP keepalive的HTTPAdapter"""
+
+    def __init__(self, keep_alive: bool = True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_http_session(valves) -> PooledSession:
+    """按连接池配置获取共享的HTTP会话，两个Pipe配置相同则共用同一个连接池"""
+    key = (
+        f"http_session@v{SHARED_CODE_VERSION}"
+        f":{valves.POOL_CONNECTIONS}:{valves.POOL_MAXSIZE}:{valves.POOL_BLOCK}:{valves.KEEP_ALIVE}"
+    )
+    return get_shared(
+        key,
+        lambda: PooledSession(
+            pool_connections=valves.POOL_CONNECTIONS,
+            pool_maxsize=valves.POOL_MAXSIZE,
+            pool_block=valves.POOL_BLOCK,
+            keep_alive=valves.KEEP_ALIVE,
+        ),
+    )
+
+
+class RetryPolicy:
+    """
+    Dify调用的重试策略：指数退避 + 全抖动，遵循Retry-After
+
+    只用于可安全重发的阶段：文件上传、阻塞调用、流式响应收到首字节之前。
+    重试连接失败（含连接超时、连接被重置）和 statuses 中的HTTP状态码；读超时不重试，避免重复执行
+
+    Args:
+        attempts: 最多尝试次数（含首次），<=1 表示不重试
+        base_delay: 首次重试的退避基数(秒)
+        max_delay: 单次等待的上限(秒)，Retry-After 也不超过该值
+        statuses: 需要重试的HTTP状态码
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10, statuses=(429, 502, 503, 504)):
+        self.attempts = max(int(attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = frozenset(statuses)
+
+    @classmethod
+    def from_valves(cls, valves) -> "RetryPolicy":
+        statuses = [int(s) for s in re.split(r"[,\s]+", valves.RETRY_STATUSES) if s.strip().isdigit()]
+        return cls(valves.RETRY_ATTEMPTS, valves.RETRY_BASE_DELAY, valves.RETRY_MAX_DELAY, statuses)
+
+    @staticmethod
+    def parse_retry_after(value) -> Optional[float]:
+        """解析Retry-After头（秒数或HTTP日期），无法解析时返回None"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def delay(self, attempt: int, retry_after=None) -> float:
+        """第attempt次重试（从0开始）前的等待时间"""
+        seconds = self.parse_retry_after(retry_after)
+        if seconds is None:
+            seconds = random.uniform(0, self.base_delay * (2 ** attempt))
+        return min(seconds, self.max_delay)
+
+    def call(self, send, what: str = "request", breaker=None):
+        """
+        执行 send() 并按策略重试，send 每次都要重新发出请求（文件体需先回到开头）
+
+        Args:
+            breaker: 可选的 CircuitBreaker，每次尝试前检查并记录结果
+
+        Returns:
+            requests.Response: 最后一次的响应，状态码仍可能是可重试的错误码
+        """
+        for attempt in range(self.attempts):
+            last = attempt == self.attempts - 1
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                if breaker is not None:
+                    breaker.record_failure()
+                if last or not isinstance(e, requests.exceptions.ConnectionError):
+                    raise
+                reason, wait = repr(e), self.delay(attempt)
+            else:
+                if breaker is not None:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if last or response.status_code not in self.statuses:
+                    return response
+                reason = f"HTTP {response.status_code}"
+                wait = self.delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+            log.warning(f"{what} 失败，{wait:.2f}秒后第{attempt + 1}次重试", reason=reason)
+            time.sleep(wait)
+
+class CircuitOpenError(Exception):
+    """熔断器打开期间直接拒绝请求"""
+
+
+class CircuitBreaker:
+    """
+    Dify服务熔断器
+
+    连续失败（连接失败、超时、5xx）failure_threshold 次后打开，打开期间请求直接失败；
+    reset_timeout 秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+
+    Args:
+        name: 名称（服务地址），用于提示信息
+        failure_threshold: 打开熔断所需的连续失败次数，<=0 表示禁用
+        reset_timeout: 打开后多久允许探测(秒)
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """发出请求前调用，熔断打开时抛出 CircuitOpenError"""
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN and now - self._probe_at >= self.reset_timeout:
+                # 探测请求迟迟没有结果，再放行一个
+                pass
+            else:
+                self.rejected += 1
+                wait = max(self._opened_at + self.reset_timeout - now, 0)
+                raise CircuitOpenError(
+                    f"Dify服务 {self.name} 暂时不可用（连续失败{self.failures}次，已熔断），请约{wait:.0f}秒后再试"
+                )
+            self._probe_at = now
+
+    def available(self) -> bool:
+        """当前是否可以放行请求（不改变状态），用于负载均衡时剔除熔断中的后端"""
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self._opened_at >= self.reset_timeout
+        return now - self._probe_at >= self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    log.warning(f"Dify服务 {self.name} 熔断打开，连续失败{self.failures}次")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(self._opened_at + self.reset_timeout - time.monotonic(), 0.0)
+            return {
+                "name": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in": round(retry_in, 1),
+            }
+
+
+def get_circuit_breaker(valves, url: str) -> CircuitBreaker:
+    """按服务地址(host)获取共享的熔断器，同一Dify服务的各Pipe共用熔断状态"""
+    host = urlparse(url).netloc or url
+    return get_shared(
+        f"circuit_breaker@v{SHARED_CODE_VERSION}:{host}:{valves.CIRCUIT_FAILURE_THRESHOLD}:{valves.CIRCUIT_RESET_TIMEOUT}",
+        lambda: CircuitBreaker(host, valves.CIRCUIT_FAILURE_THRESHOLD, valves.CIRCUIT_RESET_TIMEOUT),
+    )
+
+
+class DifyBackend:
+    """
+    一个Dify API后端（服务地址 + API Key）及其负载统计
+
+    上传文件ID与会话ID只在同一后端内有效，id 由地址和Key计算，配置调整顺序后保持不变
+    """
+
+    def __init__(self, base_url: str, key: str, weight: float = 1, file_server: str = ""):
+        self.base_url = base_url.rstrip("/")
+        self.key = key
+        self.weight = max(float(weight), 0.01)
+        self.file_server = file_server or f"{self.base_url}/files/upload"
+        self.id = hashlib.sha256(f"{self.base_url}|{key}".encode("utf-8")).hexdigest()[:16]
+        self.in_flight = 0
+        self.requests = 0
+        self.ewma_ms = None
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "ewma_ms": round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+        }
+
+
+def parse_backends(valves) -> List[DifyBackend]:
+    """
+    解析DIFY_BACKENDS：每行（或用分号分隔）一个后端，格式为 地址|API Key|权重，
+    Key省略时使用DIFY_KEY，权重省略时为1；未配置时只使用DIFY_BASE_URL与DIFY_KEY
+    """
+    backends = []
+    for line in re.split(r"[;\n]+", valves.DIFY_BACKENDS):
+        parts = [part.strip() for part in line.split("|")]
+        if not parts[0]:
+            continue
+        key = parts[1] if len(parts) > 1 and parts[1] else valves.DIFY_KEY
+        weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1
+        backends.append(DifyBackend(parts[0], key, weight))
+    if not backends:
+        backends.append(DifyBackend(valves.DIFY_BASE_URL, valves.DIFY_KEY, 1, valves.FILE_SERVER))
+    return backends
+
+
+class BackendBalancer:
+    """
+    在多个Dify后端之间分配请求
+
+    Args:
+        backends: 后端列表
+        strategy: round_robin（平滑加权轮询）、least_in_flight（按权重的最少进行中请求）
+            或 ewma（按首字节延迟的指数加权平均 × 进行中请求数）
+        ewma_alpha: EWMA的平滑系数
+    """
+
+    STRATEGIES = ("round_robin", "least_in_flight", "ewma")
+
+    def __init__(self, backends: List[DifyBackend], strategy: str = "round_robin", ewma_alpha: float = 0.3):
+        self.backends = backends
+        self.strategy = strategy if strategy in self.STRATEGIES else "round_robin"
+        self.ewma_alpha = ewma_alpha
+        self._by_id = {backend.id: backend for backend in backends}
+        self._current = {backend.id: 0.0 for backend in backends}
+        self._lock = threading.Lock()
+
+    def get(self, backend_id: str) -> Optional[DifyBackend]:
+        return self._by_id.get(backend_id)
+
+    def choose(self, available=None) -> DifyBackend:
+        """
+        选择一个后端，available(backend) 为False的后端（熔断中）被剔除；
+        全部不可用时仍在全体中选择，由熔断器给出明确的错误
+        """
+        candidates = [b for b in self.backends if available is None or available(b)] or self.backends
+        with self._lock:
+            if self.strategy == "least_in_flight":
+                return min(candidates, key=lambda b: ((b.in_flight + 1) / b.weight, b.requests / b.weight))
+            if self.strategy == "ewma":
+                # 还没有延迟数据的后端优先，以便尽快得到统计
+                return min(candidates, key=lambda b: (b.ewma_ms or 0.0) * (b.in_flight + 1) / b.weight)
+            total = sum(b.weight for b in candidates)
+            for b in candidates:
+                self._current[b.id] += b.weight
+            best = max(candidates, key=lambda b: self._current[b.id])
+            self._current[best.id] -= total
+            return best
+
+    def begin(self, backend: DifyBackend):
+        with self._lock:
+            backend.in_flight += 1
+            backend.requests += 1
+
+    def end(self, backend: DifyBackend):
+        with self._lock:
+            backend.in_flight = max(backend.in_flight - 1, 0)
+
+    def observe(self, backend: DifyBackend, latency_ms: float):
+        """记录一次首字节延迟"""
+        with self._lock:
+            if backend.ewma_ms is None:
+                backend.ewma_ms = latency_ms
+            else:
+                backend.ewma_ms += self.ewma_alpha * (latency_ms - backend.ewma_ms)
+
+    def stats(self) -> dict:
+        return {"strategy": self.strategy, "backends": [backend.stats() for backend in self.backends]}
+
+
+def get_balancer(backends: List[DifyBackend], strategy: str) -> BackendBalancer:
+    """按后端列表与策略获取共享的负载均衡器，负载统计在同配置的Pipe间共享"""
+    config = "|".join(f"{b.id}:{b.weight}:{b.file_server}" for b in backends)
+    key = f"backend_balancer@v{SHARED_CODE_VERSION}:{hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]}:{strategy}"
+    return get_shared(key, lambda: BackendBalancer(backends, strategy))
+
+
+def get_backend_balancer(valves) -> BackendBalancer:
+    """按Valves中的后端配置获取共享的负载均衡器"""
+    return get_balancer(parse_backends(valves), valves.LB_STRATEGY)
+
+# 指标定义：名称 -> (说明, 桶上界)；耗时单位为秒，大小单位为字节
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1KiB ~ 256MiB
+METRIC_DEFINITIONS = {
+    "dify_ttfb_seconds": ("从发出请求到收到Dify响应头的耗时", _LATENCY_BUCKETS),
+    "dify_ttft_seconds": ("从Pipe收到请求到向open-webui输出第一段文本的耗时", _LATENCY_BUCKETS),
+    "dify_stream_duration_seconds": ("Dify流式响应的总耗时", _LATENCY_BUCKETS),
+    "dify_stream_events": ("每个流式响应收到的SSE事件数", (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)),
+    "dify_stream_bytes": ("每个流式响应收到的字节数", _SIZE_BUCKETS),
+    "dify_upload_seconds": ("上传单个文件到Dify的耗时", _LATENCY_BUCKETS),
+    "dify_upload_bytes": ("上传到Dify的单个文件大小", _SIZE_BUCKETS),
+    "dify_save_state_seconds": ("save_state持久化聊天状态的耗时", _LATENCY_BUCKETS),
+    "dify_workflow_node_seconds": ("工作流单个节点的耗时，按节点标题与状态分组", _LATENCY_BUCKETS),
+}
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in items) + "}"
+
+
+class Histogram:
+    """Prometheus风格的直方图，按标签分组累计各桶的次数、总和与总次数"""
+
+    def __init__(self, name: str, description: str, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: dict):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        """Prometheus文本格式"""
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(key, le=bound)} {cumulative}")
+            lines.append(f'{self.name}_bucket{_format_labels(key, le="+Inf")} {count}')
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+    def stats(self) -> dict:
+        """各标签组合的次数与平均值"""
+        with self._lock:
+            return {
+                ",".join(f"{name}={value}" for name, value in key): {"count": count, "avg": round(total / count, 4)}
+                for key, (_, total, count) in self._series.items()
+                if count
+            }
+
+
+class Metrics:
+    """
+    进程内的指标注册表，dify_pipe 与 dify_Workflow 的 SHARED_CODE_VERSION 相同时两者共享
+
+    observe 记录到直方图并转发给已注册的sink：sink(name, value, labels)，
+    可用于对接StatsD、OpenTelemetry等；render 输出Prometheus文本格式
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._sinks = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    description, buckets = METRIC_DEFINITIONS[name]
+                    histogram = self._histograms[name] = Histogram(name, description, buckets)
+        return histogram
+
+    def observe(self, name: str, value: float, labels: Optional[dict] = None):
+        labels = labels or {}
+        self.histogram(name).observe(value, labels)
+        for sink in self._sinks:
+            try:
+                sink(name, value, labels)
+            except Exception as e:
+                log.error(f"指标sink出错: {e}")
+
+    def add_sink(self, sink):
+        with self._lock:
+            self._sinks = self._sinks + [sink]
+
+    def remove_sink(self, sink):
+        with self._lock:
+            self._sinks = [s for s in self._sinks if s is not sink]
+
+    def _sorted(self) -> List[Histogram]:
+        with self._lock:
+            return [self._histograms[name] for name in sorted(self._histograms)]
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._sorted():
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> dict:
+        return {histogram.name: histogram.stats() for histogram in self._sorted()}
+
+
+def get_metrics() -> Metrics:
+    """进程内共享的指标注册表"""
+    return get_shared(f"metrics@v{SHARED_CODE_VERSION}", Metrics)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host: str, port: int):
+    """
+    在后台线程中提供 http://host:port/metrics，同一地址在进程内只启动一次；端口被占用时返回False
+
+    两个函数的 SHARED_CODE_VERSION 不同时各用一个注册表，该地址只输出先启动服务的文件中的指标
+    """
+
+    def create():
+        try:
+            server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            log.error(f"指标服务启动失败 {host}:{port}: {e}")
+            return False
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="dify-metrics", daemon=True).start()
+        return server
+
+    return get_shared(f"metrics_server:{host}:{port}", create) is not False
+
+
+class SSEEvent:
+    """
+    单个SSE事件
+
+    event 优先取 event: 字段，否则从 data 开头窥探Dify的 "event" 键，不解析整个JSON；
+    data 在首次访问时才执行 json.loads，不需要的事件（如 node_finished）不会被解码
+    """
+
+    __slots__ = ("event", "id", "raw", "_data")
+
+    _EVENT_PEEK = re.compile(rb'"event"\s*:\s*"([^"]+)"')
+    _UNSET = object()
+
+    def __init__(self, event: Optional[str], raw: bytes, id: Optional[str] = None):
+        self.raw = raw
+        self.id = id
+        self._data = self._UNSET
+        if event is None and raw:
+            match = self._EVENT_PEEK.search(raw, 0, 64)
+            if match is not None:
+                event = match.group(1).decode("utf-8")
+            else:
+                event = self.data.get("event") if isinstance(self.data, dict) else None
+        self.event = event
+
+    @property
+    def data(self):
+        """解析后的JSON数据，解析失败抛出 json.JSONDecodeError"""
+        if self._data is self._UNSET:
+            self._data = json.loads(self.raw.decode("utf-8")) if self.raw else None
+        return self._data
+
+
+class SSEParser:
+    """
+    增量SSE解析器，按任意大小的字节块喂入，支持多行 data:、event:、id: 字段和注释行
+
+    Dify 的 ping 事件（event: ping，无data）会作为 event="ping" 的事件返回
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._data_lines = []
+        self._event = None
+        self._last_id = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """喂入一个字节块，返回其中已完整接收的事件"""
+        if b"\n" not in chunk:
+            # 未结束的长行（如体积很大的node_finished）先暂存，避免反复拼接和扫描
+            self._pending.append(chunk)
+            return []
+        if self._pending:
+            self._pending.append(chunk)
+            chunk = b"".join(self._pending)
+        lines = chunk.split(b"\n")
+        last = lines.pop()
+        self._pending = [last] if last else []
+        events = []
+        for line in lines:
+            event = self._process_line(line[:-1] if line.endswith(b"\r") else line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self) -> List[SSEEvent]:
+        """流结束时处理剩余未以空行结尾的事件"""
+        events = []
+        if self._pending:
+            line = b"".join(self._pending)
+            self._pending = []
+            event = self._process_line(line[:-1] if line.endswith(b"\r") else line)
+            if event is not None:
+                events.append(event)
+        event = self._process_line(b"")
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line.startswith(b"data: "):
+            self._data_lines.append(line[6:])
+            return None
+        if line[0:1] == b":":
+            # 注释行
+            return None
+        field, sep, value = line.partition(b":")
+        if sep and value[0:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self._data_lines.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8")
+        elif field == b"id":
+            self._last_id = value.decode("utf-8")
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data_lines and self._event is None:
+            return None
+        data_lines = self._data_lines
+        raw = data_lines[0] if len(data_lines) == 1 else b"\n".join(data_lines)
+        event = SSEEvent(self._event, raw, self._last_id)
+        self._data_lines = []
+        self._event = None
+        return event
+
+
+# 图片魔数 -> (MIME类型, 扩展名)
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png", "png"),
+    (b"\xff\xd8\xff", "image/jpeg", "jpg"),
+    (b"GIF87a", "image/gif", "gif"),
+    (b"GIF89a", "image/gif", "gif"),
+]
+
+
+def sniff_image_type(head: bytes, default: str = "image/png"):
+    """根据文件头的魔数判断图片类型，返回 (MIME类型, 扩展名)"""
+    for signature, mime_type, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type, extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    stripped = head.lstrip()
+    if stripped.startswith(b"<svg") or stripped.startswith(b"<?xml"):
+        return "image/svg+xml", "svg"
+    return default, default.rsplit("/", 1)[-1].split("+", 1)[0]
+
+
+class Base64Reader(io.RawIOBase):
+    """
+    按块解码base64字符串（可带data URL前缀）的只读文件对象
+
+    不复制整个base64字符串，也不生成完整的解码副本，每次只解码一块；
+    允许换行等空白（如按76字符折行的base64），每块去掉空白后补齐到4个有效字符的整数倍再解码
+    """
+
+    def __init__(self, data: str, chunk_chars: int = 256 * 1024):
+        self._data = data
+        self._start = data.index(",") + 1 if data.startswith("data:") else 0
+        self._chunk_chars = max(chunk_chars - chunk_chars % 4, 4)
+        self.declared_type = data[5:data.index(";")] if data.startswith("data:") and ";" in data[:self._start] else None
+        self.seek(0)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # 只支持回到开头，用于重复读取（先计算哈希再上传）
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Base64Reader只支持seek(0)")
+        self._pos = self._start
+        self._buffer = b""
+        self._offset = 0
+        self._position = 0
+        return 0
+
+    def readinto(self, b) -> int:
+        while self._offset >= len(self._buffer):
+            if self._pos >= len(self._data):
+                return 0
+            chunk = self._data[self._pos:self._pos + self._chunk_chars]
+            self._pos += len(chunk)
+            # 空白不计入base64的4字符分组，去掉后向后补齐，保证每块在分组边界上结束
+            chunk = "".join(chunk.split())
+            while len(chunk) % 4 and self._pos < len(self._data):
+                char = self._data[self._pos]
+                self._pos += 1
+                if not char.isspace():
+                    chunk += char
+            self._buffer = base64.b64decode(chunk)
+            self._offset = 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        self._position += n
+        return n
+
+    def decoded_size(self) -> int:
+        """解码后的字节数（按base64长度和填充计算，不解码），数据中有空白时为上限"""
+        data = self._data.rstrip()
+        length = len(data) - self._start
+        padding = len(data) - len(data.rstrip("="))
+        return length * 3 // 4 - padding
+
+    def read_all(self) -> bytearray:
+        """一次性读出全部内容到预分配的缓冲区，只产生一份解码副本"""
+        self.seek(0)
+        buffer = bytearray(self.decoded_size())
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(buffer):
+            n = self.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        del view
+        if filled < len(buffer):
+            del buffer[filled:]
+        return buffer
+
+    def digest(self):
+        """流式计算解码后内容的SHA-256和文件头，返回 (sha256, 前32字节)，完成后回到开头"""
+        sha256 = hashlib.sha256()
+        head = b""
+        self.seek(0)
+        while True:
+            chunk = self.read(self._chunk_chars)
+            if not chunk:
+                break
+            if len(head) < 32:
+                head += chunk[:32 - len(head)]
+            sha256.update(chunk)
+        self.seek(0)
+        return sha256.hexdigest(), head
+
+
+class UploadCache:
+    """
+    按内容寻址的上传缓存：内容SHA-256 + Dify用户 -> Dify返回的上传结果
+
+    Args:
+        max_size: 最多缓存的条目数(LRU)，<=0 表示禁用
+        ttl: 条目有效期(秒)，应与Dify的文件保留时间一致
+    """
+
+    def __init__(self, max_size: int = 512, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def get_upload_cache(valves) -> UploadCache:
+    """获取进程内共享的上传缓存，两个Pipe配置相同则共用"""
+    return get_shared(
+        f"upload_cache@v{SHARED_CODE_VERSION}:{valves.UPLOAD_CACHE_SIZE}:{valves.UPLOAD_CACHE_TTL}",
+        lambda: UploadCache(valves.UPLOAD_CACHE_SIZE, valves.UPLOAD_CACHE_TTL),
+    )
+
+
+def upload_cache_key(backend: "DifyBackend", digest: str, user_id: str) -> str:
+    """上传文件ID只在同一Dify后端（地址与API Key）和用户下有效，缓存键包含后端与用户"""
+    return f"{backend.id}:{user_id}:{digest}"
+
+
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """分块计算文件的SHA-256，不把整个文件读入内存"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MultipartFileStream(io.RawIOBase):
+    """
+    流式multipart/form-data请求体：若干文本字段 + 一个从磁盘按块读取的文件字段
+
+    实现了 __len__，requests 据此带上Content-Length并逐块读取发送，
+    不会像 files= 那样先把整个文件拼进内存中的请求体
+
+    Args:
+        fields: 文本字段，如 {"user": "xxx"}
+        file_field: 文件字段名
+        file_name: 上传时使用的文件名
+        file_path: 本地文件路径
+        content_type: 文件的Content-Type
+        progress: 进度回调 progress(已发送文件字节数, 文件总字节数)
+    """
+
+    def __init__(self, fields: dict, file_field: str, file_name: str, file_path: str,
+                 content_type: str = "application/octet-stream", progress=None):
+        self.boundary = os.urandom(16).hex()
+        head = "".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{self._quote(name)}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{self._quote(file_field)}"; '
+            f'filename="{self._quote(file_name)}"\r\nContent-Type: {content_type}\r\n\r\n'
+        )
+        self._head = head.encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._file = open(file_path, "rb")
+        self.file_size = os.fstat(self._file.fileno()).st_size
+        self._progress = progress
+        self.seek(0)
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        # 与urllib3一致的HTML5风格转义
+        return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self.file_size + len(self._tail)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # 只支持回到开头，用于失败后重发
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("MultipartFileStream只支持seek(0)")
+        self._file.seek(0)
+        self._position = 0
+        self._sent = 0
+        return 0
+
+    def readinto(self, b) -> int:
+        head_len = len(self._head)
+        if self._position < head_len:
+            data = self._head[self._position:self._position + len(b)]
+        elif self._position < head_len + self.file_size:
+            data = self._file.read(min(len(b), head_len + self.file_size - self._position))
+            self._sent += len(data)
+            if self._progress is not None and data:
+                self._progress(self._sent, self.file_size)
+        else:
+            start = self._position - head_len - self.file_size
+            data = self._tail[start:start + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._position += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def run_concurrently(calls: list, limit: int) -> list:
+    """
+    用线程池并发执行无参调用，按调用顺序返回结果，异常作为结果返回而不抛出
+
+    Args:
+        calls: 无参可调用对象列表
+        limit: 最大并发数
+    """
+    def call(func):
+        try:
+            return func()
+        except Exception as e:
+            return e
+
+    if len(calls) <= 1 or limit <= 1:
+        return [call(func) for func in calls]
+    # 每个任务复制当前上下文，工作线程沿用本请求的日志采样结果
+    tasks = [partial(contextvars.copy_context().run, call, func) for func in calls]
+    with ThreadPoolExecutor(max_workers=min(limit, len(calls))) as executor:
+        return list(executor.map(lambda task: task(), tasks))
+
+
+async def iterate_in_thread(iterator) -> AsyncGenerator:
+    """
+    把阻塞的同步迭代器转换为异步生成器，每一项都在工作线程中读取
+
+    open-webui 在事件循环线程中直接遍历同步迭代器，阻塞读取期间事件循环无法运行，
+    从工作线程提交的状态事件要等到下一段内容输出后才会发出
+    """
+    done = object()
+    try:
+        while True:
+            item = await asyncio.to_thread(next, iterator, done)
+            if item is done:
+                break
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+
+def iter_sse_events(chunks, events=None):
+    """把响应字节块迭代器转换为SSE事件迭代器，给定events时只返回这些类型的事件"""
+    parser = SSEParser()
+    for chunk in chunks:
+        for sse in parser.feed(chunk):
+            if events is None or sse.event in events:
+                yield sse
+    for sse in parser.close():
+        if events is None or sse.event in events:
+            yield sse
+
+
+# 流式响应中需要解码处理的事件，workflow_started、node_*、ping等事件不解码直接跳过
+STREAM_EVENTS = {"text_chunk", "workflow_finished", "tts_message", "tts_message_end", "error"}
+# 显示进度或记录节点耗时时额外解码的事件
+PROGRESS_EVENTS = {"workflow_started", "node_started", "node_finished"}
+
+
+class WorkflowProgress:
+    """
+    工作流进度：把workflow_started与node_*事件以status事件发给open-webui，并记录每个节点的耗时
+
+    流式响应在工作线程中处理，状态通过 run_coroutine_threadsafe 提交到open-webui的事件循环。
+    两次状态之间至少间隔 interval 秒，期间的更新只保留最新一条并在到期后补发，
+    因此长时间运行的节点（如ComfyUI出图）总会显示在状态栏上。
+    event_emitter或loop为None时只记录耗时
+    """
+
+    def __init__(self, event_emitter, loop, started: float, interval: float = 1.0,
+                 metrics: Optional[Metrics] = None, labels: Optional[dict] = None):
+        self.event_emitter = event_emitter if loop is not None else None
+        self.loop = loop
+        self.started = started
+        self.interval = max(interval, 0)
+        self.metrics = metrics
+        self.labels = labels or {}
+        self.nodes = {}    # node_id -> (标题, 开始时间)
+        self.timings = []  # (标题, 耗时秒数, 状态)
+        self._lock = threading.Lock()
+        self._last = float("-inf")
+        self._pending = None
+        self._flush_scheduled = False
+        self._closed = False
+
+    @staticmethod
+    def _title(node: dict) -> str:
+        return node.get("title") or node.get("node_type") or node.get("node_id") or "节点"
+
+    def handle(self, event: str, data: dict):
+        """处理一个workflow_started/node_started/node_finished事件"""
+        node = data.get("data") or {}
+        now = time.perf_counter()
+        if event == "workflow_started":
+            self.update(f"工作流已开始 · 已用时 {now - self.started:.1f}s")
+        elif event == "node_started":
+            title = self._title(node)
+            self.nodes[node.get("node_id") or node.get("id")] = (title, now)
+            self.update(f"正在运行：{title} · 已用时 {now - self.started:.1f}s")
+        elif event == "node_finished":
+            title, start = self.nodes.pop(node.get("node_id") or node.get("id"), (self._title(node), now))
+            # 优先使用Dify给出的节点耗时(秒)，缺失时用收到node_started到node_finished的间隔
+            seconds = node.get("elapsed_time")
+            if not isinstance(seconds, (int, float)):
+                seconds = now - start
+            status = node.get("status") or "succeeded"
+            self.timings.append((title, seconds, status))
+            if self.metrics is not None:
+                self.metrics.observe("dify_workflow_node_seconds", seconds, {**self.labels, "node": title, "status": status})
+            result = "完成" if status == "succeeded" else "失败"
+            self.update(f"{title} {result}，用时 {seconds:.1f}s · 已用时 {now - self.started:.1f}s")
+
+    def update(self, description: str):
+        """发送进行中的状态，间隔不足interval时推迟到期后发送最新的一条"""
+        if self.event_emitter is None:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            now = time.perf_counter()
+            wait = self._last + self.interval - now
+            if wait <= 0:
+                self._last = now
+                self._pending = None
+            else:
+                self._pending = description
+                if self._flush_scheduled:
+                    return
+                self._flush_scheduled = True
+                description = None
+        if description is None:
+            self.loop.call_soon_threadsafe(self.loop.call_later, wait, self._flush)
+        else:
+            self._send(description, False)
+
+    def _flush(self):
+        # 在事件循环线程中执行
+        with self._lock:
+            self._flush_scheduled = False
+            description, self._pending = self._pending, None
+            if description is None or self._closed:
+                return
+            self._last = time.perf_counter()
+        self.loop.create_task(self.event_emitter({"type": "status", "data": {"description": description, "done": False}}))
+
+    def _send(self, description: str, done: bool):
+        asyncio.run_coroutine_threadsafe(
+            self.event_emitter({"type": "status", "data": {"description": description, "done": done}}), self.loop
+        )
+
+    def finish(self, succeeded: bool = True):
+        """工作流结束：发送带总耗时与最慢节点的最终状态，之后不再发送进度"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._pending = None
+        total = time.perf_counter() - self.started
+        log.debug(
+            "工作流节点耗时",
+            total=round(total, 3),
+            nodes=[{"node": title, "seconds": round(seconds, 3), "status": status} for title, seconds, status in self.timings],
+        )
+        if self.event_emitter is None:
+            return
+        description = f"工作流{'完成' if succeeded else '失败'}，总用时 {total:.1f}s"
+        if self.timings:
+            title, seconds, _ = max(self.timings, key=lambda timing: timing[1])
+            description += f"（最慢：{title} {seconds:.1f}s）"
+        self._send(description, True)
+
+    def close(self):
+        """响应被中断时停止发送进度"""
+        with self._lock:
+            self._closed = True
+            self._pending = None
+
+
+def _call_once(func):
+    """把一次调用包装为只产生一个结果的迭代器，阻塞模式的合并与流式共用WorkflowFlight"""
+    yield func()
+
+
+class WorkflowFlight:
+    """
+    一次进行中的上游工作流运行
+
+    后台线程读取上游的事件并全部缓存，每个订阅者都从第一个事件开始重放，
+    因此运行中途加入的请求也能得到完整输出。上游出错时，错误在每个订阅者读完缓存后抛出
+    """
+
+    def __init__(self, key: str, owner: Optional["DifyClient"]):
+        self.key = key
+        self.owner = owner  # 发起上游请求的后端的客户端，图片地址相对于该后端
+        self.items = []
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def run(self, source, on_done):
+        try:
+            for item in source:
+                with self._cond:
+                    self.items.append(item)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            on_done(self)
+
+    def subscribe(self, events: Optional[set] = None):
+        """按顺序返回缓存的与后续到达的事件，给定events时只返回这些类型的SSE事件"""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.items) and not self.done:
+                    self._cond.wait()
+                batch = self.items[index:]
+                index += len(batch)
+                finished = self.done and index >= len(self.items)
+            for item in batch:
+                if events is None or item.event in events:
+                    yield item
+            if finished:
+                break
+        if self.error is not None:
+            # 每个订阅者抛出各自的副本，避免多个线程同时改写同一个异常的traceback
+            raise copy.copy(self.error) from self.error
+
+
+class SingleFlight:
+    """
+    单飞：key相同的工作流运行同时进行时只向Dify发起一次请求，结果分发给所有等待者
+
+    运行结束后即从表中移除，之后相同的请求会重新运行，不缓存结果
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def join(self, key: str, source, owner: Optional["DifyClient"] = None) -> WorkflowFlight:
+        """
+        加入key对应的进行中的运行，不存在时在后台线程中开始新的运行
+
+        Args:
+            key: 运行的规范化哈希
+            source: 无参可调用对象，返回上游的事件迭代器，只在开始新运行时调用
+            owner: 开始新运行时发起请求的客户端
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight
+            flight = self._flights[key] = WorkflowFlight(key, owner)
+            self.started += 1
+        # 上游运行不依赖任何一个订阅者，发起请求的用户断开后其余用户仍能收到结果
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=context.run, args=(flight.run, source(), self._finish), name="dify-workflow-flight", daemon=True,
+        ).start()
+        return flight
+
+    def _finish(self, flight: WorkflowFlight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "started": self.started, "coalesced": self.coalesced}
+
+
+def get_single_flight() -> SingleFlight:
+    """获取进程内共享的工作流单飞表"""
+    return get_shared(f"workflow_single_flight@v{SHARED_CODE_VERSION}", SingleFlight)
+
+
+class WorkflowResultCache:
+    """
+    工作流结果缓存：运行的规范化哈希 -> 成功运行的outputs（文本与补全为绝对地址的文件）
+
+    内存中按条目数与字节数做LRU淘汰，条目超过ttl失效；给定disk_dir时同时写入磁盘，
+    内存未命中时读取磁盘，进程重启后或多个进程之间仍可命中
+
+    Args:
+        max_entries: 最多缓存的条目数，<=0 表示禁用；磁盘上的条目数同样受此限制
+        max_bytes: 内存中条目的总字节数上限（按JSON计算），超过上限的单个结果不缓存
+        ttl: 条目有效期(秒)
+        disk_dir: 磁盘缓存目录，为空时只缓存在内存中
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 16 * 1024 * 1024, ttl: float = 300, disk_dir: str = ""):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (写入时间, 字节数, outputs)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        if self.max_entries <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                self._remove(key)
+        # 磁盘读取在锁外进行
+        data = self._read_disk(key, now)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            entry = json.loads(data)
+            self._store(key, entry["created"], len(data), entry["outputs"])
+            return entry["outputs"]
+
+    def put(self, key: str, outputs: dict):
+        if self.max_entries <= 0:
+            return
+        created = time.time()
+        data = json.dumps({"created": created, "outputs": outputs}, ensure_ascii=False)
+        with self._lock:
+            self._store(key, created, len(data), outputs)
+        self._write_disk(key, data, created)
+
+    def _store(self, key: str, created: float, size: int, outputs: dict):
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (created, size, outputs)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str, now: float) -> Optional[str]:
+        """读取未过期的磁盘条目，返回JSON文本"""
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = f.read()
+            if now - json.loads(data)["created"] < self.ttl:
+                return data
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    def _write_disk(self, key: str, data: str, now: float):
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # 先写临时文件再替换，其他进程不会读到写了一半的条目
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._prune_disk(now)
+        except OSError as e:
+            log.warning(f"写入工作流结果缓存失败: {e}")
+
+    def _prune_disk(self, now: float):
+        """删除过期的磁盘条目，条目数超过上限时删除最早写入的"""
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+                if now - mtime >= self.ttl:
+                    os.remove(entry.path)
+                else:
+                    files.append((mtime, entry.path))
+            except OSError:
+                continue
+        files.sort()
+        for _, path in files[:max(len(files) - self.max_entries, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.disk_hits) / total, 4) if total else 0.0,
+        }
+
+
+def get_result_cache(valves) -> WorkflowResultCache:
+    """获取应用的工作流结果缓存，每个应用(DIFY_MODLE_ID)与配置一份"""
+    return get_shared(
+        f"workflow_result_cache@v{SHARED_CODE_VERSION}:{valves.DIFY_MODLE_ID}:{valves.WORKFLOW_CACHE_SIZE}:{valves.WORKFLOW_CACHE_MAX_MB}"
+        f":{valves.WORKFLOW_CACHE_TTL}:{valves.WORKFLOW_CACHE_DIR}",
+        lambda: WorkflowResultCache(
+            valves.WORKFLOW_CACHE_SIZE,
+            int(valves.WORKFLOW_CACHE_MAX_MB * 1024 * 1024),
+            valves.WORKFLOW_CACHE_TTL,
+            valves.WORKFLOW_CACHE_DIR,
+        ),
+    )
+
+
+class DifyClient:
+    """
+    单个Dify后端的API客户端
+
+    统一构建地址与请求头，经共享连接池发送请求，负责重试、熔断、首字节延迟统计、SSE解析与文件上传；
+    dify_pipe 与 dify_Workflow 中的副本保持一致（tests/test_shared_copies.py 会检查），Pipe只负责open-webui消息与Dify载荷之间的转换；
+    客户端本身不放入 _dify_shared，每次请求用本文件的类创建。注册表中的连接池、熔断器等对象是先创建它的文件中的类的实例，
+    名称带有 SHARED_CODE_VERSION，两个函数单独更新后版本不同时各自创建实例，不会调用到旧实现
+
+    Args:
+        backend: 请求发往的后端
+        http: 共享的连接池会话
+        retry: 重试策略
+        breaker: breaker(url) -> CircuitBreaker
+        balancer: 记录首字节延迟的负载均衡器，为None时不记录
+        timeout: 接口请求的 (连接超时, 读取超时)
+        upload_timeout: 文件上传的 (连接超时, 读取超时)
+        metrics: 记录耗时、流量与上传指标的注册表，为None时不记录
+        labels: 指标的标签，如 {"app": 模型ID}
+    """
+
+    def __init__(self, backend: DifyBackend, http: PooledSession, retry: RetryPolicy, breaker,
+                 balancer: Optional[BackendBalancer] = None, timeout=(3.05, 60), upload_timeout=(5, 30),
+                 metrics: Optional[Metrics] = None, labels: Optional[dict] = None):
+        self.backend = backend
+        self.http = http
+        self.retry = retry
+        self.breaker = breaker
+        self.balancer = balancer
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.metrics = metrics
+        self.labels = labels or {}
+
+    def url(self, path: str) -> str:
+        return f"{self.backend.base_url}/{path.lstrip('/')}"
+
+    def headers(self, content_type: Optional[str] = "application/json") -> dict:
+        headers = {"Authorization": f"Bearer {self.backend.key}"}
+        if content_type:
+            headers["content-type"] = content_type
+        return headers
+
+    def file_url(self, url: str) -> str:
+        """Dify返回的相对文件地址补全为后端的地址（去掉末尾的 /v1）"""
+        if url.startswith("/"):
+            return f"{re.sub(r'/v1$', '', self.backend.base_url)}{url}"
+        return url
+
+    def observe(self, start: float):
+        """记录首字节延迟，供ewma策略与指标使用"""
+        elapsed = time.perf_counter() - start
+        if self.balancer is not None:
+            self.balancer.observe(self.backend, elapsed * 1000)
+        if self.metrics is not None:
+            self.metrics.observe("dify_ttfb_seconds", elapsed, self.labels)
+
+    def record_stream(self, start: float, events: int, size: int):
+        """记录一次流式响应的总耗时、事件数与字节数"""
+        if self.metrics is not None:
+            self.metrics.observe("dify_stream_duration_seconds", time.perf_counter() - start, self.labels)
+            self.metrics.observe("dify_stream_events", events, self.labels)
+            self.metrics.observe("dify_stream_bytes", size, self.labels)
+
+    def record_upload(self, start: float, size: int):
+        if self.metrics is not None:
+            self.metrics.observe("dify_upload_seconds", time.perf_counter() - start, self.labels)
+            self.metrics.observe("dify_upload_bytes", size, self.labels)
+
+    def post(self, path: str, payload: dict, stream: bool = False) -> requests.Response:
+        """POST JSON载荷并返回响应；流式请求只在收到响应头之前重试，开始输出后不再重发"""
+        url = self.url(path)
+        headers = self.headers()
+        start = time.perf_counter()
+        response = self.retry.call(
+            lambda: self.http.post(url, headers=headers, json=payload, stream=stream, timeout=self.timeout),
+            url,
+            self.breaker(url),
+        )
+        self.observe(start)
+        return response
+
+    def post_json(self, path: str, payload: dict) -> dict:
+        """阻塞模式调用，返回解析后的JSON"""
+        response = self.post(path, payload)
+        if response.status_code != 200:
+            raise Exception(f"HTTP Error {response.status_code}: {response.text}")
+        return response.json()
+
+    def get_json(self, path: str) -> dict:
+        url = self.url(path)
+        headers = self.headers(None)
+        response = self.retry.call(
+            lambda: self.http.get(url, headers=headers, timeout=self.timeout), url, self.breaker(url)
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def stream_events(self, path: str, payload: dict, events=None) -> Iterator[SSEEvent]:
+        """流式调用，逐个产出SSE事件；events为需要解码的事件名集合，其余事件只计数"""
+        start = time.perf_counter()
+        response = self.post(path, payload, stream=True)
+        counts = [0, 0]
+
+        def chunks():
+            for chunk in response.iter_content(chunk_size=None):
+                counts[1] += len(chunk)
+                yield chunk
+
+        with response:
+            if response.status_code != 200:
+                raise Exception(f"HTTP Error {response.status_code}: {response.text}")
+            try:
+                for sse in iter_sse_events(chunks()):
+                    counts[0] += 1
+                    if events is None or sse.event in events:
+                        yield sse
+            finally:
+                self.record_stream(start, *counts)
+
+    def upload(self, user_id: str, file_name: str, file, mime_type: str) -> dict:
+        """
+        以multipart/form-data上传内存中的数据或文件对象，返回服务器响应
+
+        Args:
+            file: bytes/bytearray 或可读的文件对象，重试时从头重发
+        """
+        files = {
+            "file": (file_name, file, mime_type),
+            "user": (None, user_id),
+        }
+
+        def send():
+            if hasattr(file, "seek"):
+                file.seek(0)
+            return self.http.post(self.backend.file_server, headers=self.headers(None), files=files, timeout=self.upload_timeout)
+
+        start = time.perf_counter()
+        result = self._upload_result(self.retry.call(send, f"上传 {file_name}", self.breaker(self.backend.file_server)))
+        self.record_upload(start, self.size_of(file))
+        return result
+
+    def upload_path(self, user_id: str, file_path: str, file_name: Optional[str] = None,
+                    mime_type: str = "application/octet-stream", progress=None) -> dict:
+        """
+        上传本地文件，文件内容按块从磁盘读取发送，不整体读入内存
+
+        Args:
+            file_name: 上传时使用的文件名，默认为本地文件名
+            progress: 进度回调 progress(已发送字节数, 文件总字节数)
+        """
+        file_name = file_name or os.path.basename(file_path)
+        with MultipartFileStream({"user": user_id}, "file", file_name, file_path, mime_type, progress) as body:
+            headers = self.headers(body.content_type)
+
+            def send():
+                # 重试时从头重发文件
+                body.seek(0)
+                return self.http.post(self.backend.file_server, headers=headers, data=body, timeout=self.upload_timeout)
+
+            start = time.perf_counter()
+            result = self._upload_result(self.retry.call(send, f"上传 {file_name}", self.breaker(self.backend.file_server)))
+            self.record_upload(start, body.file_size)
+            return result
+
+    @staticmethod
+    def size_of(file) -> int:
+        """内存数据或文件对象的字节数，无法确定时为0"""
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            return len(file)
+        try:
+            return os.fstat(file.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return 0
+
+    @staticmethod
+    def _upload_result(response: requests.Response) -> dict:
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            error_msg = f"HTTP错误: {response.status_code}"
+            if response.headers.get("content-type") == "application/json":
+                error_msg += f" - {response.json().get('message', '')}"
+            log.error(error_msg)
+            raise
+        result = response.json()
+        if "id" not in result:
+            raise ValueError(f"服务器响应格式无效: {result}")
+        return result
+
+
+
 class Pipe:
     class Valves(BaseModel):
         # 环境变量
@@ -36,6 +1775,49 @@ class Pipe:
         FILE_SERVER: str = Field(default="http://192.168.1.5/v1/files/upload")
         DIFY_WORKFLOW: str = Field(default="Dify_Flux_schnell")
         DIFY_MODLE_ID: str = Field(default="dify_t2i")
+        # 多后端负载均衡
+        DIFY_BACKENDS: str = Field(
+            default="",
+            description="多个Dify后端，每行或用分号分隔一个，格式：地址|API Key|权重（Key与权重可省略）；为空时只使用DIFY_BASE_URL",
+        )
+        LB_STRATEGY: str = Field(default="round_robin", description="负载均衡策略：round_robin、least_in_flight 或 ewma")
+        # 连接池
+        POOL_CONNECTIONS: int = Field(default=10, description="缓存的主机连接池数量")
+        POOL_MAXSIZE: int = Field(default=20, description="每个主机的最大连接数")
+        POOL_BLOCK: bool = Field(default=False, description="连接数达到上限时是否阻塞等待")
+        KEEP_ALIVE: bool = Field(default=True, description="是否复用HTTP连接并开启TCP keepalive")
+        # 上传
+        UPLOAD_CONCURRENCY: int = Field(default=4, description="同一轮对话中并发上传附件的数量上限")
+        # 上传缓存
+        UPLOAD_CACHE_SIZE: int = Field(default=512, description="按内容哈希缓存的上传文件ID数量上限，0表示禁用")
+        UPLOAD_CACHE_TTL: int = Field(default=3600, description="上传缓存有效期(秒)，应与Dify文件保留时间一致")
+        # 重试
+        RETRY_ATTEMPTS: int = Field(default=3, description="上传、阻塞调用及流式首字节前的最多尝试次数（含首次），1表示不重试")
+        RETRY_BASE_DELAY: float = Field(default=0.5, description="指数退避的基数(秒)，第n次重试前随机等待0~基数*2^n秒")
+        RETRY_MAX_DELAY: float = Field(default=10, description="单次重试等待的上限(秒)，Retry-After也不超过该值")
+        RETRY_STATUSES: str = Field(default="429,502,503,504", description="需要重试的HTTP状态码，逗号分隔")
+        # 熔断
+        CIRCUIT_FAILURE_THRESHOLD: int = Field(default=5, description="连续失败多少次后熔断，熔断期间请求直接失败，0表示禁用")
+        CIRCUIT_RESET_TIMEOUT: float = Field(default=30, description="熔断后多久(秒)放行一个探测请求")
+        # 工作流进度
+        WORKFLOW_PROGRESS: bool = Field(default=True, description="流式运行时通过状态栏显示当前节点、已用时间与各节点耗时")
+        PROGRESS_INTERVAL: float = Field(default=1.0, description="两次进度状态之间的最短间隔(秒)")
+        # 请求合并
+        WORKFLOW_COALESCE: bool = Field(default=False, description="inputs与文件相同的运行同时进行时共享一次Dify请求（不区分用户，各用户会看到同一结果）；只应对固定种子等结果确定、且不同用户间可共享结果的工作流开启")
+        # 结果缓存
+        WORKFLOW_CACHE: bool = Field(default=False, description="缓存成功运行的结果，inputs与图片内容相同的请求直接返回；只应对固定种子等结果确定的工作流开启")
+        WORKFLOW_CACHE_SIZE: int = Field(default=256, description="结果缓存的条目数上限(LRU)")
+        WORKFLOW_CACHE_MAX_MB: float = Field(default=16, description="内存中结果缓存的总大小上限(MB)")
+        WORKFLOW_CACHE_TTL: int = Field(default=300, description="结果有效期(秒)，不应超过Dify文件链接的有效期(FILES_ACCESS_TIMEOUT，默认300秒)")
+        WORKFLOW_CACHE_DIR: str = Field(default="", description="结果缓存的磁盘目录，为空时只缓存在内存中；多进程部署时可指向同一目录")
+        # 日志
+        LOG_LEVEL: str = Field(default="INFO", description="本函数的日志级别：DEBUG、INFO、WARNING 或 ERROR；DEBUG时输出请求体等调试信息")
+        LOG_MAX_CHARS: int = Field(default=2000, description="单条日志的最大字符数，base64数据与API Key总是被脱敏")
+        LOG_SAMPLE_RATE: float = Field(default=1.0, description="DEBUG日志按请求的采样率(0~1)，高并发时降低以减少日志量")
+        # 指标
+        METRICS_ENABLED: bool = Field(default=True, description="是否记录首字节、首段文本、流式响应、上传等耗时与大小的直方图指标")
+        METRICS_HOST: str = Field(default="127.0.0.1", description="Prometheus指标服务的监听地址")
+        METRICS_PORT: int = Field(default=0, description="在该端口提供 /metrics（Prometheus文本格式），0表示不启动")
 
     def __init__(self):
         self.type = "manifold"
@@ -45,6 +1827,80 @@ class Pipe:
                 
 
 
+    @property
+    def http(self) -> PooledSession:
+        """共享的带连接池HTTP会话"""
+        return get_http_session(self.valves)
+
+    @property
+    def retry(self) -> RetryPolicy:
+        """按Valves配置的重试策略"""
+        return RetryPolicy.from_valves(self.valves)
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        """url所在Dify服务的熔断器"""
+        return get_circuit_breaker(self.valves, url)
+
+    @property
+    def balancer(self) -> BackendBalancer:
+        """按Valves配置的多后端负载均衡器"""
+        return get_backend_balancer(self.valves)
+
+    @property
+    def metrics(self) -> Optional[Metrics]:
+        """共享的指标注册表，未启用时为None；METRICS_PORT非0时同时启动 /metrics 服务"""
+        if not self.valves.METRICS_ENABLED:
+            return None
+        if self.valves.METRICS_PORT:
+            start_metrics_server(self.valves.METRICS_HOST, self.valves.METRICS_PORT)
+        return get_metrics()
+
+    def metrics_text(self) -> str:
+        """Prometheus文本格式的全部指标，可用于自行暴露或推送"""
+        return get_metrics().render()
+
+    def _configure_logging(self):
+        """按Valves设置本函数的日志级别、长度上限与采样率"""
+        log.configure(self.valves.LOG_LEVEL, self.valves.LOG_MAX_CHARS, self.valves.LOG_SAMPLE_RATE)
+
+    def choose_backend(self) -> DifyBackend:
+        """按负载均衡策略选择后端，熔断中的后端被剔除"""
+        return self.balancer.choose(lambda backend: self.breaker(backend.base_url).available())
+
+    def client(self, backend: Optional[DifyBackend] = None) -> DifyClient:
+        """后端的API客户端，默认为第一个后端"""
+        return DifyClient(
+            backend or self.balancer.backends[0], self.http, self.retry, self.breaker, self.balancer,
+            metrics=self.metrics, labels={"app": self.valves.DIFY_MODLE_ID},
+        )
+
+    def backend_stats(self) -> dict:
+        """返回各后端的负载统计"""
+        return self.balancer.stats()
+
+    def circuit_stats(self) -> dict:
+        """返回各Dify后端接口与文件服务的熔断状态"""
+        urls = [url for backend in self.balancer.backends for url in (backend.base_url, backend.file_server)]
+        breakers = {self.breaker(url).name: self.breaker(url) for url in urls if url}
+        return {name: breaker.stats() for name, breaker in breakers.items()}
+
+    def pool_stats(self) -> dict:
+        """返回连接池的连接复用统计"""
+        return self.http.stats()
+
+    def upload_cache_stats(self) -> dict:
+        """返回上传缓存的命中统计"""
+        return get_upload_cache(self.valves).stats()
+
+    @property
+    def result_cache(self) -> WorkflowResultCache:
+        """本应用的工作流结果缓存"""
+        return get_result_cache(self.valves)
+
+    def result_cache_stats(self) -> dict:
+        """返回结果缓存的命中统计，未开启时为空"""
+        return self.result_cache.stats() if self.valves.WORKFLOW_CACHE else {}
+
     def get_models(self):
         """
         获取DIFY的模型列表
@@ -54,7 +1910,7 @@ class Pipe:
         ]
 
 
-    def upload_file(self, user_id: str, file_path: str, mime_type: str) -> str:
+    def upload_file(self, user_id: str, file_path: str, mime_type: str, backend: Optional[DifyBackend] = None) -> str:
         """
         上传文件到DIFY服务器
         
@@ -62,6 +1918,7 @@ class Pipe:
             user_id: 用户ID
             file_path: 文件路径
             mime_type: 文件MIME类型
+            backend: 上传到的后端，默认为第一个后端
             
         Returns:
             str: 上传成功后返回的文件ID
@@ -72,78 +1929,86 @@ class Pipe:
             ValueError: 服务器响应格式无效
         """
         try:
-            url = f"{self.valves.DIFY_BASE_URL}/files/upload"
-            headers = {
-                "Authorization": f"Bearer {self.valves.DIFY_KEY}",
-            }
-
-            file_name = os.path.basename(file_path)
-            
-            # 使用 with 语句确保文件正确关闭
-            with open(file_path, "rb") as file:
-                files = {
-                    "file": (file_name, file, mime_type),
-                    "user": (None, user_id),
-                }
-                response = requests.post(url, headers=headers, files=files, timeout=(5, 30))
-                response.raise_for_status()  # 检查响应状态
-                
-                result = response.json()
-                if "id" not in result:
-                    raise ValueError(f"服务器响应格式无效: {result}")
-                    
-                return result["id"]
-            
+            # 文件内容按块从磁盘读取发送，不整体读入内存
+            return self.client(backend).upload_path(user_id, file_path, mime_type=mime_type)["id"]
         except FileNotFoundError:
-            logging.error(f"文件未找到: {file_path}")
+            log.error(f"文件未找到: {file_path}")
             raise
+
+    def upload_file_obj(self, user_id: str, file_name: str, file, mime_type: str, backend: Optional[DifyBackend] = None) -> str:
+        """
+        上传内存中的数据或文件对象到DIFY服务器，返回文件ID
+
+        Args:
+            user_id: 用户ID
+            file_name: 上传时使用的文件名
+            file: bytes/bytearray 或可读的文件对象
+            mime_type: 文件MIME类型
+            backend: 上传到的后端，默认为第一个后端
+        """
+        try:
+            return self.client(backend).upload(user_id, file_name, file, mime_type)["id"]
         except requests.exceptions.RequestException as e:
-            logging.error(f"上传文件失败: {str(e)}")
+            log.error(f"上传文件失败: {str(e)}")
             raise
         except Exception as e:
-            logging.error(f"处理文件时发生错误: {str(e)}")
+            log.error(f"处理文件时发生错误: {str(e)}")
             raise
 
-    def upload_images(self, image_data_base64: str, user_id: str) -> str:
+    def upload_images(self, image_data_base64: str, user_id: str, backend: Optional[DifyBackend] = None) -> str:
         """
         上传 base64 编码的图片到 DIFY 服务器，返回图片路径
         支持类型: 'JPG', 'JPEG', 'PNG', 'GIF', 'WEBP', 'SVG'
+        图片直接从base64流式解码上传，不写临时文件；MIME类型按魔数识别
         """
         try:
-            # Remove the data URL scheme prefix if present
-            if image_data_base64.startswith("data:"):
-                # Extract the base64 data after the comma
-                image_data_base64 = image_data_base64.split(",", 1)[1]
-
-            # 解码 base64 图像数据
-            image_data = base64.b64decode(image_data_base64)
-
-            # Create and save temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-                tmp_file.write(image_data)
-                temp_file_path = tmp_file.name
-            try:
-                file_id = self.upload_file(user_id, temp_file_path, "image/png")
-            finally:
-                os.remove(temp_file_path)
+            backend = backend or self.balancer.backends[0]
+            # 边解码边计算哈希，不生成完整的解码副本
+            reader = Base64Reader(image_data_base64)
+            digest, head = reader.digest()
+            # 相同内容的图片已上传过时直接复用文件ID
+            upload_cache = get_upload_cache(self.valves)
+            cache_key = upload_cache_key(backend, digest, user_id)
+            file_id = upload_cache.get(cache_key)
+            if file_id is not None:
+                return file_id
+
+            mime_type, extension = sniff_image_type(head, reader.declared_type or "image/png")
+            file_id = self.upload_file_obj(user_id, f"image.{extension}", reader.read_all(), mime_type, backend)
+            upload_cache.put(cache_key, file_id)
             return file_id
         except Exception as e:
             raise ValueError(f"Failed to process base64 image data: {str(e)}")
 
+    def _upload_image_timed(self, image_data_base64: str, user_id: str, backend: Optional[DifyBackend] = None) -> str:
+        """上传单张图片并记录耗时"""
+        start = time.perf_counter()
+        file_id = self.upload_images(image_data_base64, user_id, backend)
+        log.debug("上传图片完成", ms=round((time.perf_counter() - start) * 1000, 1))
+        return file_id
+
     def pipes(self) -> List[dict]:
+        self._configure_logging()
         return self.get_models()
     
 
 
-    def pipe(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None) -> Union[str, Generator, Iterator]:
-        #主流程
-        if DEBUG_MODE:
-            print("-----------------------------------------------------------------")
-            print("Debug - Dify-Workflow Function")
-            print("Flux-schnell")
-            print(f"body:{body}")
-            print(f"__task__:{__task__}")
-            print("-----------------------------------------------------------------")
+    async def pipe(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None) -> Union[str, AsyncGenerator]:
+        #主流程：上传与请求都是阻塞调用，放到线程中执行，事件循环用于从工作线程发送进度
+        self._configure_logging()
+        log.begin_request()
+        result = await asyncio.to_thread(
+            self.pipe_sync, body, __event_emitter__, __user__, __task__, asyncio.get_running_loop()
+        )
+        if isinstance(result, str):
+            return result
+        # 流式响应同样在工作线程中逐段读取，不阻塞open-webui的事件循环
+        return iterate_in_thread(result)
+
+    def pipe_sync(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None, loop=None) -> Union[str, Generator, Iterator]:
+        #同步主流程，loop为open-webui的事件循环
+        started = time.perf_counter()
+        log.debug("收到请求", task=__task__, body=body)
         # 获取模型名称
         model_name = body["model"][body["model"].find(".") + 1 :]
         # 处理特殊任务
@@ -158,9 +2023,7 @@ class Pipe:
 
         # 处理系统消息和普通消息
         system_message, messages = pop_system_message(body["messages"])
-        if DEBUG_MODE:
-            print(f"system_message:{system_message}")
-            print(f"messages:{messages}, {len(messages)}")
+        log.debug("消息", system_message=system_message, count=len(messages), messages=messages)
 
         # 获取最后一条消息作为query
         message = messages[-1]
@@ -169,27 +2032,60 @@ class Pipe:
         # Dify APIs设置可选接入参数model与system_message.
 
         # 处理消息内容
+        images = []
         if isinstance(message.get("content"), list):
             for item in message["content"]:
                 if item["type"] == "text":
                     query += item["text"]
                 if item["type"] == "image_url":
-                    upload_file_id = self.upload_images(item["image_url"]["url"], current_user)
-                    upload_file_dict = {
-                        "type": "image",
-                        "transfer_method": "local_file",
-                        "url": "",
-                        "upload_file_id": upload_file_id
-                    }
-                    file_list.append(upload_file_dict)
+                    images.append(item["image_url"]["url"])
         else:
             query = message.get("content", "")
-        print(f"query:{query}")
         inputs = {
             "model": model_name,
             "prompt": query 
         }    
-        print(f"inputs:{inputs}")
+        # 结果缓存按inputs与图片内容查找，命中时不上传图片也不请求Dify
+        cache_key = None
+        if self.valves.WORKFLOW_CACHE:
+            cache_key = self._cache_key(inputs, images)
+            outputs = self.result_cache.get(cache_key)
+            if outputs is not None:
+                log.debug("命中工作流结果缓存", key=cache_key, cache=self.result_cache.stats)
+                result = "\n\n".join(self.workflow_outputs(outputs, self.client()))
+                if self.metrics is not None:
+                    self.metrics.observe("dify_ttft_seconds", time.perf_counter() - started, {"app": self.valves.DIFY_MODLE_ID})
+                return result
+        # 选择本次运行的后端，图片必须上传到同一后端
+        backend = self.choose_backend()
+        # 并发上传全部图片，file_list保持原有顺序
+        results = run_concurrently(
+            [partial(self._upload_image_timed, image_url, current_user, backend) for image_url in images],
+            self.valves.UPLOAD_CONCURRENCY,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                log.error(f"Error in pipe method: {result}")
+                return f"Error: {result}"
+            upload_file_dict = {
+                "type": "image",
+                "transfer_method": "local_file",
+                "url": "",
+                "upload_file_id": result
+            }
+            file_list.append(upload_file_dict)
+        # 统计信息以可调用对象传入，只在DEBUG日志实际输出时才计算
+        log.debug(
+            "发送请求",
+            inputs=inputs,
+            file_list=file_list,
+            pool=self.pool_stats,
+            circuits=self.circuit_stats,
+            backends=self.backend_stats,
+            flights=get_single_flight().stats,
+            result_cache=self.result_cache_stats,
+            metrics=get_metrics().stats,
+        )
         #开始发送数据到Dify API
         #构建载荷
         payload = {
@@ -199,130 +2095,228 @@ class Pipe:
             "files": file_list,
         }
 
-        # 设置请求头
-        headers = {
-            "Authorization": f"Bearer {self.valves.DIFY_KEY}",
-            "content-type": "application/json",
-        }
-
-        url = f"{self.valves.DIFY_BASE_URL}/workflows/run"
-
         try:
+            client = self.client(backend)
             if body.get("stream", False):
-                return self.stream_response(url, headers, payload,)
+                progress = self._progress(__event_emitter__, loop, started)
+                return self._track_stream(
+                    client, self.stream_response(client, "workflows/run", payload, progress, cache_key), started
+                )
             else:
-                return self.non_stream_response(url, headers, payload)
+                return self._run_blocking(client, "workflows/run", payload, cache_key)
         except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+            log.error(f"Request failed: {e}")
             return f"Error: Request failed: {e}"
         except Exception as e:
-            print(f"Error in pipe method: {e}")
+            log.error(f"Error in pipe method: {e}", exc_info=True)
             return f"Error: {e}"
 
 
-    def stream_response(self, url, headers, payload):
-        """处理流式响应"""
+    def _track_stream(self, client: DifyClient, chunks, started: Optional[float] = None):
+        """记录从收到请求(started)到输出第一段内容的耗时"""
+        for chunk in chunks:
+            if started is not None and chunk:
+                if client.metrics is not None:
+                    client.metrics.observe("dify_ttft_seconds", time.perf_counter() - started, client.labels)
+                started = None
+            yield chunk
+
+    @staticmethod
+    def _in_flight(client: DifyClient, source):
+        """
+        上游请求期间计入client后端的进行中请求数
+
+        只包裹实际发往Dify的请求：合并运行时由发起请求的一方计数，加入的订阅者不占用自己所选后端的负载
+
+        Args:
+            source: 无参可调用对象，返回上游的结果迭代器
+        """
+        client.balancer.begin(client.backend)
         try:
-            with requests.post(url, headers=headers, json=payload, stream=True, timeout=(3.05, 60)) as response:
-                if response.status_code != 200:
-                    raise Exception(f"HTTP Error {response.status_code}: {response.text}")
-
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode("utf-8")
-                        if line.startswith("data: "):
-                            try:
-                                data = json.loads(line[6:])
-                                event = data.get("event")
-                                
-                                if event == "workflow_started":
-                                    #yield f"Workflow started: {data.get('workflow_run_id')}"
-                                    #yield "工作流已经启动 Workflow is running..... "
-                                    pass
-                                elif event == "node_started":
-                                    # 处理节点开始事件
-                                    #node_data = data.get("data", {})
-                                    #yield f"Node started: {node_data.get('title')} ({node_data.get('node_type')})"
-                                    pass
-                                elif event == "node_finished":
-                                    # 处理节点完成事件
-                                    '''
-                                    node_data = data.get("data", {})
-                                    if node_data.get("status") == "succeeded":
-                                        yield f"Node completed: {node_data.get('title')} ({node_data.get('node_type')})"
-                                    else:
-                                        yield f"Node failed: {node_data.get('title')} ({node_data.get('node_type')})"
-                                    '''
-                                elif event == "workflow_finished":
-                                    # 处理工作流完成事件
-                                    workflow_data = data.get("data", {})
-                                    if workflow_data.get("status") == "succeeded":
-                                        outputs = workflow_data.get('outputs', {})
-                                        for value in outputs.values():
-                                            if isinstance(value, list):
-                                                for item in value:
-                                                    if item.get("type","")=="image":
-                                                        print(f"--------item:{item}")
-                                                        yield self.handle_image_response(item)
-                                                    else:
-                                                        yield item
-                                        break                                                                 
-                                    else:
-                                        yield f"Workflow failed: {workflow_data.get('error', 'Unknown error')}"
-                                        break
-                                elif event == "tts_message":
-                                    # 处理TTS音频消息
-                                    yield f"TTS audio received: {data.get('audio')[:50]}..."
-                                elif event == "tts_message_end":
-                                    # 处理TTS结束事件
-                                    yield "TTS audio stream ended"
-                                elif event == "error":
-                                    # 处理错误
-                                    error_msg = f"Error {data.get('status')}: {data.get('message')} ({data.get('code')})"
-                                    yield f"Error: {error_msg}"
-                                    break
-
-                                time.sleep(0.01)
-                            except json.JSONDecodeError:
-                                print(f"Failed to parse JSON: {line}")
-                            except KeyError as e:
-                                print(f"Unexpected data structure: {e}")
-                                print(f"Full data: {data}")
+            yield from source()
+        finally:
+            client.balancer.end(client.backend)
+
+    def _progress(self, event_emitter, loop, started: float) -> Optional[WorkflowProgress]:
+        """本次运行的进度状态，未开启进度且未开启指标时返回None，不解码节点事件"""
+        if not self.valves.WORKFLOW_PROGRESS:
+            event_emitter = None
+        if event_emitter is None and self.metrics is None:
+            return None
+        return WorkflowProgress(
+            event_emitter, loop, started, self.valves.PROGRESS_INTERVAL,
+            metrics=self.metrics, labels={"app": self.valves.DIFY_MODLE_ID},
+        )
+
+    def _flight_key(self, path: str, payload: dict) -> str:
+        """运行的规范化哈希：同一应用、同一响应模式下inputs与files相同即视为相同的运行，不区分用户与后端"""
+        canonical = json.dumps(
+            {
+                "app": [self.valves.DIFY_MODLE_ID, self.valves.DIFY_KEY],
+                "path": path,
+                "mode": payload.get("response_mode"),
+                "inputs": payload.get("inputs"),
+                "files": payload.get("files"),
+            },
+            sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _cache_key(self, inputs: dict, images: List[str]) -> str:
+        """结果缓存的键：同一应用下inputs与各图片内容(SHA-256)相同即为相同的运行，不区分用户与后端"""
+        digests = []
+        for image in images:
+            try:
+                digests.append(Base64Reader(image).digest()[0])
+            except Exception:
+                digests.append(hashlib.sha256(image.encode("utf-8")).hexdigest())
+        canonical = json.dumps(
+            {"app": [self.valves.DIFY_MODLE_ID, self.valves.DIFY_KEY], "inputs": inputs, "images": digests},
+            sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _cache_result(self, cache_key: Optional[str], outputs: Optional[dict], client: DifyClient):
+        """缓存成功运行的outputs，文件地址补全为绝对地址，命中时与后端无关"""
+        if cache_key is None:
+            return
+
+        def resolve(item):
+            if isinstance(item, dict) and isinstance(item.get("url"), str):
+                return {**item, "url": client.file_url(item["url"])}
+            return item
+
+        self.result_cache.put(cache_key, {
+            name: [resolve(item) for item in value] if isinstance(value, list) else resolve(value)
+            for name, value in (outputs or {}).items()
+        })
+
+    def _workflow_stream(self, client: DifyClient, path: str, payload: dict, events: set):
+        """
+        工作流的事件流，返回 (client, 事件迭代器)
+
+        开启WORKFLOW_COALESCE时相同的运行共享一次上游请求，上游请求总是解码进度事件以满足所有订阅者；
+        返回的client为实际发起请求的后端的客户端，用于补全图片地址
+        """
+        if not self.valves.WORKFLOW_COALESCE:
+            return client, self._in_flight(client, partial(client.stream_events, path, payload, events))
+        flight = get_single_flight().join(
+            self._flight_key(path, payload),
+            partial(self._in_flight, client, partial(client.stream_events, path, payload, STREAM_EVENTS | PROGRESS_EVENTS)),
+            client,
+        )
+        return flight.owner, flight.subscribe(events)
+
+    def _run_blocking(self, client: DifyClient, path: str, payload: dict, cache_key: Optional[str] = None) -> str:
+        """阻塞模式运行工作流，开启WORKFLOW_COALESCE时相同的运行共享一次上游请求"""
+        if not self.valves.WORKFLOW_COALESCE:
+            client.balancer.begin(client.backend)
+            try:
+                return self.non_stream_response(client, path, payload, cache_key)
+            finally:
+                client.balancer.end(client.backend)
+        flight = get_single_flight().join(
+            self._flight_key(path, payload),
+            partial(self._in_flight, client, partial(_call_once, partial(self.non_stream_response, client, path, payload, cache_key))),
+            client,
+        )
+        for result in flight.subscribe():
+            return result
+        return "Error: 工作流运行未返回结果"
+
+    def stream_response(self, client: DifyClient, path: str, payload: dict, progress: Optional[WorkflowProgress] = None,
+                        cache_key: Optional[str] = None):
+        """处理流式响应，progress不为None时转发节点进度并记录各节点耗时，cache_key不为None时缓存成功的结果"""
+        events = STREAM_EVENTS | PROGRESS_EVENTS if progress is not None else STREAM_EVENTS
+        # 按来源变量(from_variable_selector)累积text_chunk的文本，workflow_finished中与之相同的文本输出不再重复
+        streamed = {}
+        # 已经输出过内容时，后续的输出与前面之间空一行
+        separate = False
+        try:
+            client, stream = self._workflow_stream(client, path, payload, events)
+            for sse in stream:
+                try:
+                    data = sse.data
+                    event = sse.event
+
+                    if event in PROGRESS_EVENTS:
+                        progress.handle(event, data)
+                    elif event == "text_chunk":
+                        # 工作流中直接输出到结束节点的LLM文本，边生成边输出
+                        chunk = data.get("data", {})
+                        text = chunk.get("text", "")
+                        if text:
+                            selector = tuple(chunk.get("from_variable_selector") or ())
+                            streamed[selector] = streamed.get(selector, "") + text
+                            separate = True
+                            yield text
+                    elif event == "workflow_finished":
+                        # 处理工作流完成事件
+                        workflow_data = data.get("data", {})
+                        if progress is not None:
+                            progress.finish(workflow_data.get("status") == "succeeded")
+                        if workflow_data.get("status") == "succeeded":
+                            self._cache_result(cache_key, workflow_data.get("outputs"), client)
+                            # 未流式输出的文本、图片与文件在结束时输出，与前面的内容之间空一行
+                            skip_texts = {text.strip() for text in streamed.values()}
+                            for part in self.workflow_outputs(workflow_data.get("outputs"), client, skip_texts):
+                                yield f"\n\n{part}" if separate else part
+                                separate = True
+                            break
+                        else:
+                            yield f"Workflow failed: {workflow_data.get('error', 'Unknown error')}"
+                            break
+                    elif event == "tts_message":
+                        # 处理TTS音频消息
+                        yield f"TTS audio received: {data.get('audio')[:50]}..."
+                    elif event == "tts_message_end":
+                        # 处理TTS结束事件
+                        yield "TTS audio stream ended"
+                    elif event == "error":
+                        # 处理错误
+                        if progress is not None:
+                            progress.finish(False)
+                        error_msg = f"Error {data.get('status')}: {data.get('message')} ({data.get('code')})"
+                        yield f"Error: {error_msg}"
+                        break
+                except json.JSONDecodeError:
+                    log.warning("Failed to parse JSON", raw=sse.raw)
+                except KeyError as e:
+                    log.warning(f"Unexpected data structure: {e}", raw=sse.raw)
         except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+            log.error(f"Request failed: {e}")
+            if progress is not None:
+                progress.finish(False)
             yield f"Error: Request failed: {e}"
         except Exception as e:
-            print(f"General error in stream_response method: {e}")
+            log.error(f"General error in stream_response method: {e}", exc_info=True)
+            if progress is not None:
+                progress.finish(False)
             yield f"Error: {e}"
+        finally:
+            if progress is not None:
+                progress.close()
 
-    def non_stream_response(
-        self, URL,headers, payload
-    ) -> str:
+    def non_stream_response(self, client: DifyClient, path: str, payload: dict, cache_key: Optional[str] = None) -> str:
         """
         Get a non-streaming response from the API.
 
         Args:
-            headers (Dict[str, str]): The headers for the request.
+            client (DifyClient): The client of the backend the request is sent to.
+            path (str): The API path, e.g. workflows/run.
             payload (Dict[str, Any]): The payload for the request.
+            cache_key (str): The result cache key, None when caching is disabled.
 
         Returns:
             str: The response from the API.
         """
         try:
-            response = requests.post(
-                url=URL,
-                headers=headers,
-                json=payload,
-                stream=False,
-                timeout=(3.05, 60),
-            )
+            response = client.post(path, payload)
             response.raise_for_status()
 
             content_type = response.headers.get("Content-Type", "")
             if "application/json" in content_type:
-                return self.handle_json_response(response)
-            elif "image/" in content_type:
-                return self.handle_image_response(response)
+                return self.handle_json_response(response, client, cache_key)
             else:
                 return f"Error: Unsupported content type {content_type}"
 
@@ -333,12 +2327,61 @@ class Pipe:
         except Exception as e:
             return f"Error: {e}"
     
-    def handle_image_response(self, output_image) -> str:
+    def handle_json_response(self, response: requests.Response, client: DifyClient, cache_key: Optional[str] = None) -> str:
+        """
+        处理阻塞模式返回的工作流运行结果
+
+        Args:
+            response (requests.Response): workflows/run 的JSON响应
+            client (DifyClient): 运行工作流的后端的客户端
+            cache_key (str): 结果缓存的键，不为None时缓存成功的结果
+
+        Returns:
+            str: 文本输出与Markdown格式的图片、文件链接
+        """
+        workflow_data = response.json().get("data", {})
+        if workflow_data.get("status") != "succeeded":
+            return f"Workflow failed: {workflow_data.get('error', 'Unknown error')}"
+        self._cache_result(cache_key, workflow_data.get("outputs"), client)
+        return "\n\n".join(self.workflow_outputs(workflow_data.get("outputs"), client))
+
+    def workflow_outputs(self, outputs: Optional[dict], client: DifyClient, skip_texts: Collection[str] = ()) -> List[str]:
+        """
+        把工作流的outputs转换为输出片段
+
+        Args:
+            outputs (dict): workflow_finished或阻塞响应中的outputs
+            client (DifyClient): 运行工作流的后端的客户端
+            skip_texts (Collection[str]): 已经以text_chunk流式输出过的文本（去掉首尾空白），与之相同的文本输出跳过
+
+        Returns:
+            List[str]: 按输出变量顺序排列的文本、图片与文件
+        """
+        parts = []
+        for value in (outputs or {}).values():
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict) and item.get("url"):
+                    if item.get("type") == "image":
+                        log.debug("工作流输出图片", item=item)
+                        parts.append(self.handle_image_response(item, client))
+                    else:
+                        parts.append(self.handle_file_response(item, client))
+                elif isinstance(item, str) and item and item.strip() not in skip_texts:
+                    parts.append(item)
+        return parts
+
+    def handle_file_response(self, output_file: dict, client: Optional[DifyClient] = None) -> str:
+        """工作流输出的非图片文件转为Markdown链接，相对地址补全为后端的地址"""
+        url = (client or self.client()).file_url(output_file["url"])
+        return f"[{output_file.get('filename') or 'file'}]({url})"
+
+    def handle_image_response(self, output_image, client: Optional[DifyClient] = None) -> str:
         """
         处理API返回的图像响应
 
         Args:
             output_image (dict): 包含图像信息的字典
+            client (DifyClient): 生成图像的后端的客户端，图片地址相对于该后端
 
         Returns:
             str: 格式化后的图像数据，包含Markdown格式的图像链接和文件信息
@@ -348,14 +2391,13 @@ class Pipe:
             img_url = img_data.get("url")
             img_ext = img_data.get("extension", ".png").strip(".")
             
-            # 构建完整的图片URL
-            # 优化后的URL处理逻辑
-            base_url = self.valves.DIFY_BASE_URL.rstrip("/v1")  # 去掉末尾的 /v1
-            img_url = img_url.lstrip("/")  # 移除开头的所有斜杠
-            full_url = f"{base_url}/{img_url}"  # 自动处理斜杠
+            # 构建完整的图片URL，相对地址补全为后端的地址
+            if not img_url.startswith(("http://", "https://")):
+                img_url = "/" + img_url.lstrip("/")  # 统一为一个开头斜杠
+            full_url = (client or self.client()).file_url(img_url)
             # 返回Markdown格式的图像链接
             return f"![Image]({full_url})\n`GeneratedImage.{img_ext}`"
                 
         except Exception as e:
-            logging.error(f"处理图像响应时出错: {str(e)}")
+            log.error(f"处理图像响应时出错: {str(e)}")
             return f"Error: Failed to process image response - {str(e)}"
\ No newline at end of file
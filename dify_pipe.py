@@ -8,24 +8,2197 @@ version: 0.1
 description: 该流程用于DIFY的API接口，用于与DIFY的API进行交互
 """
 
+import asyncio
+import contextvars
 import logging
 import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import types
 import requests
 import json
+import random
 import time
-from typing import List, Union, Generator, Iterator, Optional
+import email.utils
+from typing import List, Union, Generator, Iterator, Optional, AsyncGenerator
 from pydantic import BaseModel, Field
 from open_webui.utils.misc import pop_system_message
 from open_webui.config import UPLOAD_DIR
 import base64
-import tempfile
-from urllib.parse import quote
+import bisect
+import io
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import quote, urlparse
 from io import BytesIO
-#Debug模式
-DEBUG_MODE = True
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+try:
+    import aiohttp
+except ImportError:  # 缺少aiohttp时只能使用同步实现
+    aiohttp = None
 def get_file_extension(file_name: str) -> str:
     return os.path.splitext(file_name)[1].strip(".")
 
+
+# 进程内共享对象注册表
+# open-webui 把每个函数当作独立模块加载，dify_pipe、dify_Workflow 与 dify_Filter 借助 sys.modules 共享连接池、附件队列等资源
+_SHARED = sys.modules.setdefault("_dify_shared", types.ModuleType("_dify_shared")).__dict__
+_SHARED_LOCK = _SHARED.setdefault("lock", threading.RLock())
+
+
+def get_shared(name: str, factory):
+    """按名称获取进程内共享对象，不存在时用factory创建"""
+    with _SHARED_LOCK:
+        obj = _SHARED.get(name)
+        if obj is None:
+            obj = factory()
+            _SHARED[name] = obj
+        return obj
+
+
+# 共享对象的代码版本，加入注册表中对象的名称
+# 各文件可以单独安装、分别更新，open-webui 更新函数时也只重新加载该文件，注册表中的对象却是先创建它的文件中的类的实例；
+# 版本不同的文件各自创建实例，不会调用到旧实现。修改三个文件共有的代码或注册表中对象的类时加一（tests/test_shared_copies.py 会检查）
+SHARED_CODE_VERSION = 2
+
+
+# 结构化日志
+# 字段值在日志真正输出时才格式化：base64数据与API Key被脱敏，长字符串与长列表被截断，可调用对象被调用取值
+_SECRET_FIELD = re.compile(r"key|token|secret|password|authorization", re.IGNORECASE)
+_SECRET_TEXT = [
+    (re.compile(r"data:([\w.+/-]+);base64,[A-Za-z0-9+/=]{16,}"), lambda m: f"data:{m.group(1)};base64,<{len(m.group(0))} chars>"),
+    (re.compile(r"(Bearer\s+)[\w.-]+"), lambda m: f"{m.group(1)}***"),
+    (re.compile(r"\b(app|dataset)-[A-Za-z0-9]{8,}"), lambda m: f"{m.group(1)}-***"),
+]
+_LOG_MAX_ITEMS = 20
+_LOG_SAMPLED = contextvars.ContextVar("dify_log_sampled", default=True)
+
+
+def redact_text(text: str) -> str:
+    """把文本中的base64数据与API Key替换为占位符"""
+    for pattern, replace in _SECRET_TEXT:
+        text = pattern.sub(replace, text)
+    return text
+
+
+def shrink_for_log(value, max_chars: int):
+    """逐层脱敏并截断日志字段，避免格式化整个请求体"""
+    if callable(value):
+        value = value()
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value[:max_chars]).decode("utf-8", errors="replace") + (f"...<{len(value)} bytes>" if len(value) > max_chars else "")
+    if isinstance(value, str):
+        value = redact_text(value)
+        return value if len(value) <= max_chars else f"{value[:max_chars]}...<{len(value)} chars>"
+    if isinstance(value, dict):
+        return {
+            key: "***" if _SECRET_FIELD.search(str(key)) else shrink_for_log(item, max_chars)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        if len(value) > _LOG_MAX_ITEMS:
+            half = _LOG_MAX_ITEMS // 2
+            value = list(value[:half]) + [f"...<{len(value) - _LOG_MAX_ITEMS} items>"] + list(value[-half:])
+        return [shrink_for_log(item, max_chars) for item in value]
+    return value
+
+
+class _LogMessage:
+    """延迟格式化的日志消息：消息 + key=value 字段"""
+
+    __slots__ = ("msg", "fields", "max_chars")
+
+    def __init__(self, msg: str, fields: dict, max_chars: int):
+        self.msg = msg
+        self.fields = fields
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        field_chars = max(self.max_chars // 4, 64)
+        parts = [self.msg]
+        for key, value in self.fields.items():
+            value = "***" if _SECRET_FIELD.search(key) else shrink_for_log(value, field_chars)
+            parts.append(f"{key}={value}")
+        text = " ".join(parts)
+        return text if len(text) <= self.max_chars else f"{text[:self.max_chars]}...<{len(text)} chars>"
+
+
+class DifyLogger:
+    """
+    logging.Logger 的轻量包装，每个函数文件一个（dify.pipe、dify.workflow、dify.filter）
+
+    log.debug("消息", key=value) 中的字段只在该级别启用时才格式化；
+    begin_request() 按采样率决定本次请求的debug日志是否输出，warning及以上不采样
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+        self.max_chars = 2000
+        self.sample_rate = 1.0
+        self._configured = None
+
+    def configure(self, level: str = "INFO", max_chars: int = 2000, sample_rate: float = 1.0):
+        """按Valves设置级别、单条日志长度上限与debug日志采样率"""
+        config = (str(level).upper(), max_chars, sample_rate)
+        if config == self._configured:
+            return
+        level_no = logging.getLevelName(config[0])
+        self.logger.setLevel(level_no if isinstance(level_no, int) else logging.INFO)
+        self.max_chars = max(int(max_chars), 200)
+        self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+        # open-webui未配置日志处理器时输出到stderr
+        root = logging.getLogger()
+        parent = logging.getLogger("dify")
+        if not root.handlers and not parent.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+            parent.addHandler(handler)
+            parent.propagate = False
+        self._configured = config
+
+    def begin_request(self) -> bool:
+        """在请求开始时调用，决定本次请求（当前上下文）的debug日志是否输出"""
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        _LOG_SAMPLED.set(sampled)
+        return sampled
+
+    def enabled(self, level: int = logging.DEBUG) -> bool:
+        if not self.logger.isEnabledFor(level):
+            return False
+        return level > logging.DEBUG or _LOG_SAMPLED.get()
+
+    def _log(self, level: int, msg: str, fields: dict, exc_info=False):
+        if self.enabled(level):
+            self.logger.log(level, "%s", _LogMessage(msg, fields, self.max_chars), exc_info=exc_info)
+
+    def debug(self, msg: str, **fields):
+        self._log(logging.DEBUG, msg, fields)
+
+    def info(self, msg: str, **fields):
+        self._log(logging.INFO, msg, fields)
+
+    def warning(self, msg: str, **fields):
+        self._log(logging.WARNING, msg, fields)
+
+    def error(self, msg: str, exc_info=False, **fields):
+        self._log(logging.ERROR, msg, fields, exc_info)
+
+
+log = DifyLogger("dify.pipe")
+
+
+class PooledSession:
+    """
+    带连接池的keep-alive HTTP会话，封装 requests.Session + HTTPAdapter
+
+    Args:
+        pool_connections: 缓存的主机连接池数量
+        pool_maxsize: 每个主机的最大连接数
+        pool_block: 连接数达到上限时是否阻塞等待空闲连接
+        keep_alive: 是否复用连接并开启TCP keepalive
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 20, pool_block: bool = False, keep_alive: bool = True):
+        self.keep_alive = keep_alive
+        self.session = requests.Session()
+        self.adapter = _KeepAliveAdapter(
+            keep_alive=keep_alive,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def stats(self) -> dict:
+        """统计连接复用情况：requests为请求数，connections为新建连接数"""
+        pools = self.adapter.poolmanager.pools
+        num_requests = 0
+        num_connections = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        reused = max(num_requests - num_connections, 0)
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "reused": reused,
+            "reuse_ratio": round(reused / num_requests, 4) if num_requests else 0.0,
+        }
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """开启TCP keepalive的HTTPAdapter"""
+
+    def __init__(self, keep_alive: bool = True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_http_session(valves) -> PooledSession:
+    """按连接池配置获取共享的HTTP会话，两个Pipe配置相同则共用同一个连接池"""
+    key = (
+        f"http_session@v{SHARED_CODE_VERSION}"
+        f":{valves.POOL_CONNECTIONS}:{valves.POOL_MAXSIZE}:{valves.POOL_BLOCK}:{valves.KEEP_ALIVE}"
+    )
+    return get_shared(
+        key,
+        lambda: PooledSession(
+            pool_connections=valves.POOL_CONNECTIONS,
+            pool_maxsize=valves.POOL_MAXSIZE,
+            pool_block=valves.POOL_BLOCK,
+            keep_alive=valves.KEEP_ALIVE,
+        ),
+    )
+
+async def get_async_http_session(valves) -> "aiohttp.ClientSession":
+    """获取当前事件循环共享的aiohttp会话，连接池参数与同步会话使用相同的Valves"""
+    loop = asyncio.get_running_loop()
+    key = f"async_http_session:{id(loop)}:{valves.POOL_CONNECTIONS}:{valves.POOL_MAXSIZE}:{valves.KEEP_ALIVE}"
+    entry = _SHARED.get(key)
+    if entry is not None and entry[0] is loop and not entry[1].closed:
+        return entry[1]
+    connector = aiohttp.TCPConnector(
+        limit=valves.POOL_CONNECTIONS * valves.POOL_MAXSIZE,
+        limit_per_host=valves.POOL_MAXSIZE,
+        force_close=not valves.KEEP_ALIVE,
+    )
+    session = aiohttp.ClientSession(connector=connector)
+    with _SHARED_LOCK:
+        _SHARED[key] = (loop, session)
+    return session
+
+
+class RetryPolicy:
+    """
+    Dify调用的重试策略：指数退避 + 全抖动，遵循Retry-After
+
+    只用于可安全重发的阶段：文件上传、阻塞调用、流式响应收到首字节之前。
+    重试连接失败（含连接超时、连接被重置）和 statuses 中的HTTP状态码；读超时不重试，避免重复执行
+
+    Args:
+        attempts: 最多尝试次数（含首次），<=1 表示不重试
+        base_delay: 首次重试的退避基数(秒)
+        max_delay: 单次等待的上限(秒)，Retry-After 也不超过该值
+        statuses: 需要重试的HTTP状态码
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10, statuses=(429, 502, 503, 504)):
+        self.attempts = max(int(attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = frozenset(statuses)
+
+    @classmethod
+    def from_valves(cls, valves) -> "RetryPolicy":
+        statuses = [int(s) for s in re.split(r"[,\s]+", valves.RETRY_STATUSES) if s.strip().isdigit()]
+        return cls(valves.RETRY_ATTEMPTS, valves.RETRY_BASE_DELAY, valves.RETRY_MAX_DELAY, statuses)
+
+    @staticmethod
+    def parse_retry_after(value) -> Optional[float]:
+        """解析Retry-After头（秒数或HTTP日期），无法解析时返回None"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def delay(self, attempt: int, retry_after=None) -> float:
+        """第attempt次重试（从0开始）前的等待时间"""
+        seconds = self.parse_retry_after(retry_after)
+        if seconds is None:
+            seconds = random.uniform(0, self.base_delay * (2 ** attempt))
+        return min(seconds, self.max_delay)
+
+    def call(self, send, what: str = "request", breaker=None):
+        """
+        执行 send() 并按策略重试，send 每次都要重新发出请求（文件体需先回到开头）
+
+        Args:
+            breaker: 可选的 CircuitBreaker，每次尝试前检查并记录结果
+
+        Returns:
+            requests.Response: 最后一次的响应，状态码仍可能是可重试的错误码
+        """
+        for attempt in range(self.attempts):
+            last = attempt == self.attempts - 1
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                if breaker is not None:
+                    breaker.record_failure()
+                if last or not isinstance(e, requests.exceptions.ConnectionError):
+                    raise
+                reason, wait = repr(e), self.delay(attempt)
+            else:
+                if breaker is not None:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if last or response.status_code not in self.statuses:
+                    return response
+                reason = f"HTTP {response.status_code}"
+                wait = self.delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+            log.warning(f"{what} 失败，{wait:.2f}秒后第{attempt + 1}次重试", reason=reason)
+            time.sleep(wait)
+
+
+def _retryable_async_error(e: Exception) -> bool:
+    """aiohttp的异常是否可以安全重发：连接失败、连接被重置与连接超时；读超时不重试"""
+    if isinstance(e, (aiohttp.ClientOSError, aiohttp.ServerDisconnectedError)):
+        return True
+    # aiohttp 3.10 起连接超时为 ConnectionTimeoutError，之前的版本与读超时同为 ServerTimeoutError，按提示信息区分
+    connect_timeout = getattr(aiohttp, "ConnectionTimeoutError", None)
+    if connect_timeout is not None:
+        return isinstance(e, connect_timeout)
+    return isinstance(e, aiohttp.ServerTimeoutError) and str(e).startswith("Connection timeout")
+
+
+async def retry_async(policy: RetryPolicy, send, what: str = "request", breaker=None):
+    """
+    RetryPolicy.call 的aiohttp版本，send() 返回 session.post(...) 等待得到的响应
+
+    Returns:
+        aiohttp.ClientResponse: 最后一次的响应，调用方负责用 async with 释放
+    """
+    for attempt in range(policy.attempts):
+        last = attempt == policy.attempts - 1
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            response = await send()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if breaker is not None:
+                breaker.record_failure()
+            if last or not _retryable_async_error(e):
+                raise
+            reason, wait = repr(e), policy.delay(attempt)
+        else:
+            if breaker is not None:
+                if response.status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if last or response.status not in policy.statuses:
+                return response
+            reason = f"HTTP {response.status}"
+            wait = policy.delay(attempt, response.headers.get("Retry-After"))
+            response.release()
+        log.warning(f"{what} 失败，{wait:.2f}秒后第{attempt + 1}次重试", reason=reason)
+        await asyncio.sleep(wait)
+
+class CircuitOpenError(Exception):
+    """熔断器打开期间直接拒绝请求"""
+
+
+class CircuitBreaker:
+    """
+    Dify服务熔断器
+
+    连续失败（连接失败、超时、5xx）failure_threshold 次后打开，打开期间请求直接失败；
+    reset_timeout 秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+
+    Args:
+        name: 名称（服务地址），用于提示信息
+        failure_threshold: 打开熔断所需的连续失败次数，<=0 表示禁用
+        reset_timeout: 打开后多久允许探测(秒)
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """发出请求前调用，熔断打开时抛出 CircuitOpenError"""
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN and now - self._probe_at >= self.reset_timeout:
+                # 探测请求迟迟没有结果，再放行一个
+                pass
+            else:
+                self.rejected += 1
+                wait = max(self._opened_at + self.reset_timeout - now, 0)
+                raise CircuitOpenError(
+                    f"Dify服务 {self.name} 暂时不可用（连续失败{self.failures}次，已熔断），请约{wait:.0f}秒后再试"
+                )
+            self._probe_at = now
+
+    def available(self) -> bool:
+        """当前是否可以放行请求（不改变状态），用于负载均衡时剔除熔断中的后端"""
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self._opened_at >= self.reset_timeout
+        return now - self._probe_at >= self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    log.warning(f"Dify服务 {self.name} 熔断打开，连续失败{self.failures}次")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == self.OPEN:
+                retry_in = max(self._opened_at + self.reset_timeout - time.monotonic(), 0.0)
+            return {
+                "name": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in": round(retry_in, 1),
+            }
+
+
+def get_circuit_breaker(valves, url: str) -> CircuitBreaker:
+    """按服务地址(host)获取共享的熔断器，同一Dify服务的各Pipe共用熔断状态"""
+    host = urlparse(url).netloc or url
+    return get_shared(
+        f"circuit_breaker@v{SHARED_CODE_VERSION}:{host}:{valves.CIRCUIT_FAILURE_THRESHOLD}:{valves.CIRCUIT_RESET_TIMEOUT}",
+        lambda: CircuitBreaker(host, valves.CIRCUIT_FAILURE_THRESHOLD, valves.CIRCUIT_RESET_TIMEOUT),
+    )
+
+
+class DifyBackend:
+    """
+    一个Dify API后端（服务地址 + API Key）及其负载统计
+
+    上传文件ID与会话ID只在同一后端内有效，id 由地址和Key计算，配置调整顺序后保持不变
+    """
+
+    def __init__(self, base_url: str, key: str, weight: float = 1, file_server: str = ""):
+        self.base_url = base_url.rstrip("/")
+        self.key = key
+        self.weight = max(float(weight), 0.01)
+        self.file_server = file_server or f"{self.base_url}/files/upload"
+        self.id = hashlib.sha256(f"{self.base_url}|{key}".encode("utf-8")).hexdigest()[:16]
+        self.in_flight = 0
+        self.requests = 0
+        self.ewma_ms = None
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "ewma_ms": round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+        }
+
+
+def parse_backends(valves) -> List[DifyBackend]:
+    """
+    解析DIFY_BACKENDS：每行（或用分号分隔）一个后端，格式为 地址|API Key|权重，
+    Key省略时使用DIFY_KEY，权重省略时为1；未配置时只使用DIFY_BASE_URL与DIFY_KEY
+    """
+    backends = []
+    for line in re.split(r"[;\n]+", valves.DIFY_BACKENDS):
+        parts = [part.strip() for part in line.split("|")]
+        if not parts[0]:
+            continue
+        key = parts[1] if len(parts) > 1 and parts[1] else valves.DIFY_KEY
+        weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1
+        backends.append(DifyBackend(parts[0], key, weight))
+    if not backends:
+        backends.append(DifyBackend(valves.DIFY_BASE_URL, valves.DIFY_KEY, 1, valves.FILE_SERVER))
+    return backends
+
+
+class BackendBalancer:
+    """
+    在多个Dify后端之间分配请求
+
+    Args:
+        backends: 后端列表
+        strategy: round_robin（平滑加权轮询）、least_in_flight（按权重的最少进行中请求）
+            或 ewma（按首字节延迟的指数加权平均 × 进行中请求数）
+        ewma_alpha: EWMA的平滑系数
+    """
+
+    STRATEGIES = ("round_robin", "least_in_flight", "ewma")
+
+    def __init__(self, backends: List[DifyBackend], strategy: str = "round_robin", ewma_alpha: float = 0.3):
+        self.backends = backends
+        self.strategy = strategy if strategy in self.STRATEGIES else "round_robin"
+        self.ewma_alpha = ewma_alpha
+        self._by_id = {backend.id: backend for backend in backends}
+        self._current = {backend.id: 0.0 for backend in backends}
+        self._lock = threading.Lock()
+
+    def get(self, backend_id: str) -> Optional[DifyBackend]:
+        return self._by_id.get(backend_id)
+
+    def choose(self, available=None) -> DifyBackend:
+        """
+        选择一个后端，available(backend) 为False的后端（熔断中）被剔除；
+        全部不可用时仍在全体中选择，由熔断器给出明确的错误
+        """
+        candidates = [b for b in self.backends if available is None or available(b)] or self.backends
+        with self._lock:
+            if self.strategy == "least_in_flight":
+                return min(candidates, key=lambda b: ((b.in_flight + 1) / b.weight, b.requests / b.weight))
+            if self.strategy == "ewma":
+                # 还没有延迟数据的后端优先，以便尽快得到统计
+                return min(candidates, key=lambda b: (b.ewma_ms or 0.0) * (b.in_flight + 1) / b.weight)
+            total = sum(b.weight for b in candidates)
+            for b in candidates:
+                self._current[b.id] += b.weight
+            best = max(candidates, key=lambda b: self._current[b.id])
+            self._current[best.id] -= total
+            return best
+
+    def begin(self, backend: DifyBackend):
+        with self._lock:
+            backend.in_flight += 1
+            backend.requests += 1
+
+    def end(self, backend: DifyBackend):
+        with self._lock:
+            backend.in_flight = max(backend.in_flight - 1, 0)
+
+    def observe(self, backend: DifyBackend, latency_ms: float):
+        """记录一次首字节延迟"""
+        with self._lock:
+            if backend.ewma_ms is None:
+                backend.ewma_ms = latency_ms
+            else:
+                backend.ewma_ms += self.ewma_alpha * (latency_ms - backend.ewma_ms)
+
+    def stats(self) -> dict:
+        return {"strategy": self.strategy, "backends": [backend.stats() for backend in self.backends]}
+
+
+def get_balancer(backends: List[DifyBackend], strategy: str) -> BackendBalancer:
+    """按后端列表与策略获取共享的负载均衡器，负载统计在同配置的Pipe间共享"""
+    config = "|".join(f"{b.id}:{b.weight}:{b.file_server}" for b in backends)
+    key = f"backend_balancer@v{SHARED_CODE_VERSION}:{hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]}:{strategy}"
+    return get_shared(key, lambda: BackendBalancer(backends, strategy))
+
+
+def get_backend_balancer(valves) -> BackendBalancer:
+    """按Valves中的后端配置获取共享的负载均衡器"""
+    return get_balancer(parse_backends(valves), valves.LB_STRATEGY)
+
+# 指标定义：名称 -> (说明, 桶上界)；耗时单位为秒，大小单位为字节
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1KiB ~ 256MiB
+METRIC_DEFINITIONS = {
+    "dify_ttfb_seconds": ("从发出请求到收到Dify响应头的耗时", _LATENCY_BUCKETS),
+    "dify_ttft_seconds": ("从Pipe收到请求到向open-webui输出第一段文本的耗时", _LATENCY_BUCKETS),
+    "dify_stream_duration_seconds": ("Dify流式响应的总耗时", _LATENCY_BUCKETS),
+    "dify_stream_events": ("每个流式响应收到的SSE事件数", (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)),
+    "dify_stream_bytes": ("每个流式响应收到的字节数", _SIZE_BUCKETS),
+    "dify_upload_seconds": ("上传单个文件到Dify的耗时", _LATENCY_BUCKETS),
+    "dify_upload_bytes": ("上传到Dify的单个文件大小", _SIZE_BUCKETS),
+    "dify_save_state_seconds": ("save_state持久化聊天状态的耗时", _LATENCY_BUCKETS),
+    "dify_workflow_node_seconds": ("工作流单个节点的耗时，按节点标题与状态分组", _LATENCY_BUCKETS),
+}
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in items) + "}"
+
+
+class Histogram:
+    """Prometheus风格的直方图，按标签分组累计各桶的次数、总和与总次数"""
+
+    def __init__(self, name: str, description: str, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: dict):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        """Prometheus文本格式"""
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(key, le=bound)} {cumulative}")
+            lines.append(f'{self.name}_bucket{_format_labels(key, le="+Inf")} {count}')
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+    def stats(self) -> dict:
+        """各标签组合的次数与平均值"""
+        with self._lock:
+            return {
+                ",".join(f"{name}={value}" for name, value in key): {"count": count, "avg": round(total / count, 4)}
+                for key, (_, total, count) in self._series.items()
+                if count
+            }
+
+
+class Metrics:
+    """
+    进程内的指标注册表，dify_pipe 与 dify_Workflow 的 SHARED_CODE_VERSION 相同时两者共享
+
+    observe 记录到直方图并转发给已注册的sink：sink(name, value, labels)，
+    可用于对接StatsD、OpenTelemetry等；render 输出Prometheus文本格式
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._sinks = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    description, buckets = METRIC_DEFINITIONS[name]
+                    histogram = self._histograms[name] = Histogram(name, description, buckets)
+        return histogram
+
+    def observe(self, name: str, value: float, labels: Optional[dict] = None):
+        labels = labels or {}
+        self.histogram(name).observe(value, labels)
+        for sink in self._sinks:
+            try:
+                sink(name, value, labels)
+            except Exception as e:
+                log.error(f"指标sink出错: {e}")
+
+    def add_sink(self, sink):
+        with self._lock:
+            self._sinks = self._sinks + [sink]
+
+    def remove_sink(self, sink):
+        with self._lock:
+            self._sinks = [s for s in self._sinks if s is not sink]
+
+    def _sorted(self) -> List[Histogram]:
+        with self._lock:
+            return [self._histograms[name] for name in sorted(self._histograms)]
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._sorted():
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> dict:
+        return {histogram.name: histogram.stats() for histogram in self._sorted()}
+
+
+def get_metrics() -> Metrics:
+    """进程内共享的指标注册表"""
+    return get_shared(f"metrics@v{SHARED_CODE_VERSION}", Metrics)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host: str, port: int):
+    """
+    在后台线程中提供 http://host:port/metrics，同一地址在进程内只启动一次；端口被占用时返回False
+
+    两个函数的 SHARED_CODE_VERSION 不同时各用一个注册表，该地址只输出先启动服务的文件中的指标
+    """
+
+    def create():
+        try:
+            server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            log.error(f"指标服务启动失败 {host}:{port}: {e}")
+            return False
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="dify-metrics", daemon=True).start()
+        return server
+
+    return get_shared(f"metrics_server:{host}:{port}", create) is not False
+
+
+class SSEEvent:
+    """
+    单个SSE事件
+
+    event 优先取 event: 字段，否则从 data 开头窥探Dify的 "event" 键，不解析整个JSON；
+    data 在首次访问时才执行 json.loads，不需要的事件（如 node_finished）不会被解码
+    """
+
+    __slots__ = ("event", "id", "raw", "_data")
+
+    _EVENT_PEEK = re.compile(rb'"event"\s*:\s*"([^"]+)"')
+    _UNSET = object()
+
+    def __init__(self, event: Optional[str], raw: bytes, id: Optional[str] = None):
+        self.raw = raw
+        self.id = id
+        self._data = self._UNSET
+        if event is None and raw:
+            match = self._EVENT_PEEK.search(raw, 0, 64)
+            if match is not None:
+                event = match.group(1).decode("utf-8")
+            else:
+                event = self.data.get("event") if isinstance(self.data, dict) else None
+        self.event = event
+
+    @property
+    def data(self):
+        """解析后的JSON数据，解析失败抛出 json.JSONDecodeError"""
+        if self._data is self._UNSET:
+            self._data = json.loads(self.raw.decode("utf-8")) if self.raw else None
+        return self._data
+
+
+class SSEParser:
+    """
+    增量SSE解析器，按任意大小的字节块喂入，支持多行 data:、event:、id: 字段和注释行
+
+    Dify 的 ping 事件（event: ping，无data）会作为 event="ping" 的事件返回
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._data_lines = []
+        self._event = None
+        self._last_id = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """喂入一个字节块，返回其中已完整接收的事件"""
+        if b"\n" not in chunk:
+            # 未结束的长行（如体积很大的node_finished）先暂存，避免反复拼接和扫描
+            self._pending.append(chunk)
+            return []
+        if self._pending:
+            self._pending.append(chunk)
+            chunk = b"".join(self._pending)
+        lines = chunk.split(b"\n")
+        last = lines.pop()
+        self._pending = [last] if last else []
+        events = []
+        for line in lines:
+            event = self._process_line(line[:-1] if line.endswith(b"\r") else line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self) -> List[SSEEvent]:
+        """流结束时处理剩余未以空行结尾的事件"""
+        events = []
+        if self._pending:
+            line = b"".join(self._pending)
+            self._pending = []
+            event = self._process_line(line[:-1] if line.endswith(b"\r") else line)
+            if event is not None:
+                events.append(event)
+        event = self._process_line(b"")
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line.startswith(b"data: "):
+            self._data_lines.append(line[6:])
+            return None
+        if line[0:1] == b":":
+            # 注释行
+            return None
+        field, sep, value = line.partition(b":")
+        if sep and value[0:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self._data_lines.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8")
+        elif field == b"id":
+            self._last_id = value.decode("utf-8")
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data_lines and self._event is None:
+            return None
+        data_lines = self._data_lines
+        raw = data_lines[0] if len(data_lines) == 1 else b"\n".join(data_lines)
+        event = SSEEvent(self._event, raw, self._last_id)
+        self._data_lines = []
+        self._event = None
+        return event
+
+
+def iter_sse_events(chunks, events=None):
+    """把响应字节块迭代器转换为SSE事件迭代器，给定events时只返回这些类型的事件"""
+    parser = SSEParser()
+    for chunk in chunks:
+        for sse in parser.feed(chunk):
+            if events is None or sse.event in events:
+                yield sse
+    for sse in parser.close():
+        if events is None or sse.event in events:
+            yield sse
+
+
+async def aiter_sse_events(chunks, events=None):
+    """iter_sse_events 的异步版本，chunks为异步字节块迭代器"""
+    parser = SSEParser()
+    async for chunk in chunks:
+        for sse in parser.feed(chunk):
+            if events is None or sse.event in events:
+                yield sse
+    for sse in parser.close():
+        if events is None or sse.event in events:
+            yield sse
+
+
+async def aiter_with_timeout(items, timeout):
+    """
+    逐个产出异步迭代器的元素，等待超时时产出None，超时不会取消进行中的读取
+
+    Args:
+        timeout: 无参调用，返回本次最长等待的秒数，None表示一直等待
+    """
+    iterator = items.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=timeout())
+            if not done:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+
+
+class TokenCoalescer:
+    """
+    合并连续的message文本片段，按字节数和时间窗口批量输出，减少发给open-webui的块数
+
+    Args:
+        max_bytes: 缓冲达到该字节数时输出，<=0 表示直通不合并
+        max_delay: 缓冲中最早片段等待超过该秒数时输出；同步流程只在新片段到达时检查，
+            异步流程按 remaining() 定时检查，上游停顿时也能按时输出
+    """
+
+    def __init__(self, max_bytes: int = 0, max_delay: float = 0.05):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._parts = []
+        self._size = 0
+        self._started = 0.0
+
+    def push(self, text: str) -> Optional[str]:
+        """加入一个片段，满足输出条件时返回合并后的文本"""
+        if self.max_bytes <= 0:
+            return text
+        if not self._parts:
+            self._started = time.monotonic()
+        self._parts.append(text)
+        self._size += len(text.encode("utf-8"))
+        if self._size >= self.max_bytes or time.monotonic() - self._started >= self.max_delay:
+            return self.flush()
+        return None
+
+    def remaining(self) -> Optional[float]:
+        """距缓冲必须输出还有多少秒，缓冲为空时返回None"""
+        if not self._parts:
+            return None
+        return max(self._started + self.max_delay - time.monotonic(), 0.0)
+
+    def flush(self) -> Optional[str]:
+        """取出缓冲中的全部文本"""
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        return text
+
+
+# 流式响应中需要解码处理的事件，message_file、ping等其他事件不解码直接跳过
+STREAM_EVENTS = {"message", "message_end", "error"}
+# 各类型应用需要处理的流式事件，工作流只处理文本片段与运行结果
+APP_STREAM_EVENTS = {
+    "chat": STREAM_EVENTS,
+    "completion": STREAM_EVENTS,
+    "workflow": {"text_chunk", "workflow_finished", "error"},
+}
+
+
+def _select_compaction(rows, max_chats: int, ttl: float, keep) -> dict:
+    """rows为按更新时间倒序排列的 (chat_id, updated_at)，选出需要删除的聊天"""
+    expired, over_limit = [], []
+    cutoff = time.time() - ttl if ttl > 0 else None
+    kept = 0
+    for chat_id, updated_at in rows:
+        if chat_id in keep:
+            kept += 1
+        elif cutoff is not None and updated_at < cutoff:
+            expired.append(chat_id)
+        elif max_chats > 0 and kept >= max_chats:
+            over_limit.append(chat_id)
+        else:
+            kept += 1
+    return {"expired": expired, "over_limit": over_limit}
+
+
+class JsonStateStore:
+    """
+    旧版状态存储：三个JSON文件，每次保存都整体重写
+
+    chat_message_mapping.json 存储了聊天ID与DIFY消息ID的对应关系
+    chat_model.json 存储了每个聊天使用的模型信息
+    file_list.json 存储了上传文件的相关信息
+    """
+
+    def __init__(self, data_cache_dir: str):
+        self.data_cache_dir = data_cache_dir
+        self.chat_mapping_file = os.path.join(data_cache_dir, "chat_message_mapping.json")
+        self.chat_model_file = os.path.join(data_cache_dir, "chat_model.json")
+        self.file_list_file = os.path.join(data_cache_dir, "file_list.json")
+
+    def exists(self) -> bool:
+        return any(
+            os.path.exists(path)
+            for path in (self.chat_mapping_file, self.chat_model_file, self.file_list_file)
+        )
+
+    def load_all(self):
+        """返回 (chat_message_mapping, dify_chat_model, dify_file_list)"""
+        return (
+            self._load(self.chat_mapping_file),
+            self._load(self.chat_model_file),
+            self._load(self.file_list_file),
+        )
+
+    def load_chat(self, chat_id: str):
+        """查询单个聊天，返回 (mapping, model, file_list)，不存在时返回None；需要读取全部文件"""
+        chat_message_mapping, dify_chat_model, dify_file_list = self.load_all()
+        if chat_id not in chat_message_mapping and chat_id not in dify_chat_model:
+            return None
+        return (
+            chat_message_mapping.get(chat_id),
+            dify_chat_model.get(chat_id),
+            dify_file_list.get(chat_id),
+        )
+
+    def save_all(self, chat_message_mapping: dict, dify_chat_model: dict, dify_file_list: dict):
+        # 内存中只缓存了部分聊天，先与文件中已有的内容合并再整体重写
+        stored_mapping, stored_model, stored_file_list = self.load_all()
+        now = time.time()
+        for chat_id, mapping in chat_message_mapping.items():
+            stored_mapping[chat_id] = dict(mapping, updated_at=now)
+        stored_model.update(dify_chat_model)
+        stored_file_list.update(dify_file_list)
+        # exist_ok=True 表示如果目录已存在也不会报错
+        os.makedirs(self.data_cache_dir, exist_ok=True)
+        self._dump(self.chat_mapping_file, stored_mapping)
+        self._dump(self.chat_model_file, stored_model)
+        self._dump(self.file_list_file, stored_file_list)
+
+    def save_chat(self, chat_id: str, chat_message_mapping: dict, dify_chat_model: dict, dify_file_list: dict):
+        # JSON文件无法局部更新，只能整体重写
+        self.save_all(
+            {chat_id: chat_message_mapping[chat_id]} if chat_id in chat_message_mapping else {},
+            {chat_id: dify_chat_model[chat_id]} if chat_id in dify_chat_model else {},
+            {chat_id: dify_file_list[chat_id]} if chat_id in dify_file_list else {},
+        )
+
+    def compact(self, max_chats: int = 0, ttl: float = 0, keep=()) -> dict:
+        """
+        删除空闲超过ttl秒以及超出max_chats的最旧聊天，keep中的聊天不删除
+
+        Returns:
+            dict: {"expired": [chat_id...], "over_limit": [chat_id...]}
+        """
+        chat_message_mapping, dify_chat_model, dify_file_list = self.load_all()
+        # 旧版文件中没有更新时间的聊天视为最旧
+        ordered = sorted(chat_message_mapping, key=lambda c: chat_message_mapping[c].get("updated_at", 0), reverse=True)
+        removed = _select_compaction(
+            [(chat_id, chat_message_mapping[chat_id].get("updated_at", 0)) for chat_id in ordered],
+            max_chats, ttl, keep,
+        )
+        if removed["expired"] or removed["over_limit"]:
+            for chat_id in removed["expired"] + removed["over_limit"]:
+                chat_message_mapping.pop(chat_id, None)
+                dify_chat_model.pop(chat_id, None)
+                dify_file_list.pop(chat_id, None)
+            self._dump(self.chat_mapping_file, chat_message_mapping)
+            self._dump(self.chat_model_file, dify_chat_model)
+            self._dump(self.file_list_file, dify_file_list)
+        return removed
+
+    def _load(self, path: str) -> dict:
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _dump(self, path: str, value: dict):
+        # ensure_ascii=False 允许写入非ASCII字符（如中文），indent=2 使JSON文件更易读
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False, indent=2)
+
+
+class SQLiteStateStore:
+    """
+    SQLite状态存储，每个聊天一行，以chat_id为主键按聊天增量upsert
+
+    首次打开时，如果目录中存在旧版JSON状态文件，会一次性导入
+    """
+
+    def __init__(self, data_cache_dir: str, db_name: str = "dify_state.db"):
+        self.data_cache_dir = data_cache_dir
+        os.makedirs(data_cache_dir, exist_ok=True)
+        self.db_path = os.path.join(data_cache_dir, db_name)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chat_state (
+                    chat_id TEXT PRIMARY KEY,
+                    model TEXT,
+                    conversation_id TEXT,
+                    messages TEXT NOT NULL DEFAULT '[]',
+                    file_list TEXT NOT NULL DEFAULT '{}',
+                    turn_offset INTEGER NOT NULL DEFAULT 0,
+                    backend TEXT,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chat_state)")}
+            if "turn_offset" not in columns:
+                self._conn.execute("ALTER TABLE chat_state ADD COLUMN turn_offset INTEGER NOT NULL DEFAULT 0")
+            if "backend" not in columns:
+                self._conn.execute("ALTER TABLE chat_state ADD COLUMN backend TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_state_updated_at ON chat_state(updated_at)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._migrate_json()
+
+    def load_all(self):
+        """返回 (chat_message_mapping, dify_chat_model, dify_file_list)"""
+        chat_message_mapping, dify_chat_model, dify_file_list = {}, {}, {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id, model, conversation_id, messages, file_list, turn_offset, backend FROM chat_state"
+            ).fetchall()
+        for row in rows:
+            self._unpack(row, chat_message_mapping, dify_chat_model, dify_file_list)
+        return chat_message_mapping, dify_chat_model, dify_file_list
+
+    def load_chat(self, chat_id: str):
+        """按chat_id查询单个聊天，返回 (mapping, model, file_list)，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chat_id, model, conversation_id, messages, file_list, turn_offset, backend FROM chat_state WHERE chat_id = ?",
+                (chat_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        chat_message_mapping, dify_chat_model, dify_file_list = {}, {}, {}
+        self._unpack(row, chat_message_mapping, dify_chat_model, dify_file_list)
+        return (
+            chat_message_mapping.get(chat_id),
+            dify_chat_model.get(chat_id),
+            dify_file_list.get(chat_id),
+        )
+
+    def save_chat(self, chat_id: str, chat_message_mapping: dict, dify_chat_model: dict, dify_file_list: dict):
+        """只写入一个聊天的状态"""
+        with self._lock, self._conn:
+            self._upsert(chat_id, chat_message_mapping, dify_chat_model, dify_file_list)
+
+    def save_all(self, chat_message_mapping: dict, dify_chat_model: dict, dify_file_list: dict):
+        chat_ids = set(chat_message_mapping) | set(dify_chat_model) | set(dify_file_list)
+        with self._lock, self._conn:
+            for chat_id in chat_ids:
+                self._upsert(chat_id, chat_message_mapping, dify_chat_model, dify_file_list)
+
+    def _upsert(self, chat_id: str, chat_message_mapping: dict, dify_chat_model: dict, dify_file_list: dict):
+        mapping = chat_message_mapping.get(chat_id) or {}
+        self._conn.execute(
+            """
+            INSERT INTO chat_state (chat_id, model, conversation_id, messages, file_list, turn_offset, backend, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                model = excluded.model,
+                conversation_id = excluded.conversation_id,
+                messages = excluded.messages,
+                file_list = excluded.file_list,
+                turn_offset = excluded.turn_offset,
+                backend = excluded.backend,
+                updated_at = excluded.updated_at
+            """,
+            (
+                chat_id,
+                dify_chat_model.get(chat_id),
+                mapping.get("dify_conversation_id", ""),
+                json.dumps(mapping.get("messages", []), ensure_ascii=False),
+                json.dumps(dify_file_list.get(chat_id, {}), ensure_ascii=False),
+                mapping.get("turn_offset", 0),
+                mapping.get("backend"),
+                time.time(),
+            ),
+        )
+
+    def _unpack(self, row, chat_message_mapping: dict, dify_chat_model: dict, dify_file_list: dict):
+        chat_id, model, conversation_id, messages, file_list, turn_offset, backend = row
+        chat_message_mapping[chat_id] = {
+            "dify_conversation_id": conversation_id or "",
+            "messages": json.loads(messages),
+        }
+        if turn_offset:
+            chat_message_mapping[chat_id]["turn_offset"] = turn_offset
+        # 聊天固定使用的Dify后端，旧版本保存的聊天没有该字段
+        if backend:
+            chat_message_mapping[chat_id]["backend"] = backend
+        if model is not None:
+            dify_chat_model[chat_id] = model
+        dify_file_list[chat_id] = json.loads(file_list)
+
+    def compact(self, max_chats: int = 0, ttl: float = 0, keep=()) -> dict:
+        """
+        删除空闲超过ttl秒以及超出max_chats的最旧聊天，keep中的聊天不删除
+
+        Returns:
+            dict: {"expired": [chat_id...], "over_limit": [chat_id...]}
+        """
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT chat_id, updated_at FROM chat_state ORDER BY updated_at DESC"
+            ).fetchall()
+            removed = _select_compaction(rows, max_chats, ttl, keep)
+            self._conn.executemany(
+                "DELETE FROM chat_state WHERE chat_id = ?",
+                [(chat_id,) for chat_id in removed["expired"] + removed["over_limit"]],
+            )
+        return removed
+
+    def _migrate_json(self):
+        """一次性导入旧版JSON状态文件，导入后在meta表中记录，不再重复导入"""
+        with self._lock:
+            migrated = self._conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if migrated is not None:
+            return
+        legacy = JsonStateStore(self.data_cache_dir)
+        if legacy.exists():
+            try:
+                chat_message_mapping, dify_chat_model, dify_file_list = legacy.load_all()
+                self.save_all(chat_message_mapping, dify_chat_model, dify_file_list)
+                log.info(f"已从JSON状态文件迁移 {len(chat_message_mapping)} 个聊天到 {self.db_path}")
+            except Exception as e:
+                log.error(f"迁移Dify JSON状态文件失败: {e}")
+                return
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (str(time.time()),))
+
+
+def get_state_store(backend: str, data_cache_dir: str):
+    """按后端名称获取状态存储：sqlite（默认）或 json（旧版）"""
+    if backend == "json":
+        return JsonStateStore(data_cache_dir)
+    if backend != "sqlite":
+        raise ValueError(f"不支持的状态存储后端: {backend}")
+    return get_shared(
+        f"state_store@v{SHARED_CODE_VERSION}:sqlite:{os.path.abspath(data_cache_dir)}",
+        lambda: SQLiteStateStore(data_cache_dir),
+    )
+
+
+# 图片魔数 -> (MIME类型, 扩展名)
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png", "png"),
+    (b"\xff\xd8\xff", "image/jpeg", "jpg"),
+    (b"GIF87a", "image/gif", "gif"),
+    (b"GIF89a", "image/gif", "gif"),
+]
+
+
+def sniff_image_type(head: bytes, default: str = "image/png"):
+    """根据文件头的魔数判断图片类型，返回 (MIME类型, 扩展名)"""
+    for signature, mime_type, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type, extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    stripped = head.lstrip()
+    if stripped.startswith(b"<svg") or stripped.startswith(b"<?xml"):
+        return "image/svg+xml", "svg"
+    return default, default.rsplit("/", 1)[-1].split("+", 1)[0]
+
+
+class Base64Reader(io.RawIOBase):
+    """
+    按块解码base64字符串（可带data URL前缀）的只读文件对象
+
+    不复制整个base64字符串，也不生成完整的解码副本，每次只解码一块；
+    允许换行等空白（如按76字符折行的base64），每块去掉空白后补齐到4个有效字符的整数倍再解码
+    """
+
+    def __init__(self, data: str, chunk_chars: int = 256 * 1024):
+        self._data = data
+        self._start = data.index(",") + 1 if data.startswith("data:") else 0
+        self._chunk_chars = max(chunk_chars - chunk_chars % 4, 4)
+        self.declared_type = data[5:data.index(";")] if data.startswith("data:") and ";" in data[:self._start] else None
+        self.seek(0)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # 只支持回到开头，用于重复读取（先计算哈希再上传）
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Base64Reader只支持seek(0)")
+        self._pos = self._start
+        self._buffer = b""
+        self._offset = 0
+        self._position = 0
+        return 0
+
+    def readinto(self, b) -> int:
+        while self._offset >= len(self._buffer):
+            if self._pos >= len(self._data):
+                return 0
+            chunk = self._data[self._pos:self._pos + self._chunk_chars]
+            self._pos += len(chunk)
+            # 空白不计入base64的4字符分组，去掉后向后补齐，保证每块在分组边界上结束
+            chunk = "".join(chunk.split())
+            while len(chunk) % 4 and self._pos < len(self._data):
+                char = self._data[self._pos]
+                self._pos += 1
+                if not char.isspace():
+                    chunk += char
+            self._buffer = base64.b64decode(chunk)
+            self._offset = 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        self._position += n
+        return n
+
+    def decoded_size(self) -> int:
+        """解码后的字节数（按base64长度和填充计算，不解码），数据中有空白时为上限"""
+        data = self._data.rstrip()
+        length = len(data) - self._start
+        padding = len(data) - len(data.rstrip("="))
+        return length * 3 // 4 - padding
+
+    def read_all(self) -> bytearray:
+        """一次性读出全部内容到预分配的缓冲区，只产生一份解码副本"""
+        self.seek(0)
+        buffer = bytearray(self.decoded_size())
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(buffer):
+            n = self.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        del view
+        if filled < len(buffer):
+            del buffer[filled:]
+        return buffer
+
+    def digest(self):
+        """流式计算解码后内容的SHA-256和文件头，返回 (sha256, 前32字节)，完成后回到开头"""
+        sha256 = hashlib.sha256()
+        head = b""
+        self.seek(0)
+        while True:
+            chunk = self.read(self._chunk_chars)
+            if not chunk:
+                break
+            if len(head) < 32:
+                head += chunk[:32 - len(head)]
+            sha256.update(chunk)
+        self.seek(0)
+        return sha256.hexdigest(), head
+
+
+class UploadCache:
+    """
+    按内容寻址的上传缓存：内容SHA-256 + Dify用户 -> Dify返回的上传结果
+
+    Args:
+        max_size: 最多缓存的条目数(LRU)，<=0 表示禁用
+        ttl: 条目有效期(秒)，应与Dify的文件保留时间一致
+    """
+
+    def __init__(self, max_size: int = 512, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def get_upload_cache(valves) -> UploadCache:
+    """获取进程内共享的上传缓存，两个Pipe配置相同则共用"""
+    return get_shared(
+        f"upload_cache@v{SHARED_CODE_VERSION}:{valves.UPLOAD_CACHE_SIZE}:{valves.UPLOAD_CACHE_TTL}",
+        lambda: UploadCache(valves.UPLOAD_CACHE_SIZE, valves.UPLOAD_CACHE_TTL),
+    )
+
+
+def upload_cache_key(backend: "DifyBackend", digest: str, user_id: str) -> str:
+    """上传文件ID只在同一Dify后端（地址与API Key）和用户下有效，缓存键包含后端与用户"""
+    return f"{backend.id}:{user_id}:{digest}"
+
+
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """分块计算文件的SHA-256，不把整个文件读入内存"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MultipartFileStream(io.RawIOBase):
+    """
+    流式multipart/form-data请求体：若干文本字段 + 一个从磁盘按块读取的文件字段
+
+    实现了 __len__，requests 据此带上Content-Length并逐块读取发送，
+    不会像 files= 那样先把整个文件拼进内存中的请求体
+
+    Args:
+        fields: 文本字段，如 {"user": "xxx"}
+        file_field: 文件字段名
+        file_name: 上传时使用的文件名
+        file_path: 本地文件路径
+        content_type: 文件的Content-Type
+        progress: 进度回调 progress(已发送文件字节数, 文件总字节数)
+    """
+
+    def __init__(self, fields: dict, file_field: str, file_name: str, file_path: str,
+                 content_type: str = "application/octet-stream", progress=None):
+        self.boundary = os.urandom(16).hex()
+        head = "".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{self._quote(name)}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{self._quote(file_field)}"; '
+            f'filename="{self._quote(file_name)}"\r\nContent-Type: {content_type}\r\n\r\n'
+        )
+        self._head = head.encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._file = open(file_path, "rb")
+        self.file_size = os.fstat(self._file.fileno()).st_size
+        self._progress = progress
+        self.seek(0)
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        # 与urllib3一致的HTML5风格转义
+        return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self.file_size + len(self._tail)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # 只支持回到开头，用于失败后重发
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("MultipartFileStream只支持seek(0)")
+        self._file.seek(0)
+        self._position = 0
+        self._sent = 0
+        return 0
+
+    def readinto(self, b) -> int:
+        head_len = len(self._head)
+        if self._position < head_len:
+            data = self._head[self._position:self._position + len(b)]
+        elif self._position < head_len + self.file_size:
+            data = self._file.read(min(len(b), head_len + self.file_size - self._position))
+            self._sent += len(data)
+            if self._progress is not None and data:
+                self._progress(self._sent, self.file_size)
+        else:
+            start = self._position - head_len - self.file_size
+            data = self._tail[start:start + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._position += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def upload_progress_reporter(event_emitter, loop, file_name: str, step: float = 0.1):
+    """
+    生成上传进度回调，把进度以status事件发给open-webui
+
+    上传在工作线程中进行，回调通过 run_coroutine_threadsafe 提交到事件循环；
+    每前进 step 比例才发送一次，避免刷屏。没有可用的事件循环时返回None
+    """
+    if event_emitter is None or loop is None:
+        return None
+    reported = [-1.0]
+
+    def report(sent: int, total: int):
+        ratio = sent / total if total else 1.0
+        done = sent >= total
+        if not done and ratio - reported[0] < step:
+            return
+        reported[0] = ratio
+        description = f"正在上传 {file_name}: {ratio:.0%}" if not done else f"{file_name} 上传完成"
+        asyncio.run_coroutine_threadsafe(
+            event_emitter({"type": "status", "data": {"description": description, "done": done}}), loop
+        )
+
+    return report
+
+
+def run_concurrently(calls: list, limit: int) -> list:
+    """
+    用线程池并发执行无参调用，按调用顺序返回结果，异常作为结果返回而不抛出
+
+    Args:
+        calls: 无参可调用对象列表
+        limit: 最大并发数
+    """
+    def call(func):
+        try:
+            return func()
+        except Exception as e:
+            return e
+
+    if len(calls) <= 1 or limit <= 1:
+        return [call(func) for func in calls]
+    # 每个任务复制当前上下文，工作线程沿用本请求的日志采样结果
+    tasks = [partial(contextvars.copy_context().run, call, func) for func in calls]
+    with ThreadPoolExecutor(max_workers=min(limit, len(calls))) as executor:
+        return list(executor.map(lambda task: task(), tasks))
+
+
+async def iterate_in_thread(iterator) -> AsyncGenerator:
+    """
+    把阻塞的同步迭代器转换为异步生成器，每一项都在工作线程中读取
+
+    open-webui 在事件循环线程中直接遍历同步迭代器，阻塞读取期间事件循环无法运行，
+    从工作线程提交的状态事件要等到下一段内容输出后才会发出
+    """
+    done = object()
+    try:
+        while True:
+            item = await asyncio.to_thread(next, iterator, done)
+            if item is done:
+                break
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+
+class AttachmentQueue:
+    """
+    附件队列：Filter.inlet 按聊天（无chat_id时按用户）放入文件信息，Pipe 取出后上传
+
+    默认只在进程内存中传递，不产生文件读写；spill_path 非空时改为写入该SQLite文件，
+    用于 open-webui 多进程部署时在进程间传递。超过 ttl 秒未被取走的附件会被丢弃。
+    """
+
+    def __init__(self, ttl: float = 600, spill_path: str = ""):
+        self.ttl = ttl
+        self.spill_path = spill_path
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if spill_path:
+            os.makedirs(os.path.dirname(spill_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(spill_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS attachments ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_attachments_key ON attachments(key)")
+
+    def put(self, key: str, file_info: dict):
+        now = time.time()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM attachments WHERE created_at < ?", (now - self.ttl,))
+                self._conn.execute(
+                    "INSERT INTO attachments (key, payload, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(file_info, ensure_ascii=False), now),
+                )
+                return
+            # 顺带清理已过期的队列
+            for stale in [k for k, q in self._queues.items() if q[-1][0] < now - self.ttl]:
+                del self._queues[stale]
+            self._queues.setdefault(key, deque()).append((now, file_info))
+
+    def pop_all(self, key: str) -> List[dict]:
+        """取出该键下所有未过期的附件，按放入顺序返回"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            if self._conn is not None:
+                # BEGIN IMMEDIATE 保证多个进程不会取到同一批附件
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = self._conn.execute(
+                        "SELECT payload, created_at FROM attachments WHERE key = ? ORDER BY seq", (key,)
+                    ).fetchall()
+                    self._conn.execute("DELETE FROM attachments WHERE key = ?", (key,))
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                return [json.loads(payload) for payload, created_at in rows if created_at >= cutoff]
+            queue = self._queues.pop(key, None)
+        if not queue:
+            return []
+        return [file_info for created_at, file_info in queue if created_at >= cutoff]
+
+
+def get_attachment_queue(spill_path: str = "") -> AttachmentQueue:
+    """获取 Filter 与 Pipe 共用的附件队列，两边的 ATTACHMENT_SPILL_PATH 需保持一致"""
+    return get_shared(
+        f"attachment_queue@v{SHARED_CODE_VERSION}:{spill_path}", lambda: AttachmentQueue(spill_path=spill_path)
+    )
+
+
+class PreuploadRegistry:
+    """
+    Filter 后台预上传任务登记表：预上传键 -> concurrent.futures.Future（结果为Dify上传响应）
+
+    只在进程内有效，Pipe 取不到时回退为直接上传
+    """
+
+    def __init__(self, ttl: float = 600):
+        self.ttl = ttl
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def put(self, key: str, future):
+        now = time.time()
+        with self._lock:
+            for stale in [k for k, (created_at, _) in self._futures.items() if created_at < now - self.ttl]:
+                del self._futures[stale]
+            self._futures[key] = (now, future)
+
+    def pop(self, key: str):
+        with self._lock:
+            entry = self._futures.pop(key, None)
+        return entry[1] if entry is not None else None
+
+
+def get_preupload_registry() -> PreuploadRegistry:
+    return get_shared(f"preupload_registry@v{SHARED_CODE_VERSION}", PreuploadRegistry)
+
+
+def preupload_key(file_server: str, dify_key: str, user_id: str, file_name: str) -> str:
+    """上传文件ID只在同一Dify应用和用户下有效，预上传键包含上传地址与API Key摘要"""
+    app = hashlib.sha256(f"{file_server}|{dify_key}".encode("utf-8")).hexdigest()[:16]
+    return f"{app}:{user_id}:{file_name}"
+
+
+class DifyClient:
+    """
+    单个Dify后端的API客户端
+
+    统一构建地址与请求头，经共享连接池发送请求，负责重试、熔断、首字节延迟统计、SSE解析与文件上传；
+    dify_pipe 与 dify_Workflow 中的副本保持一致（tests/test_shared_copies.py 会检查），Pipe只负责open-webui消息与Dify载荷之间的转换；
+    客户端本身不放入 _dify_shared，每次请求用本文件的类创建。注册表中的连接池、熔断器等对象是先创建它的文件中的类的实例，
+    名称带有 SHARED_CODE_VERSION，两个函数单独更新后版本不同时各自创建实例，不会调用到旧实现
+
+    Args:
+        backend: 请求发往的后端
+        http: 共享的连接池会话
+        retry: 重试策略
+        breaker: breaker(url) -> CircuitBreaker
+        balancer: 记录首字节延迟的负载均衡器，为None时不记录
+        timeout: 接口请求的 (连接超时, 读取超时)
+        upload_timeout: 文件上传的 (连接超时, 读取超时)
+        metrics: 记录耗时、流量与上传指标的注册表，为None时不记录
+        labels: 指标的标签，如 {"app": 模型ID}
+    """
+
+    def __init__(self, backend: DifyBackend, http: PooledSession, retry: RetryPolicy, breaker,
+                 balancer: Optional[BackendBalancer] = None, timeout=(3.05, 60), upload_timeout=(5, 30),
+                 metrics: Optional[Metrics] = None, labels: Optional[dict] = None):
+        self.backend = backend
+        self.http = http
+        self.retry = retry
+        self.breaker = breaker
+        self.balancer = balancer
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.metrics = metrics
+        self.labels = labels or {}
+
+    def url(self, path: str) -> str:
+        return f"{self.backend.base_url}/{path.lstrip('/')}"
+
+    def headers(self, content_type: Optional[str] = "application/json") -> dict:
+        headers = {"Authorization": f"Bearer {self.backend.key}"}
+        if content_type:
+            headers["content-type"] = content_type
+        return headers
+
+    def file_url(self, url: str) -> str:
+        """Dify返回的相对文件地址补全为后端的地址（去掉末尾的 /v1）"""
+        if url.startswith("/"):
+            return f"{re.sub(r'/v1$', '', self.backend.base_url)}{url}"
+        return url
+
+    def observe(self, start: float):
+        """记录首字节延迟，供ewma策略与指标使用"""
+        elapsed = time.perf_counter() - start
+        if self.balancer is not None:
+            self.balancer.observe(self.backend, elapsed * 1000)
+        if self.metrics is not None:
+            self.metrics.observe("dify_ttfb_seconds", elapsed, self.labels)
+
+    def record_stream(self, start: float, events: int, size: int):
+        """记录一次流式响应的总耗时、事件数与字节数"""
+        if self.metrics is not None:
+            self.metrics.observe("dify_stream_duration_seconds", time.perf_counter() - start, self.labels)
+            self.metrics.observe("dify_stream_events", events, self.labels)
+            self.metrics.observe("dify_stream_bytes", size, self.labels)
+
+    def record_upload(self, start: float, size: int):
+        if self.metrics is not None:
+            self.metrics.observe("dify_upload_seconds", time.perf_counter() - start, self.labels)
+            self.metrics.observe("dify_upload_bytes", size, self.labels)
+
+    def post(self, path: str, payload: dict, stream: bool = False) -> requests.Response:
+        """POST JSON载荷并返回响应；流式请求只在收到响应头之前重试，开始输出后不再重发"""
+        url = self.url(path)
+        headers = self.headers()
+        start = time.perf_counter()
+        response = self.retry.call(
+            lambda: self.http.post(url, headers=headers, json=payload, stream=stream, timeout=self.timeout),
+            url,
+            self.breaker(url),
+        )
+        self.observe(start)
+        return response
+
+    def post_json(self, path: str, payload: dict) -> dict:
+        """阻塞模式调用，返回解析后的JSON"""
+        response = self.post(path, payload)
+        if response.status_code != 200:
+            raise Exception(f"HTTP Error {response.status_code}: {response.text}")
+        return response.json()
+
+    def get_json(self, path: str) -> dict:
+        url = self.url(path)
+        headers = self.headers(None)
+        response = self.retry.call(
+            lambda: self.http.get(url, headers=headers, timeout=self.timeout), url, self.breaker(url)
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def stream_events(self, path: str, payload: dict, events=None) -> Iterator[SSEEvent]:
+        """流式调用，逐个产出SSE事件；events为需要解码的事件名集合，其余事件只计数"""
+        start = time.perf_counter()
+        response = self.post(path, payload, stream=True)
+        counts = [0, 0]
+
+        def chunks():
+            for chunk in response.iter_content(chunk_size=None):
+                counts[1] += len(chunk)
+                yield chunk
+
+        with response:
+            if response.status_code != 200:
+                raise Exception(f"HTTP Error {response.status_code}: {response.text}")
+            try:
+                for sse in iter_sse_events(chunks()):
+                    counts[0] += 1
+                    if events is None or sse.event in events:
+                        yield sse
+            finally:
+                self.record_stream(start, *counts)
+
+    def upload(self, user_id: str, file_name: str, file, mime_type: str) -> dict:
+        """
+        以multipart/form-data上传内存中的数据或文件对象，返回服务器响应
+
+        Args:
+            file: bytes/bytearray 或可读的文件对象，重试时从头重发
+        """
+        files = {
+            "file": (file_name, file, mime_type),
+            "user": (None, user_id),
+        }
+
+        def send():
+            if hasattr(file, "seek"):
+                file.seek(0)
+            return self.http.post(self.backend.file_server, headers=self.headers(None), files=files, timeout=self.upload_timeout)
+
+        start = time.perf_counter()
+        result = self._upload_result(self.retry.call(send, f"上传 {file_name}", self.breaker(self.backend.file_server)))
+        self.record_upload(start, self.size_of(file))
+        return result
+
+    def upload_path(self, user_id: str, file_path: str, file_name: Optional[str] = None,
+                    mime_type: str = "application/octet-stream", progress=None) -> dict:
+        """
+        上传本地文件，文件内容按块从磁盘读取发送，不整体读入内存
+
+        Args:
+            file_name: 上传时使用的文件名，默认为本地文件名
+            progress: 进度回调 progress(已发送字节数, 文件总字节数)
+        """
+        file_name = file_name or os.path.basename(file_path)
+        with MultipartFileStream({"user": user_id}, "file", file_name, file_path, mime_type, progress) as body:
+            headers = self.headers(body.content_type)
+
+            def send():
+                # 重试时从头重发文件
+                body.seek(0)
+                return self.http.post(self.backend.file_server, headers=headers, data=body, timeout=self.upload_timeout)
+
+            start = time.perf_counter()
+            result = self._upload_result(self.retry.call(send, f"上传 {file_name}", self.breaker(self.backend.file_server)))
+            self.record_upload(start, body.file_size)
+            return result
+
+    @staticmethod
+    def size_of(file) -> int:
+        """内存数据或文件对象的字节数，无法确定时为0"""
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            return len(file)
+        try:
+            return os.fstat(file.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return 0
+
+    @staticmethod
+    def _upload_result(response: requests.Response) -> dict:
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            error_msg = f"HTTP错误: {response.status_code}"
+            if response.headers.get("content-type") == "application/json":
+                error_msg += f" - {response.json().get('message', '')}"
+            log.error(error_msg)
+            raise
+        result = response.json()
+        if "id" not in result:
+            raise ValueError(f"服务器响应格式无效: {result}")
+        return result
+
+
+class AsyncDifyClient(DifyClient):
+    """
+    DifyClient 的aiohttp版本，接口调用不占用线程
+
+    Args:
+        session: 当前事件循环的aiohttp会话，其余参数同DifyClient；
+            磁盘文件的流式上传仍在工作线程中使用同步实现
+    """
+
+    def __init__(self, backend: DifyBackend, http: PooledSession, session: "aiohttp.ClientSession", retry: RetryPolicy,
+                 breaker, balancer: Optional[BackendBalancer] = None, timeout=(3.05, 60), upload_timeout=(5, 30),
+                 metrics: Optional[Metrics] = None, labels: Optional[dict] = None):
+        super().__init__(backend, http, retry, breaker, balancer, timeout, upload_timeout, metrics, labels)
+        self.session = session
+
+    @staticmethod
+    def _client_timeout(timeout) -> "aiohttp.ClientTimeout":
+        return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+
+    async def post_async(self, path: str, payload: dict) -> "aiohttp.ClientResponse":
+        """POST JSON载荷并返回响应，调用方负责用 async with 释放"""
+        url = self.url(path)
+        headers = self.headers()
+        timeout = self._client_timeout(self.timeout)
+        start = time.perf_counter()
+        response = await retry_async(
+            self.retry, lambda: self.session.post(url, headers=headers, json=payload, timeout=timeout), url, self.breaker(url)
+        )
+        self.observe(start)
+        return response
+
+    async def post_json_async(self, path: str, payload: dict) -> dict:
+        async with await self.post_async(path, payload) as response:
+            if response.status != 200:
+                raise Exception(f"HTTP Error {response.status}: {await response.text()}")
+            return await response.json(content_type=None)
+
+    async def stream_events_async(self, path: str, payload: dict, events=None) -> AsyncGenerator[SSEEvent, None]:
+        start = time.perf_counter()
+        counts = [0, 0]
+
+        async def chunks(response):
+            async for chunk in response.content.iter_any():
+                counts[1] += len(chunk)
+                yield chunk
+
+        async with await self.post_async(path, payload) as response:
+            if response.status != 200:
+                raise Exception(f"HTTP Error {response.status}: {await response.text()}")
+            try:
+                async for sse in aiter_sse_events(chunks(response)):
+                    counts[0] += 1
+                    if events is None or sse.event in events:
+                        yield sse
+            finally:
+                self.record_stream(start, *counts)
+
+    async def upload_async(self, user_id: str, file_name: str, file_data, mime_type: str) -> dict:
+        """以multipart/form-data异步上传内存中的数据或文件对象，返回服务器响应"""
+        url = self.backend.file_server
+        headers = self.headers(None)
+        timeout = self._client_timeout(self.upload_timeout)
+
+        def send():
+            # FormData只能发送一次，每次重试都重新构建
+            if hasattr(file_data, "seek"):
+                file_data.seek(0)
+            form = aiohttp.FormData()
+            form.add_field("file", file_data, filename=file_name, content_type=mime_type)
+            form.add_field("user", user_id)
+            return self.session.post(url, headers=headers, data=form, timeout=timeout)
+
+        # aiohttp发送后会关闭文件对象，大小需要提前取得
+        size = self.size_of(file_data)
+        start = time.perf_counter()
+        response = await retry_async(self.retry, send, f"上传 {file_name}", self.breaker(url))
+        async with response:
+            if response.status >= 400:
+                error_msg = f"HTTP错误: {response.status} - {await response.text()}"
+                log.error(error_msg)
+                raise aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status, message=error_msg
+                )
+            result = await response.json(content_type=None)
+        if "id" not in result:
+            raise ValueError(f"服务器响应格式无效: {result}")
+        self.record_upload(start, size)
+        return result
+
+    async def upload_path_async(self, user_id: str, file_path: str, file_name: Optional[str] = None,
+                                mime_type: str = "application/octet-stream", progress=None) -> dict:
+        # aiohttp对自定义文件对象无法给出Content-Length，会退化为分块传输编码，这里复用同步的流式实现
+        return await asyncio.to_thread(self.upload_path, user_id, file_path, file_name, mime_type, progress)
+
+
+# Dify应用类型：/info 返回的mode -> 调用方式
+APP_MODES = {
+    "chat": "chat",
+    "advanced-chat": "chat",
+    "agent-chat": "chat",
+    "completion": "completion",
+    "workflow": "workflow",
+}
+
+
+class DifyApp:
+    """
+    注册表中的一个Dify应用
+
+    Args:
+        app_id: 模型ID（open-webui中显示为 函数ID.app_id）
+        key: 应用的API Key
+        mode: chat、completion 或 workflow，为空时按 /info 返回的类型判断
+        base_url: 应用所在的Dify地址，为空时使用Pipe配置的后端（DIFY_BACKENDS或DIFY_BASE_URL）
+        name: 显示名称，为空时使用 /info 返回的应用名称
+    """
+
+    def __init__(self, app_id: str, key: str, mode: str = "", base_url: str = "", name: str = ""):
+        self.id = app_id
+        self.key = key
+        self.declared_mode = APP_MODES.get(mode, "") if mode else ""
+        self.base_url = base_url.rstrip("/")
+        self.name = name or app_id
+        self.fixed_name = bool(name)
+        self.info = {}
+        self.parameters = {}
+
+    @property
+    def mode(self) -> str:
+        return self.declared_mode or APP_MODES.get(self.info.get("mode", ""), "chat")
+
+    @property
+    def query_variable(self) -> str:
+        """completion与workflow应用中承载用户输入的变量：/parameters 中第一个文本类输入，默认为query"""
+        for field in self.parameters.get("user_input_form", []) or []:
+            for kind in ("paragraph", "text-input"):
+                if isinstance(field, dict) and kind in field and field[kind].get("variable"):
+                    return field[kind]["variable"]
+        return "query"
+
+    def update(self, info: Optional[dict], parameters: Optional[dict]):
+        if info:
+            self.info = info
+            if not self.fixed_name and info.get("name"):
+                self.name = info["name"]
+        if parameters:
+            self.parameters = parameters
+
+    @property
+    def needs_info(self) -> bool:
+        """已声明名称的对话应用不需要从Dify获取信息"""
+        return not (self.declared_mode == "chat" and self.fixed_name)
+
+    def to_model(self) -> dict:
+        return {"id": self.id, "name": self.name}
+
+
+def parse_apps(valves) -> List[DifyApp]:
+    """
+    解析DIFY_APPS：每行（或用分号分隔）一个应用，格式为 模型ID|API Key|类型|地址|名称，
+    类型、地址与名称可省略；未配置时只有由DIFY_MODLE_ID、DIFY_KEY与DIFY_WORKFLOW构成的对话应用
+    """
+    apps = []
+    for line in re.split(r"[;\n]+", valves.DIFY_APPS):
+        parts = [part.strip() for part in line.split("|")] + [""] * 4
+        if not parts[0] or not parts[1]:
+            continue
+        apps.append(DifyApp(parts[0], parts[1], parts[2], parts[3], parts[4]))
+    if not apps:
+        apps.append(DifyApp(valves.DIFY_MODLE_ID, valves.DIFY_KEY, "chat", name=valves.DIFY_WORKFLOW))
+    return apps
+
+
+class DifyAppRegistry:
+    """
+    一个Pipe对外提供的全部Dify应用
+
+    应用信息（名称、类型、输入变量）从 /info 与 /parameters 获取并缓存，
+    首次获取与过期后的刷新都在后台线程中进行，期间返回配置中的ID与名称或缓存的信息，
+    open-webui 在事件循环中调用 pipes()，不能等待Dify应答
+
+    Args:
+        apps: 应用列表
+        refresh_interval: 应用信息的刷新间隔(秒)，<=0 表示不从Dify获取
+    """
+
+    def __init__(self, apps: List[DifyApp], refresh_interval: float = 600):
+        self.apps = OrderedDict((app.id, app) for app in apps)
+        self.refresh_interval = refresh_interval
+        self.refreshed_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def get(self, app_id: str) -> Optional[DifyApp]:
+        return self.apps.get(app_id)
+
+    def models(self, fetch) -> List[dict]:
+        """返回open-webui的模型列表，按需刷新应用信息"""
+        self.refresh_if_stale(fetch)
+        return [app.to_model() for app in self.apps.values()]
+
+    def refresh_if_stale(self, fetch):
+        if self.refresh_interval <= 0:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            if self.refreshed_at is not None and time.monotonic() - self.refreshed_at < self.refresh_interval:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, args=(fetch,), name="dify-app-refresh", daemon=True).start()
+
+    def wait_ready(self, fetch, timeout: float) -> bool:
+        """需要应用信息的请求（未声明类型）等待首次获取完成，最多timeout秒，返回是否已完成"""
+        if self.refresh_interval <= 0:
+            return True
+        self.refresh_if_stale(fetch)
+        return self._ready.wait(timeout)
+
+    def refresh(self, fetch):
+        """
+        并发获取全部应用的信息
+
+        Args:
+            fetch: fetch(app) -> (info, parameters)，失败时抛出异常，保留上次的信息
+        """
+        try:
+            apps = [app for app in self.apps.values() if app.needs_info]
+            results = run_concurrently([partial(fetch, app) for app in apps], 8)
+            for app, result in zip(apps, results):
+                if isinstance(result, Exception):
+                    log.warning(f"获取Dify应用 {app.id} 信息失败: {result}")
+                    continue
+                app.update(*result)
+        finally:
+            with self._lock:
+                self.refreshed_at = time.monotonic()
+                self._refreshing = False
+            self._ready.set()
+
+
+def get_app_registry(valves) -> DifyAppRegistry:
+    """按应用配置获取共享的应用注册表"""
+    config = f"{valves.DIFY_APPS}|{valves.DIFY_MODLE_ID}|{valves.DIFY_KEY}|{valves.DIFY_WORKFLOW}"
+    key = f"app_registry@v{SHARED_CODE_VERSION}:{hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]}:{valves.APP_REFRESH_INTERVAL}"
+    return get_shared(key, lambda: DifyAppRegistry(parse_apps(valves), valves.APP_REFRESH_INTERVAL))
+
+
 #从__event_emitter__中获取闭包变量
 def get_closure_info(func):
     # 获取函数的闭包变量
@@ -44,6 +2217,62 @@ class Pipe:
         FILE_SERVER: str = Field(default="http://192.168.1.4/v1/files/upload")
         DIFY_WORKFLOW: str = Field(default="Dify_API_GPT4o")
         DIFY_MODLE_ID: str = Field(default="dify_id")
+        # 多后端负载均衡
+        DIFY_BACKENDS: str = Field(
+            default="",
+            description="多个Dify后端，每行或用分号分隔一个，格式：地址|API Key|权重（Key与权重可省略）；为空时只使用DIFY_BASE_URL",
+        )
+        LB_STRATEGY: str = Field(default="round_robin", description="负载均衡策略：round_robin、least_in_flight 或 ewma")
+        # 多应用
+        DIFY_APPS: str = Field(
+            default="",
+            description="同时提供的多个Dify应用，每行或用分号分隔一个，格式：模型ID|API Key|类型(chat/completion/workflow)|地址|名称，后三项可省略；为空时只提供DIFY_MODLE_ID",
+        )
+        APP_REFRESH_INTERVAL: int = Field(default=600, description="从Dify的/info与/parameters刷新应用信息的间隔(秒)，0表示不获取")
+        APP_INFO_TIMEOUT: float = Field(default=5, description="获取应用信息的超时(秒)，不重试；未声明类型的应用在首次获取完成前最多等待这么久")
+        # 连接池
+        POOL_CONNECTIONS: int = Field(default=10, description="缓存的主机连接池数量")
+        POOL_MAXSIZE: int = Field(default=20, description="每个主机的最大连接数")
+        POOL_BLOCK: bool = Field(default=False, description="连接数达到上限时是否阻塞等待")
+        KEEP_ALIVE: bool = Field(default=True, description="是否复用HTTP连接并开启TCP keepalive")
+        # 附件
+        ATTACHMENT_SPILL_PATH: str = Field(default="", description="附件队列的SQLite文件路径，多进程部署时设置，需与Filter一致；为空则只在进程内传递")
+        PREUPLOAD_TIMEOUT: float = Field(default=30, description="等待Filter后台预上传结果的最长时间(秒)，超时后直接上传")
+        # 上传
+        UPLOAD_CONCURRENCY: int = Field(default=4, description="同一轮对话中并发上传附件的数量上限")
+        UPLOAD_PROGRESS: bool = Field(default=True, description="上传本地文档时通过状态栏显示上传进度")
+        # 上传缓存
+        UPLOAD_CACHE_SIZE: int = Field(default=512, description="按内容哈希缓存的上传文件ID数量上限，0表示禁用")
+        UPLOAD_CACHE_TTL: int = Field(default=3600, description="上传缓存有效期(秒)，应与Dify文件保留时间一致")
+        # 重试
+        RETRY_ATTEMPTS: int = Field(default=3, description="上传、阻塞调用及流式首字节前的最多尝试次数（含首次），1表示不重试")
+        RETRY_BASE_DELAY: float = Field(default=0.5, description="指数退避的基数(秒)，第n次重试前随机等待0~基数*2^n秒")
+        RETRY_MAX_DELAY: float = Field(default=10, description="单次重试等待的上限(秒)，Retry-After也不超过该值")
+        RETRY_STATUSES: str = Field(default="429,502,503,504", description="需要重试的HTTP状态码，逗号分隔")
+        # 熔断
+        CIRCUIT_FAILURE_THRESHOLD: int = Field(default=5, description="连续失败多少次后熔断，熔断期间请求直接失败，0表示禁用")
+        CIRCUIT_RESET_TIMEOUT: float = Field(default=30, description="熔断后多久(秒)放行一个探测请求")
+        # 日志
+        LOG_LEVEL: str = Field(default="INFO", description="本函数的日志级别：DEBUG、INFO、WARNING 或 ERROR；DEBUG时输出请求体等调试信息")
+        LOG_MAX_CHARS: int = Field(default=2000, description="单条日志的最大字符数，base64数据与API Key总是被脱敏")
+        LOG_SAMPLE_RATE: float = Field(default=1.0, description="DEBUG日志按请求的采样率(0~1)，高并发时降低以减少日志量")
+        # 指标
+        METRICS_ENABLED: bool = Field(default=True, description="是否记录首字节、首段文本、流式响应、上传等耗时与大小的直方图指标")
+        METRICS_HOST: str = Field(default="127.0.0.1", description="Prometheus指标服务的监听地址")
+        METRICS_PORT: int = Field(default=0, description="在该端口提供 /metrics（Prometheus文本格式），0表示不启动")
+        # 异步
+        ASYNC_MODE: bool = Field(default=True, description="使用原生asyncio实现，关闭后回退到同步实现")
+        # 流式输出合并
+        STREAM_COALESCE_BYTES: int = Field(default=0, description="合并message片段的字节阈值，0表示逐片段直通")
+        STREAM_COALESCE_MS: int = Field(default=50, description="合并message片段的最长等待时间(毫秒)")
+        # 状态存储
+        STATE_BACKEND: str = Field(default="sqlite", description="状态存储后端：sqlite 或 json（旧版三个JSON文件）")
+        STATE_CACHE_SIZE: int = Field(default=1024, description="内存中缓存的聊天状态数量上限(LRU)")
+        # 状态保留策略，0表示不限制
+        STATE_MAX_CHATS: int = Field(default=0, description="存储中保留的聊天数量上限，超出时删除最久未更新的聊天")
+        STATE_CHAT_TTL_HOURS: float = Field(default=0, description="聊天空闲超过该小时数后删除")
+        STATE_MAX_TURNS: int = Field(default=0, description="每个聊天保存的消息轮次上限，超出时丢弃最早的轮次")
+        STATE_COMPACT_INTERVAL: int = Field(default=300, description="两次状态压缩之间的最短间隔(秒)")
 
     def __init__(self):
         self.type = "manifold"
@@ -52,90 +2281,248 @@ class Pipe:
         self.chat_message_mapping = {}
         self.dify_chat_model = {}
         self.dify_file_list = {}
+        # 已加载到内存的聊天及其最近使用时间，按最近使用排序
+        self._loaded_chats = OrderedDict()
+        self._state_lock = threading.Lock()
+        self._last_compaction = 0.0
+        # 状态淘汰计数
+        self.eviction_stats = {"chats_expired": 0, "chats_over_limit": 0, "turns_trimmed": 0, "memory_idle": 0}
         self.data_cache_dir = "data/dify"
-        self.load_state()
         self.valves = self.Valves()
+        self.load_state()
                 
 
-    def save_state(self):
+    @property
+    def state_store(self):
+        """当前Valves配置的状态存储"""
+        return get_state_store(self.valves.STATE_BACKEND, self.data_cache_dir)
+
+    def save_state(self, chat_id: Optional[str] = None):
         """
-        持久化Dify相关的状态变量到文件
-        这个函数的主要作用是将程序运行时的状态信息保存到本地文件中，以便程序重启后能够恢复之前的状态
+        持久化Dify相关的状态变量
+        指定chat_id时只写入该聊天（SQLite为单行upsert），否则写入全部状态
         """
-        # 创建数据缓存目录，如果目录不存在则创建
-        # exist_ok=True 表示如果目录已存在也不会报错
-        os.makedirs(self.data_cache_dir, exist_ok=True)
+        store = self.state_store
+        start = time.perf_counter()
+        if chat_id is None:
+            store.save_all(self.chat_message_mapping, self.dify_chat_model, self.dify_file_list)
+        else:
+            store.save_chat(chat_id, self.chat_message_mapping, self.dify_chat_model, self.dify_file_list)
+        metrics = self.metrics
+        if metrics is not None:
+            # 与其他指标一样按应用区分，聊天记录的模型即应用ID；写入全部状态时记为默认应用
+            app_id = self.dify_chat_model.get(chat_id) if chat_id is not None else None
+            labels = {"app": app_id or self.valves.DIFY_MODLE_ID, "store": self.valves.STATE_BACKEND}
+            metrics.observe("dify_save_state_seconds", time.perf_counter() - start, labels)
+        # 摊还压缩：距上次压缩超过STATE_COMPACT_INTERVAL秒时顺带执行一次
+        if time.monotonic() - self._last_compaction >= self.valves.STATE_COMPACT_INTERVAL:
+            self.compact_state()
 
-        # 1. 保存聊天消息映射关系
-        # chat_message_mapping.json 存储了聊天ID与DIFY消息ID的对应关系
-        chat_mapping_file = os.path.join(
-            self.data_cache_dir, "chat_message_mapping.json"
-        )
-        # 打开文件进行写入，使用UTF-8编码以支持中文
-        with open(chat_mapping_file, "w", encoding="utf-8") as f:
-            # json.dump 将Python对象转换为JSON格式并写入文件
-            # ensure_ascii=False 允许写入非ASCII字符（如中文）
-            # indent=2 设置缩进为2个空格，使JSON文件更易读
-            json.dump(self.chat_message_mapping, f, ensure_ascii=False, indent=2)
-
-         # 2. 保存聊天模型信息
-        # chat_model.json 存储了每个聊天使用的模型信息
-        chat_model_file = os.path.join(self.data_cache_dir, "chat_model.json")
-        with open(chat_model_file, "w", encoding="utf-8") as f:
-            json.dump(self.dify_chat_model, f, ensure_ascii=False, indent=2)
-
-        # 3. 保存文件列表信息
-        # file_list.json 存储了上传文件的相关信息
-        file_list_file = os.path.join(self.data_cache_dir, "file_list.json")
-        with open(file_list_file, "w", encoding="utf-8") as f:
-            json.dump(self.dify_file_list, f, ensure_ascii=False, indent=2)
-
-    def load_state(self):
-        """从文件加载Dify相关的状态变量"""
-        try:
-            # chat_message_mapping.json
-            chat_mapping_file = os.path.join(
-                self.data_cache_dir, "chat_message_mapping.json"
-            )
-            if os.path.exists(chat_mapping_file):
-                with open(chat_mapping_file, "r", encoding="utf-8") as f:
-                    self.chat_message_mapping = json.load(f)
-            else:
-                self.chat_message_mapping = {}
+    def compact_state(self) -> dict:
+        """
+        按保留策略同时清理内存和存储中的聊天状态
 
-            # chat_model.json
-            chat_model_file = os.path.join(self.data_cache_dir, "chat_model.json")
-            if os.path.exists(chat_model_file):
-                with open(chat_model_file, "r", encoding="utf-8") as f:
-                    self.dify_chat_model = json.load(f)
-            else:
-                self.dify_chat_model = {}
+        Returns:
+            dict: 本次淘汰的数量
+        """
+        self._last_compaction = time.monotonic()
+        ttl = self.valves.STATE_CHAT_TTL_HOURS * 3600
+        evicted = {"chats_expired": 0, "chats_over_limit": 0, "turns_trimmed": 0, "memory_idle": 0}
+        with self._state_lock:
+            now = time.time()
+            # 最近使用过的聊天（可能正在流式响应中）不从存储中删除
+            keep = {
+                chat_id for chat_id, used_at in self._loaded_chats.items()
+                if ttl <= 0 or now - used_at < ttl
+            }
+        if ttl > 0 or self.valves.STATE_MAX_CHATS > 0:
+            try:
+                removed = self.state_store.compact(self.valves.STATE_MAX_CHATS, ttl, keep)
+            except Exception as e:
+                log.error(f"压缩Dify状态失败: {e}")
+                removed = {"expired": [], "over_limit": []}
+            evicted["chats_expired"] = len(removed["expired"])
+            evicted["chats_over_limit"] = len(removed["over_limit"])
+            with self._state_lock:
+                for chat_id in removed["expired"] + removed["over_limit"]:
+                    self._drop_chat(chat_id)
+                # 内存中空闲超过TTL的聊天
+                if ttl > 0:
+                    for chat_id in [c for c in self._loaded_chats if c not in keep]:
+                        self._drop_chat(chat_id)
+                        evicted["memory_idle"] += 1
+        for key, value in evicted.items():
+            self.eviction_stats[key] += value
+        log.debug("Dify状态压缩", evicted=evicted, total=self.eviction_stats)
+        return evicted
 
-            # file_list.json
-            file_list_file = os.path.join(self.data_cache_dir, "file_list.json")
-            if os.path.exists(file_list_file):
-                with open(file_list_file, "r", encoding="utf-8") as f:
-                    self.dify_file_list = json.load(f)
-            else:
+    def _drop_chat(self, chat_id: str):
+        """从内存中移除一个聊天的状态"""
+        self._loaded_chats.pop(chat_id, None)
+        self.chat_message_mapping.pop(chat_id, None)
+        self.dify_chat_model.pop(chat_id, None)
+        self.dify_file_list.pop(chat_id, None)
+
+    def _trim_turns(self, chat_id: str):
+        """超过STATE_MAX_TURNS时丢弃最早的轮次，并记录偏移以保持索引对齐"""
+        max_turns = self.valves.STATE_MAX_TURNS
+        mapping = self.chat_message_mapping[chat_id]
+        if max_turns <= 0 or len(mapping["messages"]) <= max_turns:
+            return
+        dropped = len(mapping["messages"]) - max_turns
+        mapping["messages"] = mapping["messages"][dropped:]
+        mapping["turn_offset"] = mapping.get("turn_offset", 0) + dropped
+        self.eviction_stats["turns_trimmed"] += dropped
+
+    def load_state(self, chat_id: Optional[str] = None):
+        """
+        按需从状态存储加载Dify相关的状态变量
+        不指定chat_id时只清空内存缓存，各聊天在首次使用时按chat_id加载，启动耗时和内存不随历史聊天数增长
+        """
+        with self._state_lock:
+            if chat_id is None:
+                self.chat_message_mapping = {}
+                self.dify_chat_model = {}
                 self.dify_file_list = {}
+                self._loaded_chats.clear()
+                return
+            if chat_id in self._loaded_chats:
+                self._loaded_chats[chat_id] = time.time()
+                self._loaded_chats.move_to_end(chat_id)
+                return
+            try:
+                state = self.state_store.load_chat(chat_id)
+            except Exception as e:
+                log.error(f"加载Dify状态失败: {e}")
+                state = None
+            if state is not None:
+                mapping, model, file_list = state
+                if mapping is not None:
+                    self.chat_message_mapping[chat_id] = mapping
+                if model is not None:
+                    self.dify_chat_model[chat_id] = model
+                if file_list is not None:
+                    self.dify_file_list[chat_id] = file_list
+            self._loaded_chats[chat_id] = time.time()
+            # 超出上限时淘汰最久未使用的聊天，其状态已保存在存储中
+            while len(self._loaded_chats) > max(self.valves.STATE_CACHE_SIZE, 1):
+                self._drop_chat(next(iter(self._loaded_chats)))
 
-        except Exception as e:
-            print(f"加载Dify状态文件失败: {e}")
-            # 加载失败时使用空字典
-            self.chat_message_mapping = {}
-            self.dify_chat_model = {}
-            self.dify_file_list = {}
+    @property
+    def http(self) -> PooledSession:
+        """共享的带连接池HTTP会话"""
+        return get_http_session(self.valves)
+
+    @property
+    def retry(self) -> RetryPolicy:
+        """按Valves配置的重试策略"""
+        return RetryPolicy.from_valves(self.valves)
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        """url所在Dify服务的熔断器"""
+        return get_circuit_breaker(self.valves, url)
+
+    @property
+    def balancer(self) -> BackendBalancer:
+        """按Valves配置的多后端负载均衡器"""
+        return get_backend_balancer(self.valves)
+
+    @property
+    def metrics(self) -> Optional[Metrics]:
+        """共享的指标注册表，未启用时为None；METRICS_PORT非0时同时启动 /metrics 服务"""
+        if not self.valves.METRICS_ENABLED:
+            return None
+        if self.valves.METRICS_PORT:
+            start_metrics_server(self.valves.METRICS_HOST, self.valves.METRICS_PORT)
+        return get_metrics()
+
+    def metrics_text(self) -> str:
+        """Prometheus文本格式的全部指标，可用于自行暴露或推送"""
+        return get_metrics().render()
+
+    def _configure_logging(self):
+        """按Valves设置本函数的日志级别、长度上限与采样率"""
+        log.configure(self.valves.LOG_LEVEL, self.valves.LOG_MAX_CHARS, self.valves.LOG_SAMPLE_RATE)
+
+    @property
+    def apps(self) -> DifyAppRegistry:
+        """本Pipe提供的Dify应用注册表"""
+        return get_app_registry(self.valves)
+
+    def app_balancer(self, app: DifyApp) -> BackendBalancer:
+        """
+        应用的负载均衡器：应用配置了地址时只使用该地址，
+        否则使用Pipe配置的后端并换成应用自己的API Key；连接池、熔断与上传缓存在各应用间共享
+        """
+        if app.base_url:
+            return get_balancer([DifyBackend(app.base_url, app.key)], self.valves.LB_STRATEGY)
+        backends = parse_backends(self.valves)
+        if app.key != self.valves.DIFY_KEY:
+            backends = [DifyBackend(b.base_url, app.key, b.weight, b.file_server) for b in backends]
+        return get_balancer(backends, self.valves.LB_STRATEGY)
+
+    def choose_backend(self, balancer: Optional[BackendBalancer] = None) -> DifyBackend:
+        """按负载均衡策略选择后端，熔断中的后端被剔除"""
+        balancer = balancer or self.balancer
+        return balancer.choose(lambda backend: self.breaker(backend.base_url).available())
+
+    def client(self, backend: Optional[DifyBackend] = None, app: Optional[DifyApp] = None) -> DifyClient:
+        """后端的API客户端，默认为第一个后端；负载统计记入应用的负载均衡器"""
+        balancer = self.app_balancer(app) if app else self.balancer
+        return DifyClient(
+            backend or balancer.backends[0], self.http, self.retry, self.breaker, balancer,
+            metrics=self.metrics, labels=self._metric_labels(app),
+        )
+
+    async def async_client(self, backend: Optional[DifyBackend] = None, app: Optional[DifyApp] = None) -> AsyncDifyClient:
+        """client 的异步版本，使用当前事件循环的aiohttp会话"""
+        balancer = self.app_balancer(app) if app else self.balancer
+        session = await get_async_http_session(self.valves)
+        return AsyncDifyClient(
+            backend or balancer.backends[0], self.http, session, self.retry, self.breaker, balancer,
+            metrics=self.metrics, labels=self._metric_labels(app),
+        )
+
+    def _metric_labels(self, app: Optional[DifyApp]) -> dict:
+        return {"app": app.id if app else self.valves.DIFY_MODLE_ID}
+
+    def backend_stats(self) -> dict:
+        """返回各应用后端的负载统计"""
+        return {app.id: self.app_balancer(app).stats() for app in self.apps.apps.values()}
+
+    def circuit_stats(self) -> dict:
+        """返回各Dify后端接口与文件服务的熔断状态"""
+        backends = [b for app in self.apps.apps.values() for b in self.app_balancer(app).backends]
+        urls = [url for backend in backends for url in (backend.base_url, backend.file_server)]
+        breakers = {self.breaker(url).name: self.breaker(url) for url in urls if url}
+        return {name: breaker.stats() for name, breaker in breakers.items()}
+
+    def pool_stats(self) -> dict:
+        """返回连接池的连接复用统计"""
+        return self.http.stats()
+
+    def upload_cache_stats(self) -> dict:
+        """返回上传缓存的命中统计"""
+        return get_upload_cache(self.valves).stats()
 
     def get_models(self):
         """
-        获取DIFY的模型列表
+        获取DIFY的模型列表，每个注册的应用对应一个模型
         """
-        return [
-            {"id": self.valves.DIFY_MODLE_ID, "name": self.valves.DIFY_WORKFLOW},
-        ]
+        return self.apps.models(self._fetch_app_info)
+
+    def _fetch_app_info(self, app: DifyApp):
+        """从Dify获取应用的 /info 与 /parameters，使用较短的超时且不重试，Dify无应答时尽快放弃"""
+        balancer = self.app_balancer(app)
+        timeout = self.valves.APP_INFO_TIMEOUT
+        client = DifyClient(
+            self.choose_backend(balancer), self.http, RetryPolicy(attempts=1), self.breaker, balancer,
+            timeout=(min(timeout, 3.05), timeout), metrics=self.metrics, labels=self._metric_labels(app),
+        )
+        return client.get_json("info"), client.get_json("parameters")
 
 
-    def upload_file(self, user_id: str, file_path: str, mime_type: str) -> str:
+    def upload_file(self, user_id: str, file_path: str, mime_type: str, backend: Optional[DifyBackend] = None) -> str:
         """
         上传文件到DIFY服务器
         
@@ -143,6 +2530,7 @@ class Pipe:
             user_id: 用户ID
             file_path: 文件路径
             mime_type: 文件MIME类型
+            backend: 上传到的后端，默认为第一个后端
             
         Returns:
             str: 上传成功后返回的文件ID
@@ -153,79 +2541,176 @@ class Pipe:
             ValueError: 服务器响应格式无效
         """
         try:
-            url = f"{self.valves.DIFY_BASE_URL}/files/upload"
-            headers = {
-                "Authorization": f"Bearer {self.valves.DIFY_KEY}",
-            }
-
-            file_name = os.path.basename(file_path)
-            
-            # 使用 with 语句确保文件正确关闭
-            with open(file_path, "rb") as file:
-                files = {
-                    "file": (file_name, file, mime_type),
-                    "user": (None, user_id),
-                }
-                response = requests.post(url, headers=headers, files=files, timeout=(5, 30))
-                response.raise_for_status()  # 检查响应状态
-                
-                result = response.json()
-                if "id" not in result:
-                    raise ValueError(f"服务器响应格式无效: {result}")
-                    
-                return result["id"]
-            
+            return self.client(backend).upload_path(user_id, file_path, mime_type=mime_type)["id"]
         except FileNotFoundError:
-            logging.error(f"文件未找到: {file_path}")
+            log.error(f"文件未找到: {file_path}")
             raise
+
+    def upload_file_obj(self, user_id: str, file_name: str, file, mime_type: str, backend: Optional[DifyBackend] = None,
+                        app: Optional[DifyApp] = None) -> str:
+        """
+        上传内存中的数据或文件对象到DIFY服务器，返回文件ID
+
+        Args:
+            user_id: 用户ID
+            file_name: 上传时使用的文件名
+            file: bytes/bytearray 或可读的文件对象
+            mime_type: 文件MIME类型
+            backend: 上传到的后端，默认为第一个后端
+            app: 指标中标记的应用
+        """
+        try:
+            return self.client(backend, app).upload(user_id, file_name, file, mime_type)["id"]
         except requests.exceptions.RequestException as e:
-            logging.error(f"上传文件失败: {str(e)}")
+            log.error(f"上传文件失败: {str(e)}")
             raise
         except Exception as e:
-            logging.error(f"处理文件时发生错误: {str(e)}")
+            log.error(f"处理文件时发生错误: {str(e)}")
             raise
 
-    def upload_images(self, image_data_base64: str, user_id: str) -> str:
+    def upload_images(self, image_data_base64: str, user_id: str, backend: Optional[DifyBackend] = None,
+                      app: Optional[DifyApp] = None) -> str:
         """
         上传 base64 编码的图片到 DIFY 服务器，返回图片路径
         支持类型: 'JPG', 'JPEG', 'PNG', 'GIF', 'WEBP', 'SVG'
+        图片直接从base64流式解码上传，不写临时文件；MIME类型按魔数识别
         """
         try:
-            # Remove the data URL scheme prefix if present
-            if image_data_base64.startswith("data:"):
-                # Extract the base64 data after the comma
-                image_data_base64 = image_data_base64.split(",", 1)[1]
-
-            # 解码 base64 图像数据
-            image_data = base64.b64decode(image_data_base64)
-
-            # Create and save temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-                tmp_file.write(image_data)
-                temp_file_path = tmp_file.name
-            try:
-                file_id = self.upload_file(user_id, temp_file_path, "image/png")
-            finally:
-                os.remove(temp_file_path)
+            backend = backend or self.balancer.backends[0]
+            # 边解码边计算哈希，不生成完整的解码副本
+            reader = Base64Reader(image_data_base64)
+            digest, head = reader.digest()
+            # 相同内容的图片已上传过时直接复用文件ID
+            upload_cache = get_upload_cache(self.valves)
+            cache_key = upload_cache_key(backend, digest, user_id)
+            file_id = upload_cache.get(cache_key)
+            if file_id is not None:
+                return file_id
+
+            mime_type, extension = sniff_image_type(head, reader.declared_type or "image/png")
+            file_id = self.upload_file_obj(user_id, f"image.{extension}", reader.read_all(), mime_type, backend, app)
+            upload_cache.put(cache_key, file_id)
             return file_id
         except Exception as e:
             raise ValueError(f"Failed to process base64 image data: {str(e)}")
+
         
 
 
     def pipes(self) -> List[dict]:
+        self._configure_logging()
         return self.get_models()
     
 
 
-    def pipe(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None) -> Union[str, Generator, Iterator]:
-        #主流程
-        if DEBUG_MODE:
-            print("-----------------------------------------------------------------")
-            print("Debug - Pipi Function ")
-            print(f"body:{body}")
-            print(f"__task__:{__task__}")
-            print("-----------------------------------------------------------------")
+    async def pipe(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None) -> Union[str, Generator, Iterator, AsyncGenerator]:
+        #主流程：默认走原生asyncio路径，未开启或缺少aiohttp时回退到同步实现
+        self._configure_logging()
+        log.begin_request()
+        if self.valves.ASYNC_MODE and aiohttp is not None:
+            return await self.pipe_async(body, __event_emitter__, __user__, __task__)
+        # 同步实现中的上传等阻塞操作放到线程中执行，避免阻塞事件循环
+        result = await asyncio.to_thread(
+            self.pipe_sync, body, __event_emitter__, __user__, __task__, asyncio.get_running_loop()
+        )
+        if isinstance(result, str):
+            return result
+        # 流式响应同样在工作线程中逐段读取
+        return iterate_in_thread(result)
+
+    def pipe_sync(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None, loop=None) -> Union[str, Generator, Iterator]:
+        #同步主流程，loop为open-webui的事件循环，用于从工作线程发送上传进度
+        request = self._prepare_request(body, __event_emitter__, __user__, __task__, loop)
+        if isinstance(request, str):
+            return request
+
+        # 并发上传本轮的全部附件，file_list保持原有顺序
+        jobs = self._attachment_jobs(request)
+        results = run_concurrently(
+            [partial(self._upload_attachment, kind, item, request) for kind, item in jobs],
+            self.valves.UPLOAD_CONCURRENCY,
+        )
+        file_list = self._collect_file_list(jobs, results)
+        if isinstance(file_list, str):
+            return file_list
+
+        path, payload = self._build_chat_request(request, file_list)
+        chat_id, message_id, mode = request["chat_id"], request["message_id"], request["app"].mode
+        try:
+            client = self.client(request["backend"], request["app"])
+            if request["stream"]:
+                return self._track_stream(
+                    client, self.stream_response(client, path, payload, chat_id, message_id, mode), request["started"]
+                )
+            else:
+                client.balancer.begin(client.backend)
+                try:
+                    return self.non_stream_response(client, path, payload, chat_id, message_id, mode)
+                finally:
+                    client.balancer.end(client.backend)
+        except requests.exceptions.RequestException as e:
+            log.error(f"Request failed: {e}")
+            return f"Error: Request failed: {e}"
+        except Exception as e:
+            log.error(f"Error in pipe method: {e}", exc_info=True)
+            return f"Error: {e}"
+
+    async def pipe_async(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None) -> Union[str, AsyncGenerator]:
+        #异步主流程，流式响应以异步生成器返回给open-webui
+        # 加载聊天状态、取出附件队列可能读写磁盘，在工作线程中执行
+        request = await asyncio.to_thread(
+            self._prepare_request, body, __event_emitter__, __user__, __task__, asyncio.get_running_loop()
+        )
+        if isinstance(request, str):
+            return request
+
+        # 并发上传本轮的全部附件，file_list保持原有顺序
+        jobs = self._attachment_jobs(request)
+        semaphore = asyncio.Semaphore(max(self.valves.UPLOAD_CONCURRENCY, 1))
+
+        async def upload(kind, item):
+            async with semaphore:
+                return await self._upload_attachment_async(kind, item, request)
+
+        results = await asyncio.gather(*(upload(kind, item) for kind, item in jobs), return_exceptions=True)
+        file_list = self._collect_file_list(jobs, results)
+        if isinstance(file_list, str):
+            return file_list
+
+        path, payload = self._build_chat_request(request, file_list)
+        chat_id, message_id, mode = request["chat_id"], request["message_id"], request["app"].mode
+        try:
+            client = await self.async_client(request["backend"], request["app"])
+            if request["stream"]:
+                return self._track_stream_async(
+                    client, self.stream_response_async(client, path, payload, chat_id, message_id, mode), request["started"]
+                )
+            else:
+                client.balancer.begin(client.backend)
+                try:
+                    return await self.non_stream_response_async(client, path, payload, chat_id, message_id, mode)
+                finally:
+                    client.balancer.end(client.backend)
+        except aiohttp.ClientError as e:
+            log.error(f"Request failed: {e}")
+            return f"Error: Request failed: {e}"
+        except Exception as e:
+            log.error(f"Error in pipe method: {e}", exc_info=True)
+            return f"Error: {e}"
+
+    def _prepare_request(self, body: dict, __event_emitter__: dict, __user__: Optional[dict], __task__=None, loop=None) -> Union[str, dict]:
+        """
+        解析open-webui请求，维护对话上下文，同步与异步流程共用；会读写状态存储，异步流程在工作线程中调用
+
+        Args:
+            loop: open-webui的事件循环，用于从工作线程发送上传进度；为None时取当前线程正在运行的循环
+
+        Returns:
+            str: 特殊任务（标题、标签生成）直接返回的结果
+            dict: 待上传的图片、文件信息以及构建载荷所需的上下文
+        """
+        started = time.perf_counter()
+        log.debug("收到请求", task=__task__, body=body)
         # 获取模型名称
         model_name = body["model"][body["model"].find(".") + 1 :]
         # 处理特殊任务
@@ -235,24 +2720,35 @@ class Pipe:
             elif __task__ == "tags_generation":
                 return f'{{"tags":[{model_name}]}}'
 
+        # 模型对应的Dify应用
+        app = self.apps.get(model_name)
+        if app is None:
+            return f"Error: 未配置Dify应用 {model_name}"
+        if not app.declared_mode:
+            # 应用类型由 /info 决定，首次获取尚未完成时等待其结果（本方法在工作线程中执行）
+            self.apps.wait_ready(self._fetch_app_info, self.valves.APP_INFO_TIMEOUT * 2)
+
         # 获取当前用户
         current_user = __user__["email"]
 
         # 处理系统消息和普通消息
         system_message, messages = pop_system_message(body["messages"])
-        if DEBUG_MODE:
-            print(f"system_message:{system_message}")
-            print(f"messages:{messages}, {len(messages)}")
+        log.debug("消息", system_message=system_message, count=len(messages), messages=messages)
 
         # 从event_emitter获取chat_id和message_id
         cell_contents = get_closure_info(__event_emitter__)
         chat_id = cell_contents["chat_id"]
         message_id = cell_contents["message_id"]
+        # 按需加载当前聊天的状态
+        self.load_state(chat_id)
         # 处理对话模型和上下文
         parent_message_id = None
+        # 新聊天、截断历史或更换后端时需要先保存，否则上传期间被LRU淘汰后这些改动会丢失
+        changed = False
         # 在pipe函数中修改对话历史的处理逻辑
         if len(messages) == 1:
             # 新对话逻辑保持不变
+            changed = True
             self.dify_chat_model[chat_id] = model_name
             self.chat_message_mapping[chat_id] = {
                 "dify_conversation_id": "",
@@ -271,18 +2767,29 @@ class Pipe:
                     self.dify_chat_model[chat_id] = model_name
                     
                 chat_history = self.chat_message_mapping[chat_id]["messages"]
-                current_msg_index = len(messages) - 1  # 当前消息的索引
+                # 超出STATE_MAX_TURNS而被裁剪掉的早期轮次数，用于对齐索引
+                turn_offset = self.chat_message_mapping[chat_id].get("turn_offset", 0)
+                current_msg_index = len(messages) - 1 - turn_offset  # 当前消息在保留历史中的索引
                 
                 # 如果不是第一条消息，获取前一条消息的dify_id作为parent
                 if current_msg_index > 0 and len(chat_history) >= current_msg_index:
                     previous_msg = chat_history[current_msg_index - 1]
                     parent_message_id = list(previous_msg.values())[0]                
                     # 关键修改：截断当前位置之后的消息历史
+                    changed = len(chat_history) > current_msg_index
                     self.chat_message_mapping[chat_id]["messages"] = chat_history[:current_msg_index]
+        # 选择后端：Dify会话只在创建它的后端上有效
+        pinned = self.chat_message_mapping.get(chat_id, {}).get("backend")
+        backend = self._route_backend(chat_id, self.app_balancer(app))
+        mapping = self.chat_message_mapping.get(chat_id) or {"dify_conversation_id": "", "messages": [], "backend": backend.id}
+        if changed or pinned != backend.id:
+            self.save_state(chat_id)
+        if not mapping["dify_conversation_id"]:
+            parent_message_id = None
         # 获取最后一条消息作为query
         message = messages[-1]
         query = ""
-        file_list = []
+        images = []
         # Dify APIs设置可选接入参数model与system_message.
         inputs = {
             "model": model_name,
@@ -294,223 +2801,526 @@ class Pipe:
                 if item["type"] == "text":
                     query += item["text"]
                 if item["type"] == "image_url":
-                    upload_file_id = self.upload_images(item["image_url"]["url"], current_user)
-                    upload_file_dict = {
-                        "type": "image",
-                        "transfer_method": "local_file",
-                        "url": "",
-                        "upload_file_id": upload_file_id
-                    }
-                    print("-----------------4------------------")
-                    file_list.append(upload_file_dict)
+                    images.append(item["image_url"]["url"])
         else:
             query = message.get("content", "")
 
-        # 处理文件上传，如需上传多个文件这里改为轮询     
-        with open('data/dify/dify_file_data.json', 'r', encoding='utf-8') as f:
-            file_info = json.load(f)
-        if DEBUG_MODE:
-            print(f"file_info:{file_info}")
-        if file_info.get("flag", False) is True:
-            file_info["flag"] = False
-            with open('data/dify/dify_file_data.json', 'w', encoding='utf-8') as f:
-                json.dump(file_info, f, ensure_ascii=False, indent=2)
-            url = f"{self.valves.DIFY_BASE_URL}/files/upload"
+        running_loop = loop
+        if running_loop is None:
             try:
-                file_name = file_info['name']
-                file_extension = get_file_extension(file_name).upper()
-                # 根据DifyAPI文件扩展名确定文件类型
-                file_type = "custom"  # 默认类型
-                if file_extension in ['TXT', 'MD', 'MARKDOWN', 'PDF', 'HTML', 'XLSX', 'XLS','DOC','DOCX', 'CSV', 'EML', 'MSG', 'PPTX', 'PPT', 'XML', 'EPUB']:
-                    file_type = "document"
-                elif file_extension in ['JPG', 'JPEG', 'PNG', 'GIF', 'WEBP', 'SVG']:
-                    file_type = "image"
-                elif file_extension in ['MP3', 'M4A', 'WAV', 'WEBM', 'AMR']:
-                    file_type = "audio"
-                elif file_extension in ['MP4', 'MOV', 'MPEG', 'MPGA']:
-                    file_type = "video"
-                file_DYFI_FILE_ID = self._get_file_dify_server(file_info["user_id"],f"{file_info['id']}_{file_info['name']}",)
-                #file_path_url=f"{file_info['id']}_{file_info['name']}"
-                #file_DYFI_FILE_ID=self.upload_file(file_id,f"data/uploads/{file_path_url}",file_type)
-                print(f"------------------file_DYFI_FILE_ID=:{file_DYFI_FILE_ID}")
-
-                file_list.append({
-                    "type": file_type,
-                    "transfer_method": "local_file",
-                    "upload_file_id": file_DYFI_FILE_ID["id"]
-                })                
-                print(f"成功添加文件: {file_name}, 类型: {file_type}")
-            except Exception as e:
-                print(f"处理文件 {file_name} 失败: {str(e)}")
+                running_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+
+        # 取出Filter为本聊天（或本用户）放入队列的全部文件
+        attachment_queue = get_attachment_queue(self.valves.ATTACHMENT_SPILL_PATH)
+        files = attachment_queue.pop_all(chat_id)
+        if __user__.get("id"):
+            files += attachment_queue.pop_all(f"user:{__user__['id']}")
+        log.debug("附件", files=files)
+
+        return {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "user": current_user,
+            "stream": body.get("stream", False),
+            "inputs": inputs,
+            "query": query,
+            "parent_message_id": parent_message_id,
+            "images": images,
+            "files": files,
+            "event_emitter": __event_emitter__,
+            "loop": running_loop,
+            "app": app,
+            "backend": backend,
+            "mapping": mapping,
+            "started": started,
+        }
+
+    def _route_backend(self, chat_id: str, balancer: BackendBalancer) -> DifyBackend:
+        """
+        为聊天选择Dify后端并记录在chat_message_mapping中
+        已有Dify会话的聊天固定使用原后端；原后端已从配置中移除时在新后端上开始新的Dify会话
+        """
+        mapping = self.chat_message_mapping.setdefault(chat_id, {"dify_conversation_id": "", "messages": []})
+        if mapping.get("dify_conversation_id"):
+            # 旧版本保存的聊天没有记录后端，它们都创建在DIFY_BASE_URL上
+            pinned = mapping.get("backend") or DifyBackend(self.valves.DIFY_BASE_URL, self.valves.DIFY_KEY).id
+            backend = balancer.get(pinned)
+            if backend is not None:
+                return backend
+            log.info(f"聊天 {chat_id} 的Dify后端已不在配置中，在新后端上开始新的会话")
+            mapping.update({"dify_conversation_id": "", "messages": [], "turn_offset": 0})
+        backend = self.choose_backend(balancer)
+        mapping["backend"] = backend.id
+        return backend
+
+    def _attachment_jobs(self, request: dict) -> list:
+        """本轮需要上传的附件，按file_list中的顺序排列：(类型, 图片URL或文件信息)"""
+        jobs = [("image", image_url) for image_url in request["images"]]
+        jobs += [("file", file_info) for file_info in request["files"]]
+        return jobs
+
+    def _upload_attachment(self, kind: str, item, request: dict) -> dict:
+        """上传单个附件并返回file_list中的文件项，记录耗时"""
+        start = time.perf_counter()
+        if kind == "image":
+            file_dict = self._image_file_dict(self.upload_images(item, request["user"], request["backend"], request["app"]))
+        else:
+            upload_result = self._await_preupload(item, request["backend"])
+            if upload_result is None:
+                upload_result = self._get_file_dify_server(
+                    item["user_id"], f"{item['id']}_{item['name']}", self._upload_progress(request, item),
+                    request["backend"], request["app"],
+                )
+            file_dict = self._document_file_dict(item, upload_result)
+        log.debug("上传附件完成", kind=kind, ms=round((time.perf_counter() - start) * 1000, 1))
+        return file_dict
+
+    async def _upload_attachment_async(self, kind: str, item, request: dict) -> dict:
+        """_upload_attachment 的异步版本"""
+        start = time.perf_counter()
+        if kind == "image":
+            file_dict = self._image_file_dict(
+                await self.upload_images_async(item, request["user"], request["backend"], request["app"])
+            )
+        else:
+            upload_result = await self._await_preupload_async(item, request["backend"])
+            if upload_result is None:
+                upload_result = await self._get_file_dify_server_async(
+                    item["user_id"], f"{item['id']}_{item['name']}", self._upload_progress(request, item),
+                    request["backend"], request["app"],
+                )
+            file_dict = self._document_file_dict(item, upload_result)
+        log.debug("上传附件完成", kind=kind, ms=round((time.perf_counter() - start) * 1000, 1))
+        return file_dict
+
+    def _upload_progress(self, request: dict, file_info: dict):
+        """文档上传的进度回调，未开启UPLOAD_PROGRESS时返回None"""
+        if not self.valves.UPLOAD_PROGRESS:
+            return None
+        return upload_progress_reporter(request["event_emitter"], request["loop"], file_info.get("name", ""))
+
+    def _take_preupload(self, file_info: dict, backend: DifyBackend):
+        """取出Filter为该文件启动的预上传任务，没有时返回None；只有上传到本轮所选后端的结果可用"""
+        key = preupload_key(
+            backend.file_server, backend.key, file_info["user_id"], f"{file_info['id']}_{file_info['name']}"
+        )
+        return get_preupload_registry().pop(key)
+
+    def _await_preupload(self, file_info: dict, backend: DifyBackend) -> Optional[dict]:
+        """等待预上传结果，超时或失败时返回None以回退为直接上传"""
+        future = self._take_preupload(file_info, backend)
+        if future is None:
+            return None
+        try:
+            result = future.result(timeout=self.valves.PREUPLOAD_TIMEOUT)
+        except Exception as e:
+            log.warning(f"预上传 {file_info.get('name')} 未完成，改为直接上传: {e!r}")
+            return None
+        self._cache_preupload(file_info, backend, result)
+        return result
+
+    async def _await_preupload_async(self, file_info: dict, backend: DifyBackend) -> Optional[dict]:
+        """_await_preupload 的异步版本"""
+        future = self._take_preupload(file_info, backend)
+        if future is None:
+            return None
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.valves.PREUPLOAD_TIMEOUT)
+        except Exception as e:
+            log.warning(f"预上传 {file_info.get('name')} 未完成，改为直接上传: {e!r}")
+            return None
+        # 计算文件哈希需要读取整个文件，放到工作线程中
+        await asyncio.to_thread(self._cache_preupload, file_info, backend, result)
+        return result
 
-        if DEBUG_MODE:
-            print(f"file_list:{file_list}")
+    def _cache_preupload(self, file_info: dict, backend: DifyBackend, result: dict):
+        """预上传结果按文件内容放入上传缓存，同一文件再次发送或在其他对话中发送时不再上传"""
+        if self.valves.UPLOAD_CACHE_SIZE <= 0:
+            return
+        local_file_path = os.path.join('data/uploads', f"{file_info['id']}_{file_info['name']}")
+        try:
+            digest = file_sha256(local_file_path)
+        except OSError as e:
+            log.warning(f"缓存预上传结果失败: {e!r}")
+            return
+        get_upload_cache(self.valves).put(upload_cache_key(backend, digest, file_info["user_id"]), result)
+
+    def _collect_file_list(self, jobs: list, results: list) -> Union[str, list]:
+        """
+        按顺序汇总上传结果
+        图片上传失败时返回错误信息终止请求，文档上传失败时跳过该文件
+        """
+        file_list = []
+        for (kind, item), result in zip(jobs, results):
+            if not isinstance(result, Exception):
+                file_list.append(result)
+            elif kind == "image":
+                log.error(f"Error in pipe method: {result}")
+                return f"Error: {result}"
+            else:
+                log.error(f"处理文件 {item.get('name')} 失败: {str(result)}")
+        return file_list
+
+    def _image_file_dict(self, upload_file_id: str) -> dict:
+        """构建Dify载荷中的图片文件项"""
+        return {
+            "type": "image",
+            "transfer_method": "local_file",
+            "url": "",
+            "upload_file_id": upload_file_id
+        }
+
+    def _document_file_dict(self, file_info: dict, upload_result: dict) -> dict:
+        """构建Dify载荷中的文档文件项"""
+        file_name = file_info['name']
+        file_extension = get_file_extension(file_name).upper()
+        # 根据DifyAPI文件扩展名确定文件类型
+        file_type = "custom"  # 默认类型
+        if file_extension in ['TXT', 'MD', 'MARKDOWN', 'PDF', 'HTML', 'XLSX', 'XLS','DOC','DOCX', 'CSV', 'EML', 'MSG', 'PPTX', 'PPT', 'XML', 'EPUB']:
+            file_type = "document"
+        elif file_extension in ['JPG', 'JPEG', 'PNG', 'GIF', 'WEBP', 'SVG']:
+            file_type = "image"
+        elif file_extension in ['MP3', 'M4A', 'WAV', 'WEBM', 'AMR']:
+            file_type = "audio"
+        elif file_extension in ['MP4', 'MOV', 'MPEG', 'MPGA']:
+            file_type = "video"
+        log.debug("成功添加文件", file_name=file_name, file_type=file_type, result=upload_result)
+        return {
+            "type": file_type,
+            "transfer_method": "local_file",
+            "upload_file_id": upload_result["id"]
+        }
+
+    def _build_chat_request(self, request: dict, file_list: list):
+        """按应用类型构建 /chat-messages、/completion-messages 或 /workflows/run 的接口路径和载荷"""
+        # 统计信息以可调用对象传入，只在DEBUG日志实际输出时才计算
+        log.debug(
+            "发送请求",
+            file_list=file_list,
+            pool=self.pool_stats,
+            circuits=self.circuit_stats,
+            backends=self.backend_stats,
+            upload_cache=self.upload_cache_stats,
+            metrics=get_metrics().stats,
+        )
         
         #开始发送数据到Dify API
+        # 上传附件期间该聊天可能已被LRU淘汰，此时使用准备请求时的映射
+        mapping = self.chat_message_mapping.get(request["chat_id"]) or request["mapping"]
 
         #构建载荷
         payload = {
-            "inputs": inputs,
-            "parent_message_id": parent_message_id,
-            "query": query,
-            "response_mode": "streaming" if body.get("stream", False) else "blocking",
-            "conversation_id": self.chat_message_mapping[chat_id].get("dify_conversation_id", ""),
-            "user": current_user,
+            "inputs": request["inputs"],
+            "parent_message_id": request["parent_message_id"],
+            "query": request["query"],
+            "response_mode": "streaming" if request["stream"] else "blocking",
+            "conversation_id": mapping.get("dify_conversation_id", ""),
+            "user": request["user"],
             "files": file_list,
         }
+        app = request["app"]
+        path = "chat-messages"
+        if app.mode != "chat":
+            # 文本生成与工作流应用没有会话，用户输入放入应用的输入变量
+            payload = {
+                "inputs": {**request["inputs"], app.query_variable: request["query"]},
+                "response_mode": payload["response_mode"],
+                "user": request["user"],
+                "files": file_list,
+            }
+            path = "completion-messages" if app.mode == "completion" else "workflows/run"
+        return path, payload
 
-        # 设置请求头
-        headers = {
-            "Authorization": f"Bearer {self.valves.DIFY_KEY}",
-            "content-type": "application/json",
-        }
+    def _handle_stream_event(self, data: dict, chat_id, message_id, context: Optional[dict] = None):
+        """
+        处理单个流式事件，同步与异步流式响应共用
+
+        Args:
+            context: 本次流式响应的上下文，包含应用类型mode与后端backend
+
+        Returns:
+            tuple: (需要输出的文本或None, 是否结束流)
+        """
+        event = data.get("event")
+        context = context or {"mode": "chat"}
+
+        if event == "message":
+            # 处理普通文本消息
+            return data.get("answer", ""), False
+        elif event == "message_end":
+            # 保存会话和消息ID映射，文本生成应用没有会话
+            if context["mode"] == "chat":
+                self._record_message(chat_id, message_id, data)
+            return None, True
+        elif event == "text_chunk":
+            # 工作流的文本输出片段
+            text = data.get("data", {}).get("text", "")
+            context["streamed"] = context.get("streamed") or bool(text)
+            return text, False
+        elif event == "workflow_finished":
+            # 已流式输出过文本时只输出文件等其余结果
+            result = self._workflow_result(data.get("data", {}), context.get("client"), not context.get("streamed"))
+            return result, True
+        elif event == "error":
+            # 处理错误
+            error_msg = f"Error {data.get('status')}: {data.get('message')} ({data.get('code')})"
+            return f"Error: {error_msg}", True
+        return None, False
+
+    def _new_coalescer(self) -> TokenCoalescer:
+        return TokenCoalescer(self.valves.STREAM_COALESCE_BYTES, self.valves.STREAM_COALESCE_MS / 1000)
+
+    def _coalesce_output(self, coalescer: TokenCoalescer, event: str, text: Optional[str]) -> list:
+        """message与text_chunk片段交给合并器，其他输出先清空缓冲以保持顺序"""
+        if event in ("message", "text_chunk"):
+            chunk = coalescer.push(text)
+            return [chunk] if chunk else []
+        chunks = []
+        pending = coalescer.flush()
+        if pending:
+            chunks.append(pending)
+        if text is not None:
+            chunks.append(text)
+        return chunks
+
+    def _workflow_result(self, data: dict, client: Optional[DifyClient], include_text: bool = True) -> Optional[str]:
+        """把工作流的运行结果转换为输出文本：文本输出原样输出，文件输出转为Markdown链接"""
+        if data.get("status") != "succeeded":
+            return f"Workflow failed: {data.get('error', 'Unknown error')}"
+        parts = []
+        for value in (data.get("outputs") or {}).values():
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict) and item.get("url"):
+                    parts.append(self._file_markdown(item, client))
+                elif isinstance(item, str) and include_text:
+                    parts.append(item)
+        return "\n\n".join(parts) or None
+
+    def _file_markdown(self, file: dict, client: Optional[DifyClient]) -> str:
+        """Dify返回的文件转为Markdown，相对地址补全为后端的地址"""
+        url = (client or self.client()).file_url(file["url"])
+        name = file.get("filename") or "file"
+        if file.get("type") == "image":
+            return f"![{name}]({url})"
+        return f"[{name}]({url})"
+
+    def _blocking_result(self, res: dict, chat_id, message_id, mode: str, client: DifyClient) -> str:
+        """阻塞模式响应的输出文本，对话应用同时记录会话"""
+        if mode == "workflow":
+            return self._workflow_result(res.get("data", {}), client) or ""
+        if mode == "chat":
+            self._record_message(chat_id, message_id, res)
+        return res.get("answer", "")
+
+    def _record_message(self, chat_id, message_id, res: dict):
+        """记录Dify会话ID与消息ID映射并保存状态"""
+        dify_conversation_id = res.get("conversation_id", "")
+        dify_message_id = res.get("message_id", "")
+        # 流式响应期间该聊天可能已被LRU淘汰，重新加载
+        self.load_state(chat_id)
+        self.chat_message_mapping.setdefault(chat_id, {"dify_conversation_id": "", "messages": []})
+        
+        self.chat_message_mapping[chat_id]["dify_conversation_id"] = dify_conversation_id
+        self.chat_message_mapping[chat_id]["messages"].append({message_id: dify_message_id})
+        self._trim_turns(chat_id)
+        
+        # 保存状态
+        self.save_state(chat_id)
 
-        url = f"{self.valves.DIFY_BASE_URL}/chat-messages"
+    def _track_stream(self, client: DifyClient, chunks, started: Optional[float] = None):
+        """流式响应输出期间计入后端的进行中请求数，并记录从收到请求(started)到输出第一段文本的耗时"""
+        client.balancer.begin(client.backend)
+        try:
+            for chunk in chunks:
+                if started is not None and chunk:
+                    self._observe_ttft(client, started)
+                    started = None
+                yield chunk
+        finally:
+            client.balancer.end(client.backend)
 
+    async def _track_stream_async(self, client: DifyClient, chunks, started: Optional[float] = None):
+        """_track_stream 的异步版本"""
+        client.balancer.begin(client.backend)
         try:
-            if body.get("stream", False):
-                return self.stream_response(url, headers, payload, chat_id, message_id)
-            else:
-                return self.non_stream_response(url, headers, payload, chat_id, message_id)
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
-            return f"Error: Request failed: {e}"
-        except Exception as e:
-            print(f"Error in pipe method: {e}")
-            return f"Error: {e}"
+            async for chunk in chunks:
+                if started is not None and chunk:
+                    self._observe_ttft(client, started)
+                    started = None
+                yield chunk
+        finally:
+            client.balancer.end(client.backend)
+
+    def _observe_ttft(self, client: DifyClient, started: float):
+        if client.metrics is not None:
+            client.metrics.observe("dify_ttft_seconds", time.perf_counter() - started, client.labels)
 
+    def _stream_context(self, mode: str, client: DifyClient) -> dict:
+        """单次流式响应的上下文，供 _handle_stream_event 使用"""
+        return {"mode": mode, "client": client, "streamed": False}
 
-    def stream_response(self, url, headers, payload, chat_id, message_id):
+    def stream_response(self, client: DifyClient, path: str, payload: dict, chat_id, message_id, mode: str = "chat"):
         """处理流式响应"""
         try:
-            with requests.post(url, headers=headers, json=payload, stream=True, timeout=(3.05, 60)) as response:
-                if response.status_code != 200:
-                    raise Exception(f"HTTP Error {response.status_code}: {response.text}")
-
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode("utf-8")
-                        if line.startswith("data: "):
-                            try:
-                                data = json.loads(line[6:])
-                                event = data.get("event")
-                                
-                                if event == "message":
-                                    # 处理普通文本消息
-                                    yield data.get("answer", "")
-                                elif event == "message_file":
-                                    # 处理文件（图片）消息
-                                    pass
-                                elif event == "message_end":
-                                    # 保存会话和消息ID映射
-                                    dify_conversation_id = data.get("conversation_id", "")
-                                    dify_message_id = data.get("message_id", "")
-                                    
-                                    self.chat_message_mapping[chat_id]["dify_conversation_id"] = dify_conversation_id
-                                    self.chat_message_mapping[chat_id]["messages"].append({message_id: dify_message_id})
-                                    
-                                    # 保存状态
-                                    self.save_state()
-                                    break
-                                elif event == "error":
-                                    # 处理错误
-                                    error_msg = f"Error {data.get('status')}: {data.get('message')} ({data.get('code')})"
-                                    yield f"Error: {error_msg}"
-                                    break
-
-                                time.sleep(0.01)
-                            except json.JSONDecodeError:
-                                print(f"Failed to parse JSON: {line}")
-                            except KeyError as e:
-                                print(f"Unexpected data structure: {e}")
-                                print(f"Full data: {data}")
+            context = self._stream_context(mode, client)
+            coalescer = self._new_coalescer()
+            for sse in client.stream_events(path, payload, APP_STREAM_EVENTS[mode]):
+                try:
+                    text, done = self._handle_stream_event(sse.data, chat_id, message_id, context)
+                    for chunk in self._coalesce_output(coalescer, sse.event, text):
+                        yield chunk
+                    if done:
+                        break
+                except json.JSONDecodeError:
+                    log.warning("Failed to parse JSON", raw=sse.raw)
+                except KeyError as e:
+                    log.warning(f"Unexpected data structure: {e}", raw=sse.raw)
+            # 流意外结束时输出缓冲中剩余的文本
+            pending = coalescer.flush()
+            if pending:
+                yield pending
         except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+            log.error(f"Request failed: {e}")
             yield f"Error: Request failed: {e}"
         except Exception as e:
-            print(f"General error in stream_response method: {e}")
+            log.error(f"General error in stream_response method: {e}", exc_info=True)
             yield f"Error: {e}"
 
-    def non_stream_response(self, url, headers, payload, chat_id, message_id):
+    def non_stream_response(self, client: DifyClient, path: str, payload: dict, chat_id, message_id, mode: str = "chat"):
         """处理非流式响应"""
         try:
-            response = requests.post(url, headers=headers, json=payload, timeout=(3.05, 60))
-            if response.status_code != 200:
-                raise Exception(f"HTTP Error {response.status_code}: {response.text}")
-
-            res = response.json()
-            
-            # 保存会话和消息ID映射
-            dify_conversation_id = res.get("conversation_id", "")
-            dify_message_id = res.get("message_id", "")
-            
-            self.chat_message_mapping[chat_id]["dify_conversation_id"] = dify_conversation_id
-            self.chat_message_mapping[chat_id]["messages"].append({message_id: dify_message_id})
-            
-            # 保存状态
-            self.save_state()
-            
-            return res.get("answer", "")
+            res = client.post_json(path, payload)
+            return self._blocking_result(res, chat_id, message_id, mode, client)
         except requests.exceptions.RequestException as e:
-            print(f"Failed non-stream request: {e}")
+            log.error(f"Failed non-stream request: {e}")
             return f"Error: {e}"
 
-    def _get_file_dify_server(self, User_id: str, file_name: str) -> str:   
-        #从本地uploads目录读取文件并以multipart/form-data格式上传到DIFY服务器       
+    async def stream_response_async(self, client: AsyncDifyClient, path: str, payload: dict, chat_id, message_id, mode: str = "chat") -> AsyncGenerator[str, None]:
+        """处理流式响应（异步），不占用线程"""
         try:
+            context = self._stream_context(mode, client)
+            coalescer = self._new_coalescer()
+            events = client.stream_events_async(path, payload, APP_STREAM_EVENTS[mode])
+            async for sse in aiter_with_timeout(events, coalescer.remaining):
+                if sse is None:
+                    # 时间窗口已到而上游没有新片段，先输出缓冲
+                    pending = coalescer.flush()
+                    if pending:
+                        yield pending
+                    continue
+                try:
+                    if sse.event == "message_end":
+                        # 记录会话时会保存并压缩状态存储，在工作线程中执行
+                        text, done = await asyncio.to_thread(self._handle_stream_event, sse.data, chat_id, message_id, context)
+                    else:
+                        text, done = self._handle_stream_event(sse.data, chat_id, message_id, context)
+                    for chunk in self._coalesce_output(coalescer, sse.event, text):
+                        yield chunk
+                    if done:
+                        break
+                except json.JSONDecodeError:
+                    log.warning("Failed to parse JSON", raw=sse.raw)
+                except KeyError as e:
+                    log.warning(f"Unexpected data structure: {e}", raw=sse.raw)
+            # 流意外结束时输出缓冲中剩余的文本
+            pending = coalescer.flush()
+            if pending:
+                yield pending
+        except aiohttp.ClientError as e:
+            log.error(f"Request failed: {e}")
+            yield f"Error: Request failed: {e}"
+        except asyncio.TimeoutError:
+            log.error("Request failed: timeout")
+            yield "Error: Request failed: timeout"
+        except Exception as e:
+            log.error(f"General error in stream_response_async method: {e}", exc_info=True)
+            yield f"Error: {e}"
+
+    async def non_stream_response_async(self, client: AsyncDifyClient, path: str, payload: dict, chat_id, message_id, mode: str = "chat"):
+        """处理非流式响应（异步）"""
+        try:
+            res = await client.post_json_async(path, payload)
+            return await asyncio.to_thread(self._blocking_result, res, chat_id, message_id, mode, client)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error(f"Failed non-stream request: {e}")
+            return f"Error: {e}"
+
+    def _get_file_dify_server(self, User_id: str, file_name: str, progress=None, backend: Optional[DifyBackend] = None,
+                              app: Optional[DifyApp] = None) -> str:   
+        #从本地uploads目录读取文件并以multipart/form-data格式流式上传到DIFY服务器       
+        try:
+            backend = backend or self.balancer.backends[0]
             # 构建本地文件路径
             local_file_path = os.path.join('data/uploads', file_name)
-            if DEBUG_MODE:
-                print(f"读取本地文件: {local_file_path}")
-            
-            upload_url = self.valves.FILE_SERVER
-            headers = {
-                "Authorization": f"Bearer {self.valves.DIFY_KEY}"
-            }
+            log.debug("读取本地文件", path=local_file_path)
             
-            # 准备文件数据和用户ID
-            with open(local_file_path, 'rb') as file:
-                files = {
-                    'file': (file_name, file, 'application/octet-stream')
-                }
-                data = {
-                    'user': User_id  # 添加用户ID参数
-                }
-                
-                # 发送POST请求
-                response = requests.post(
-                    upload_url,
-                    headers=headers,
-                    files=files,
-                    data=data,
-                    timeout=(5, 30)  # 连接超时5秒，读取超时30秒
-                )           
-                # 检查响应
-                try:
-                    response.raise_for_status()
-                except requests.exceptions.HTTPError as e:
-                    error_msg = f"HTTP错误: {e.response.status_code}"
-                    if response.headers.get('content-type') == 'application/json':
-                        error_detail = response.json()
-                        error_msg += f" - {error_detail.get('message', '')}"
-                    logging.error(error_msg)
-                    raise
-                
-                result = response.json()
-                required_fields = ['id', 'name']
-                if not all(field in result for field in required_fields):
-                    raise ValueError(f"服务器响应格式无效: {result}")
-                if DEBUG_MODE:
-                    print(f"文件上传成功: {result}")
-                return result
-                
+            # 相同内容的文件已上传过时直接复用上传结果
+            upload_cache = get_upload_cache(self.valves)
+            cache_key = upload_cache_key(backend, file_sha256(local_file_path), User_id)
+            cached = upload_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+            # 文件内容按块从磁盘读取发送，不整体读入内存
+            result = self.client(backend, app).upload_path(User_id, local_file_path, file_name, progress=progress)
+            if "name" not in result:
+                raise ValueError(f"服务器响应格式无效: {result}")
+            log.debug("文件上传成功", result=result)
+            upload_cache.put(cache_key, result)
+            return result
+
         except FileNotFoundError:
-            logging.error(f"文件未找到: {local_file_path}")
+            log.error(f"文件未找到: {local_file_path}")
             raise
         except requests.exceptions.RequestException as e:
-            logging.error(f"上传文件失败: {str(e)}")
+            log.error(f"上传文件失败: {str(e)}")
+            raise
+        except Exception as e:
+            log.error(f"处理文件失败: {str(e)}")
+            raise
+
+    async def upload_file_async(self, user_id: str, file_path: str, mime_type: str, backend: Optional[DifyBackend] = None) -> str:
+        """异步上传文件到DIFY服务器，返回文件ID，参数与异常同upload_file"""
+        try:
+            client = await self.async_client(backend)
+            with open(file_path, "rb") as file:
+                result = await client.upload_async(user_id, os.path.basename(file_path), file, mime_type)
+            return result["id"]
+        except FileNotFoundError:
+            log.error(f"文件未找到: {file_path}")
+            raise
+        except aiohttp.ClientError as e:
+            log.error(f"上传文件失败: {str(e)}")
+            raise
+        except Exception as e:
+            log.error(f"处理文件时发生错误: {str(e)}")
             raise
+
+    async def upload_images_async(self, image_data_base64: str, user_id: str, backend: Optional[DifyBackend] = None,
+                                  app: Optional[DifyApp] = None) -> str:
+        """异步上传 base64 编码的图片到 DIFY 服务器，流式解码后直接从内存发送，不写临时文件"""
+        try:
+            backend = backend or self.balancer.backends[0]
+            reader = Base64Reader(image_data_base64)
+            # 解码与计算哈希占用CPU，大图在工作线程中处理
+            digest, head = await asyncio.to_thread(reader.digest)
+            upload_cache = get_upload_cache(self.valves)
+            cache_key = upload_cache_key(backend, digest, user_id)
+            file_id = upload_cache.get(cache_key)
+            if file_id is not None:
+                return file_id
+            mime_type, extension = sniff_image_type(head, reader.declared_type or "image/png")
+            client = await self.async_client(backend, app)
+            data = await asyncio.to_thread(reader.read_all)
+            result = await client.upload_async(user_id, f"image.{extension}", data, mime_type)
+            upload_cache.put(cache_key, result["id"])
+            return result["id"]
         except Exception as e:
-            logging.error(f"处理文件失败: {str(e)}")
-            raise           
-  
+            raise ValueError(f"Failed to process base64 image data: {str(e)}")
+
+    async def _get_file_dify_server_async(self, User_id: str, file_name: str, progress=None, backend: Optional[DifyBackend] = None,
+                                          app: Optional[DifyApp] = None) -> dict:
+        #异步版本：流式上传在工作线程中完成，见 AsyncDifyClient.upload_path_async
+        return await asyncio.to_thread(self._get_file_dify_server, User_id, file_name, progress, backend, app)
@@ -0,0 +1,46 @@
+"""
+测试的公共夹具
+
+管道脚本与模拟Dify服务都不是包，这里把仓库根目录与 benchmarks 加入 sys.path，
+并在未安装 open-webui 时注册基准测试使用的最小替代模块。
+"""
+
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_ROOT, os.path.join(REPO_ROOT, "benchmarks")]
+
+from _compat import ensure_open_webui  # noqa: E402
+
+ensure_open_webui()
+
+import mock_dify  # noqa: E402
+
+
+MOCK_ARGS = ["--tokens", "20", "--token-rate", "0", "--latency-ms", "0", "--upload-latency-ms", "0", "--nodes", "2"]
+
+
+@pytest.fixture(scope="session")
+def _mock_server():
+    server = mock_dify.start_server(mock_dify.build_parser().parse_args(MOCK_ARGS))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dify_server(_mock_server):
+    """在后台线程运行的模拟Dify服务，每个测试开始时恢复默认参数并清空请求计数，测试可以修改 server.config 调整行为"""
+    _mock_server.config = mock_dify.build_parser().parse_args(MOCK_ARGS)
+    with _mock_server.lock:
+        _mock_server.stats.clear()
+    return _mock_server
+
+
+@pytest.fixture
+def base_url(dify_server):
+    host, port = dify_server.server_address[:2]
+    return f"http://{host}:{port}/v1"
@@ -0,0 +1,53 @@
+"""
+DifyAppRegistry 在后台获取应用信息：Dify无应答时 pipes() 也不阻塞open-webui的事件循环
+"""
+
+import socket
+import time
+
+import pytest
+
+import dify_pipe
+
+
+@pytest.fixture
+def silent_url():
+    """接受连接但从不应答的服务"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(16)
+        yield f"http://127.0.0.1:{sock.getsockname()[1]}/v1"
+
+
+def make_pipe(apps: str, tmp_path, monkeypatch) -> dify_pipe.Pipe:
+    monkeypatch.chdir(tmp_path)
+    pipe = dify_pipe.Pipe()
+    pipe.valves.DIFY_APPS = apps
+    pipe.valves.APP_INFO_TIMEOUT = 0.3
+    return pipe
+
+
+def test_pipes_does_not_wait_for_silent_dify(silent_url, tmp_path, monkeypatch):
+    pipe = make_pipe(f"a|app-a||{silent_url}|Alpha;b|app-b|workflow|{silent_url}", tmp_path, monkeypatch)
+    started = time.perf_counter()
+    models = pipe.pipes()
+    assert time.perf_counter() - started < 0.2
+    # 获取完成前返回配置中的ID与名称
+    assert models == [{"id": "a", "name": "Alpha"}, {"id": "b", "name": "b"}]
+
+
+def test_refresh_updates_names(dify_server, base_url, tmp_path, monkeypatch):
+    pipe = make_pipe(f"a|app-a||{base_url}", tmp_path, monkeypatch)
+    assert pipe.pipes() == [{"id": "a", "name": "a"}]
+    assert pipe.apps.wait_ready(pipe._fetch_app_info, 2)
+    assert pipe.pipes() == [{"id": "a", "name": "Mock Dify"}]
+    assert pipe.apps.get("a").mode == "chat"
+
+
+def test_request_waits_at_most_twice_the_timeout(silent_url, tmp_path, monkeypatch):
+    pipe = make_pipe(f"a|app-a||{silent_url}", tmp_path, monkeypatch)
+    started = time.perf_counter()
+    assert not pipe.apps.wait_ready(pipe._fetch_app_info, 0.1)
+    # 每个请求超时后不重试，首次获取在两次超时内结束
+    assert pipe.apps.wait_ready(pipe._fetch_app_info, 2)
+    assert time.perf_counter() - started < 1.5
@@ -0,0 +1,34 @@
+"""
+Base64Reader 按块解码：带换行等空白的base64在任意块大小下都按4字符分组正确切分
+"""
+
+import base64
+import hashlib
+import os
+
+import pytest
+
+import dify_pipe
+import dify_Workflow
+
+RAW = os.urandom(10003)
+ENCODED = base64.b64encode(RAW).decode()
+
+
+def wrap(text: str, width: int, sep: str = "\n") -> str:
+    return sep.join(text[i:i + width] for i in range(0, len(text), width)) + sep
+
+
+@pytest.mark.parametrize("module", [dify_pipe, dify_Workflow])
+@pytest.mark.parametrize("data", [
+    ENCODED,
+    wrap(ENCODED, 76),
+    "data:image/png;base64," + wrap(ENCODED, 76, "\r\n"),
+    wrap(ENCODED, 13, " \n\t"),
+    ENCODED[:400] + " " * 300 + ENCODED[400:],
+])
+@pytest.mark.parametrize("chunk_chars", [4, 64, 1000])
+def test_whitespace_does_not_misalign_chunks(module, data, chunk_chars):
+    reader = module.Base64Reader(data, chunk_chars)
+    assert bytes(reader.read_all()) == RAW
+    assert reader.digest() == (hashlib.sha256(RAW).hexdigest(), RAW[:32])
@@ -0,0 +1,296 @@
+"""
+DifyClient 与 AsyncDifyClient 对模拟Dify服务的端到端测试：阻塞调用、流式调用、文件上传、重试与熔断
+"""
+
+import asyncio
+import socket
+import time
+
+import aiohttp
+import pytest
+import requests
+
+import dify_pipe
+import dify_Workflow
+
+# 两个文件中的同步客户端是同一份代码的副本，测试对两者都执行
+MODULES = [dify_pipe, dify_Workflow]
+
+
+class FlakyRetry(dify_pipe.RetryPolicy):
+    """第一次失败后让模拟服务恢复，且不等待退避时间"""
+
+    def __init__(self, server, attempts: int = 3):
+        super().__init__(attempts=attempts, base_delay=0)
+        self.server = server
+        self.waits = 0
+
+    def delay(self, attempt: int, retry_after=None) -> float:
+        self.waits += 1
+        self.server.config.error_rate = 0
+        return 0
+
+
+def make_client(module, base_url, retry=None, breaker=None, metrics=None, cls=None, **kwargs):
+    breaker = breaker or module.CircuitBreaker("mock", failure_threshold=0)
+    cls = cls or module.DifyClient
+    return cls(
+        module.DifyBackend(base_url, "app-test"),
+        module.PooledSession(),
+        retry=retry or module.RetryPolicy(attempts=1),
+        breaker=lambda url: breaker,
+        metrics=metrics,
+        labels={"app": "test"},
+        **kwargs,
+    )
+
+
+def requests_to(server, path: str) -> int:
+    return server.stats.get(f"/v1/{path}", 0)
+
+
+def closed_port_url() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1"
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_blocking_chat(module, dify_server, base_url):
+    metrics = module.Metrics()
+    client = make_client(module, base_url, metrics=metrics)
+    result = client.post_json("chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"})
+    assert result["answer"] == "xxxxxxx " * 20
+    assert result["conversation_id"]
+    assert metrics.stats()["dify_ttfb_seconds"]["app=test"]["count"] == 1
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_blocking_error_raises(module, dify_server, base_url):
+    dify_server.config.error_rate = 1
+    client = make_client(module, base_url)
+    with pytest.raises(Exception, match="HTTP Error 503"):
+        client.post_json("chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"})
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_stream_events(module, dify_server, base_url):
+    metrics = module.Metrics()
+    client = make_client(module, base_url, metrics=metrics)
+    events = list(client.stream_events("chat-messages", {"query": "hi", "response_mode": "streaming", "user": "u"},
+                                       events={"message", "message_end"}))
+    assert [e.event for e in events] == ["message"] * 20 + ["message_end"]
+    assert "".join(e.data["answer"] for e in events[:-1]) == "xxxxxxx " * 20
+    stats = metrics.stats()
+    # ping事件不解码但计入事件数
+    assert stats["dify_stream_events"]["app=test"]["avg"] == 22
+    assert stats["dify_stream_bytes"]["app=test"]["avg"] > 0
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_stream_workflow_filters_events(module, dify_server, base_url):
+    client = make_client(module, base_url)
+    events = list(client.stream_events("workflows/run", {"inputs": {}, "response_mode": "streaming", "user": "u"},
+                                       events={"node_started", "workflow_finished"}))
+    assert [e.event for e in events] == ["node_started", "node_started", "workflow_finished"]
+    assert events[-1].data["data"]["outputs"]["files"][0]["url"].endswith(".png")
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_upload_bytes(module, dify_server, base_url):
+    metrics = module.Metrics()
+    client = make_client(module, base_url, metrics=metrics)
+    result = client.upload("u", "a.png", b"\x89PNG" + b"0" * 1000, "image/png")
+    assert result["id"]
+    assert requests_to(dify_server, "files/upload") == 1
+    assert metrics.stats()["dify_upload_bytes"]["app=test"]["avg"] == 1004
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_upload_path_reports_progress(module, dify_server, base_url, tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"0" * 300000)
+    progress = []
+    client = make_client(module, base_url)
+    result = client.upload_path("u", str(path), mime_type="image/png", progress=lambda sent, total: progress.append((sent, total)))
+    assert result["id"]
+    # 模拟服务返回收到的请求体大小，包含multipart的分隔与头部
+    assert result["size"] > 300000
+    assert progress[-1] == (300000, 300000)
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_retry_status_then_success(module, dify_server, base_url):
+    dify_server.config.error_rate = 1
+    retry = FlakyRetry(dify_server)
+    client = make_client(module, base_url, retry=retry)
+    result = client.post_json("chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"})
+    assert result["answer"]
+    assert retry.waits == 1
+    assert requests_to(dify_server, "chat-messages") == 2
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_retry_gives_up_after_attempts(module, dify_server, base_url):
+    dify_server.config.error_rate = 1
+    client = make_client(module, base_url, retry=module.RetryPolicy(attempts=3, base_delay=0))
+    with pytest.raises(Exception, match="HTTP Error 503"):
+        client.post_json("chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"})
+    assert requests_to(dify_server, "chat-messages") == 3
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_retry_connection_error(module):
+    breaker = module.CircuitBreaker("mock", failure_threshold=10)
+    client = make_client(module, closed_port_url(), retry=module.RetryPolicy(attempts=2, base_delay=0), breaker=breaker)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post_json("chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"})
+    assert breaker.failures == 2
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_breaker_opens_and_recovers(module, dify_server, base_url):
+    dify_server.config.error_rate = 1
+    breaker = module.CircuitBreaker("mock", failure_threshold=2, reset_timeout=0.2)
+    client = make_client(module, base_url, breaker=breaker)
+    payload = {"query": "hi", "response_mode": "blocking", "user": "u"}
+    for _ in range(2):
+        with pytest.raises(Exception, match="HTTP Error 503"):
+            client.post_json("chat-messages", payload)
+    assert breaker.state == breaker.OPEN
+
+    # 熔断期间请求不会发到服务
+    with pytest.raises(module.CircuitOpenError):
+        client.post_json("chat-messages", payload)
+    assert requests_to(dify_server, "chat-messages") == 2
+    assert breaker.rejected == 1
+
+    # 超过reset_timeout后放行一个探测请求，成功则关闭
+    time.sleep(0.25)
+    dify_server.config.error_rate = 0
+    assert client.post_json("chat-messages", payload)["answer"]
+    assert breaker.state == breaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_breaker_probe_failure_reopens(dify_server, base_url):
+    dify_server.config.error_rate = 1
+    breaker = dify_pipe.CircuitBreaker("mock", failure_threshold=1, reset_timeout=0.2)
+    client = make_client(dify_pipe, base_url, breaker=breaker)
+    payload = {"query": "hi", "response_mode": "blocking", "user": "u"}
+    with pytest.raises(Exception, match="HTTP Error 503"):
+        client.post_json("chat-messages", payload)
+    time.sleep(0.25)
+    with pytest.raises(Exception, match="HTTP Error 503"):
+        client.post_json("chat-messages", payload)
+    assert breaker.state == breaker.OPEN
+    assert breaker.opened == 2
+
+
+# ---------- AsyncDifyClient
+
+
+def run_async(base_url, func, **kwargs):
+    """在新的事件循环中用AsyncDifyClient执行 func(client)"""
+
+    async def main():
+        async with aiohttp.ClientSession() as session:
+            client = make_client(dify_pipe, base_url, cls=dify_pipe.AsyncDifyClient, session=session, **kwargs)
+            return await func(client)
+
+    return asyncio.run(main())
+
+
+def test_async_blocking(dify_server, base_url):
+    result = run_async(base_url, lambda client: client.post_json_async(
+        "chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"}))
+    assert result["answer"] == "xxxxxxx " * 20
+
+
+def test_async_stream_events(dify_server, base_url):
+    metrics = dify_pipe.Metrics()
+
+    async def collect(client):
+        return [sse async for sse in client.stream_events_async(
+            "chat-messages", {"query": "hi", "response_mode": "streaming", "user": "u"}, events={"message", "message_end"})]
+
+    events = run_async(base_url, collect, metrics=metrics)
+    assert [e.event for e in events] == ["message"] * 20 + ["message_end"]
+    assert metrics.stats()["dify_stream_events"]["app=test"]["avg"] == 22
+
+
+def test_async_upload(dify_server, base_url):
+    result = run_async(base_url, lambda client: client.upload_async("u", "a.png", b"\x89PNG" + b"0" * 1000, "image/png"))
+    assert result["id"]
+    assert requests_to(dify_server, "files/upload") == 1
+
+
+def test_async_retry_status_then_success(dify_server, base_url):
+    dify_server.config.error_rate = 1
+    retry = FlakyRetry(dify_server)
+    result = run_async(base_url, lambda client: client.post_json_async(
+        "chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"}), retry=retry)
+    assert result["answer"]
+    assert requests_to(dify_server, "chat-messages") == 2
+
+
+def test_async_retry_connection_error():
+    breaker = dify_pipe.CircuitBreaker("mock", failure_threshold=10)
+    with pytest.raises(aiohttp.ClientConnectionError):
+        run_async(closed_port_url(), lambda client: client.post_json_async("chat-messages", {"query": "hi"}),
+                  retry=dify_pipe.RetryPolicy(attempts=2, base_delay=0), breaker=breaker)
+    assert breaker.failures == 2
+
+
+def test_async_breaker_opens(dify_server, base_url):
+    dify_server.config.error_rate = 1
+    breaker = dify_pipe.CircuitBreaker("mock", failure_threshold=2, reset_timeout=30)
+    payload = {"query": "hi", "response_mode": "blocking", "user": "u"}
+
+    async def calls(client):
+        for _ in range(2):
+            with pytest.raises(Exception, match="HTTP Error 503"):
+                await client.post_json_async("chat-messages", payload)
+        with pytest.raises(dify_pipe.CircuitOpenError):
+            await client.post_json_async("chat-messages", payload)
+
+    run_async(base_url, calls, breaker=breaker)
+    assert breaker.state == breaker.OPEN
+    assert requests_to(dify_server, "chat-messages") == 2
+
+
+@pytest.mark.parametrize("error, attempts", [
+    (aiohttp.ConnectionTimeoutError("Connection timeout to host"), 3),
+    (aiohttp.SocketTimeoutError("Timeout on reading data from socket"), 1),
+])
+def test_async_retry_timeouts(error, attempts):
+    # 连接超时时请求尚未发出，可以重发；读超时时Dify可能已在执行，不重发
+    calls = []
+
+    async def send():
+        calls.append(error)
+        raise error
+
+    with pytest.raises(type(error)):
+        asyncio.run(dify_pipe.retry_async(dify_pipe.RetryPolicy(attempts=3, base_delay=0), send))
+    assert len(calls) == attempts
+
+
+def test_async_connect_timeout_then_success(dify_server, base_url):
+    async def call(client):
+        post = client.session.post
+        calls = []
+
+        def flaky_post(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise aiohttp.ConnectionTimeoutError("Connection timeout to host")
+            return post(*args, **kwargs)
+
+        client.session.post = flaky_post
+        return await client.post_json_async("chat-messages", {"query": "hi", "response_mode": "blocking", "user": "u"}), calls
+
+    result, calls = run_async(base_url, call, retry=dify_pipe.RetryPolicy(attempts=2, base_delay=0))
+    assert result["answer"]
+    assert len(calls) == 2
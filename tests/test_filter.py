@@ -0,0 +1,80 @@
+"""
+Filter.inlet 为Pipe的各个Dify应用排队附件
+"""
+
+import pytest
+
+import dify_Filter
+import dify_pipe
+
+
+def file_item(file_id: str) -> dict:
+    return {
+        "type": "file", "name": f"{file_id}.pdf", "id": file_id, "url": f"/files/{file_id}", "size": 10,
+        "file": {"user_id": "u", "meta": {"content_type": "application/pdf", "size": 10}},
+    }
+
+
+@pytest.mark.parametrize("prefixes, model, queued", [
+    ("", "difyapitest.dify_id", True),
+    ("", "difyapitest.translator", True),
+    ("difyapitest.", "difyapitest.translator", True),
+    ("difyapitest., other.", "other.app", True),
+    ("difyapitest.", "gpt-4o", False),
+])
+def test_inlet_queues_files_for_matching_models(prefixes, model, queued):
+    filter = dify_Filter.Filter()
+    filter.valves.PREUPLOAD = False
+    filter.valves.MODEL_PREFIXES = prefixes
+    chat_id = f"chat-{model}-{prefixes}"
+    filter.inlet({"model": model, "files": [file_item("f1")]}, {"id": "u"}, {"chat_id": chat_id})
+    files = dify_Filter.get_attachment_queue().pop_all(chat_id)
+    assert [f["id"] for f in files] == (["f1"] if queued else [])
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    """Filter与Pipe都从当前目录下的 data/uploads 读取open-webui保存的文件"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data" / "uploads").mkdir(parents=True)
+    (tmp_path / "data" / "uploads" / "f1_f1.pdf").write_bytes(b"%PDF" + b"0" * 1000)
+    return tmp_path
+
+
+def preupload_filter(base_url: str) -> dify_Filter.Filter:
+    filter = dify_Filter.Filter()
+    filter.valves.DIFY_KEY = "app-test"
+    filter.valves.FILE_SERVER = f"{base_url}/files/upload"
+    filter.valves.RETRY_BASE_DELAY = 0
+    filter.valves.CIRCUIT_FAILURE_THRESHOLD = 0
+    return filter
+
+
+def test_preupload_retries_with_shared_session(dify_server, base_url, upload_dir):
+    filter = preupload_filter(base_url)
+    dify_server.config.error_rate = 1
+    with pytest.raises(Exception, match="503"):
+        dify_Filter.preupload_file(filter.valves, "u", "f1_f1.pdf")
+    assert dify_server.stats["/v1/files/upload"] == filter.valves.RETRY_ATTEMPTS
+
+    dify_server.config.error_rate = 0
+    assert dify_Filter.preupload_file(filter.valves, "u", "f1_f1.pdf")["id"]
+    # 与同样连接池配置的Pipe共用一个连接池
+    assert dify_Filter.get_http_session(filter.valves) is dify_pipe.get_http_session(dify_pipe.Pipe().valves)
+
+
+def test_pipe_caches_preupload_result(dify_server, base_url, upload_dir):
+    filter = preupload_filter(base_url)
+    filter.inlet({"model": "difyapitest.dify_id", "files": [file_item("f1")]}, {"id": "u"}, {"chat_id": "chat-cache"})
+    pipe = dify_pipe.Pipe()
+    pipe.valves.DIFY_BASE_URL = base_url
+    pipe.valves.DIFY_KEY = "app-test"
+    pipe.valves.FILE_SERVER = f"{base_url}/files/upload"
+    backend = dify_pipe.parse_backends(pipe.valves)[0]
+    file_info = dify_Filter.get_attachment_queue().pop_all("chat-cache")[0]
+    result = pipe._await_preupload(file_info, backend)
+    assert result["id"]
+
+    # 同一文件再次发送时命中上传缓存，不再上传
+    assert pipe._get_file_dify_server("u", "f1_f1.pdf", backend=backend) == result
+    assert dify_server.stats["/v1/files/upload"] == 1
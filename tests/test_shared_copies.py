@@ -0,0 +1,77 @@
+"""
+dify_pipe、dify_Workflow 与 dify_Filter 各自包含一份共用的基础设施代码（open-webui 独立加载每个函数），
+同名的顶层类、函数与常量必须逐字一致，修复只改了其中一份时在这里失败
+"""
+
+import ast
+import hashlib
+import itertools
+import os
+
+import pytest
+
+import dify_Filter
+import dify_pipe
+import dify_Workflow
+from conftest import REPO_ROOT
+
+FILES = ["dify_pipe.py", "dify_Workflow.py", "dify_Filter.py"]
+# 各文件有意不同的顶层名称：函数主体、各自的日志名称与需要处理的流式事件
+DIFFERENT = {"Pipe", "Filter", "log", "STREAM_EVENTS"}
+
+
+def top_level_sources(file_name: str) -> dict:
+    with open(os.path.join(REPO_ROOT, file_name), encoding="utf-8") as f:
+        source = f.read()
+    symbols = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            symbols[node.name] = ast.get_source_segment(source, node)
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            symbols[node.targets[0].id] = ast.get_source_segment(source, node)
+    return symbols
+
+
+SOURCES = {file_name: top_level_sources(file_name) for file_name in FILES}
+SHARED = [
+    (name, first, second)
+    for first, second in itertools.combinations(FILES, 2)
+    for name in sorted(SOURCES[first].keys() & SOURCES[second].keys() - DIFFERENT)
+]
+
+
+def test_files_share_infrastructure():
+    # 防止解析方式变化后比较的符号为空而测试形同虚设
+    assert len(SHARED) > 60
+
+
+@pytest.mark.parametrize("name, first, second", SHARED, ids=[f"{n}:{a}~{b}" for n, a, b in SHARED])
+def test_shared_symbol_identical(name, first, second):
+    assert SOURCES[first][name] == SOURCES[second][name], f"{name} 在 {first} 与 {second} 中不一致"
+
+
+def shared_code_digest() -> str:
+    """各文件中除函数主体以外的全部顶层代码的摘要"""
+    digest = hashlib.sha256()
+    for file_name in FILES:
+        for name, source in sorted(SOURCES[file_name].items()):
+            if name not in DIFFERENT:
+                digest.update(f"{file_name}:{name}\n{source}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+# 共享代码有改动时，把 SHARED_CODE_VERSION 加一并更新这里记录的版本与摘要
+RECORDED_VERSION = (2, "36f6b41181f025c4")
+
+
+def test_shared_code_version_bumped():
+    assert dify_pipe.SHARED_CODE_VERSION == dify_Workflow.SHARED_CODE_VERSION == dify_Filter.SHARED_CODE_VERSION
+    assert (dify_pipe.SHARED_CODE_VERSION, shared_code_digest()) == RECORDED_VERSION, (
+        "共享代码已修改：SHARED_CODE_VERSION 加一，使注册表中旧版本的对象不再被新代码使用"
+    )
+
+
+def test_same_version_shares_instances():
+    assert dify_pipe.get_metrics() is dify_Workflow.get_metrics()
+    assert dify_pipe.get_preupload_registry() is dify_Filter.get_preupload_registry()
+    assert dify_pipe.get_attachment_queue() is dify_Filter.get_attachment_queue()
@@ -0,0 +1,60 @@
+"""
+TokenCoalescer 在异步流程中按时间窗口输出：上游停顿时缓冲的文本不等下一个片段到达
+"""
+
+import asyncio
+import time
+
+import dify_pipe
+
+
+async def paused_source(pause: float):
+    for i in range(3):
+        yield f"a{i}"
+    await asyncio.sleep(pause)
+    yield "b"
+
+
+async def coalesce(source, coalescer):
+    started = time.monotonic()
+    out = []
+    async for text in dify_pipe.aiter_with_timeout(source, coalescer.remaining):
+        chunk = coalescer.flush() if text is None else coalescer.push(text)
+        if chunk:
+            out.append((time.monotonic() - started, chunk))
+    out.append((time.monotonic() - started, coalescer.flush()))
+    return out
+
+
+def test_flush_on_timer_while_upstream_pauses():
+    out = asyncio.run(coalesce(paused_source(0.5), dify_pipe.TokenCoalescer(1000, 0.05)))
+    assert [chunk for _, chunk in out] == ["a0a1a2", "b"]
+    # 停顿期间按时间窗口输出，而不是等到0.5秒后的下一个片段
+    assert out[0][0] < 0.3
+
+
+def test_passthrough_never_times_out():
+    coalescer = dify_pipe.TokenCoalescer(0, 0.05)
+    assert coalescer.push("a") == "a"
+    assert coalescer.remaining() is None
+
+
+def test_close_cancels_pending_read():
+    closed = []
+
+    async def slow():
+        try:
+            yield 1
+            await asyncio.sleep(10)
+            yield 2
+        finally:
+            closed.append(True)
+
+    async def main():
+        items = dify_pipe.aiter_with_timeout(slow(), lambda: 0.01)
+        assert await items.__anext__() == 1
+        assert await items.__anext__() is None
+        await items.aclose()
+
+    asyncio.run(main())
+    assert closed == [True]
@@ -0,0 +1,32 @@
+"""
+工作流流式响应：text_chunk已经输出过的文本不在workflow_finished中重复，未流式输出的文本在结束时补上
+"""
+
+import json
+
+import dify_Workflow
+
+
+def sse(event: str, data: dict) -> dify_Workflow.SSEEvent:
+    return dify_Workflow.SSEEvent(event, json.dumps({"event": event, "data": data}).encode("utf-8"))
+
+
+def run_stream(events) -> str:
+    pipe = dify_Workflow.Pipe()
+    pipe._workflow_stream = lambda client, path, payload, stream_events: (None, iter(events))
+    return "".join(pipe.stream_response(None, "workflows/run", {}))
+
+
+def test_only_streamed_outputs_are_skipped():
+    selector = ["llm", "text"]
+    events = [
+        sse("text_chunk", {"text": "Hello ", "from_variable_selector": selector}),
+        sse("text_chunk", {"text": "world", "from_variable_selector": selector}),
+        sse("workflow_finished", {"status": "succeeded", "outputs": {"answer": "Hello world", "summary": "Short"}}),
+    ]
+    assert run_stream(events) == "Hello world\n\nShort"
+
+
+def test_outputs_without_text_chunks():
+    events = [sse("workflow_finished", {"status": "succeeded", "outputs": {"answer": "Hello", "summary": "Short"}})]
+    assert run_stream(events) == "Hello\n\nShort"